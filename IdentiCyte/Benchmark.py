@@ -0,0 +1,461 @@
+"""
+   File Name: Benchmark.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Times each stage of the analysis on synthetic images and libraries
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+import cv2
+import numpy as np
+from IdentiCyte.CellDetection import detect, binarize, segment, analyze
+from IdentiCyte.ToGreyScale import greyalize
+from IdentiCyte.PCARecognition import PCARecognition
+from IdentiCyte.ConstructLibrary import compileLibrary
+from IdentiCyte.CellRecognitionDriver import driver
+from IdentiCyte.LibraryStore import loadLibrary
+from IdentiCyte.LibraryIndex import loadIndex
+import IdentiCyte.Globs as Globs
+
+BENCHMARK_VERSION = 1
+
+# The kinds of cell drawn in synthetic images. Each is a category of the synthetic library.
+CELL_KINDS = ['Solid', 'Ring', 'Faint']
+
+# The modules whose import time is measured, and the GUI and plotting packages none of them should load
+IMPORT_MODULES = ['IdentiCyte.ProcessFiles', 'IdentiCyte.CellRecognitionDriver', 'IdentiCyte.ConstructLibrary',
+                  'IdentiCyte.CommandLine']
+GUI_MODULES = ['tkinter', 'mttkinter', 'matplotlib', 'PIL.ImageTk']
+
+# Run in a new interpreter to time a cold import of one module
+_IMPORT_SCRIPT = '''import sys, timeit
+start = timeit.default_timer()
+import %s
+print(timeit.default_timer() - start)
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+def drawCell(img,  # type: ndarray
+             y,  # type: int
+             x,  # type: int
+             radius,  # type: int
+             kind,  # type: str
+             bf,  # type: bool
+             rng  # type: RandomState
+             ):
+    # type: (...) -> None
+    """
+    Draws one synthetic cell into a single channel image.
+
+    Parameters
+    ----------
+    img : ndarray
+        The uint8 image to draw in
+    y, x : int
+        The centre of the cell
+    radius : int
+        The radius of the cell in pixels
+    kind : str
+        One of CELL_KINDS
+    bf : bool
+        Draws a dark cell for bright field(True) or a bright one for fluorescence(False)
+    rng : RandomState
+        The source of the variation between cells
+    """
+    if bf:
+        body = int(rng.randint(40, 90))
+        centre = int(rng.randint(110, 150))
+    else:
+        body = int(rng.randint(150, 230))
+        centre = int(rng.randint(70, 110))
+    if kind == 'Faint':
+        body = (body + (200 if bf else 30))//2
+    cv2.circle(img, (int(x), int(y)), int(radius), body, -1)
+    if kind == 'Ring':
+        cv2.circle(img, (int(x), int(y)), int(radius)//2, centre, -1)
+
+
+def syntheticField(height=2048,  # type: Optional(int)
+                   width=2048,  # type: Optional(int)
+                   density=20,  # type: Optional(float)
+                   radius=(30, 50),  # type: Optional(Tuple[int, int])
+                   bf=True,  # type: Optional(bool)
+                   seed=0  # type: Optional(int)
+                   ):
+    # type: (...) -> ndarray
+    """
+    Makes a synthetic microscope image of randomly placed cells.
+
+    Parameters
+    ----------
+    height, width : int
+        The size of the image in pixels
+    density : float
+        The number of cells per million pixels. Cells may overlap and form clumps.
+    radius : tuple
+        The smallest and largest cell radius in pixels
+    bf : bool
+        Makes a bright field(True) or fluorescence(False) image
+    seed : int
+        The random seed, so the same image can be made again
+
+    Returns
+    -------
+    image : ndarray
+        A 3 channel uint8 image
+    """
+    rng = np.random.RandomState(seed)
+    img = np.full((height, width), 200 if bf else 30, np.uint8)
+    for _ in range(int(round(density*height*width/1e6))):
+        drawCell(img, rng.randint(0, height), rng.randint(0, width), rng.randint(radius[0], radius[1] + 1),
+                 CELL_KINDS[rng.randint(len(CELL_KINDS))], bf, rng)
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    img = np.clip(img + rng.normal(0, 6, img.shape), 0, 255).astype(np.uint8)
+    return np.stack((img,)*3, axis=-1)
+
+
+def syntheticLibrary(l_dir,  # type: str
+                     size=60,  # type: Optional(int)
+                     cropRadius=60,  # type: Optional(int)
+                     radius=(30, 50),  # type: Optional(Tuple[int, int])
+                     bits=3,  # type: Optional(int)
+                     seed=0  # type: Optional(int)
+                     ):
+    # type: (...) -> List[str]
+    """
+    Writes a synthetic library of single cell images, sorted into a folder for each of CELL_KINDS.
+
+    Parameters
+    ----------
+    l_dir : str
+        The library folder. It is created if needed.
+    size : int
+        The total number of library images
+    cropRadius : int
+        The images are cropRadius*2 + 1 pixels square, as cut out by ExCells
+    radius : tuple
+        The smallest and largest cell radius in pixels
+    bits : int
+        The bit depth the images are reduced to
+    seed : int
+        The random seed
+
+    Returns
+    -------
+    typeArray : list
+        The categories of the library
+    """
+    rng = np.random.RandomState(seed)
+    side = 2*cropRadius + 1
+    for kind in CELL_KINDS:
+        os.makedirs(os.path.join(l_dir, kind), exist_ok=True)
+    for k in range(size):
+        kind = CELL_KINDS[k % len(CELL_KINDS)]
+        img = np.full((side, side), 200, np.uint8)
+        drawCell(img, cropRadius + rng.randint(-3, 4), cropRadius + rng.randint(-3, 4),
+                 rng.randint(radius[0], radius[1] + 1), kind, True, rng)
+        img = np.clip(img + rng.normal(0, 6, img.shape), 0, 255).astype(np.uint8)
+        cell = greyalize(img, bits).astype(np.uint8)
+        cv2.imwrite(os.path.join(l_dir, kind, '%d.tif' % k), cell)
+    return list(CELL_KINDS)
+
+
+def timeStage(function,  # type: Callable[[], Any]
+              repeat=3  # type: Optional(int)
+              ):
+    # type: (...) -> dict
+    """
+    Times a function over several runs.
+
+    Returns
+    -------
+    timing : dict
+        The 'best' and 'median' time in seconds and the time of every run ('runs').
+    """
+    runs = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        function()
+        runs.append(timeit.default_timer() - start)
+    return {'best': min(runs), 'median': float(np.median(runs)), 'runs': runs}
+
+
+def importTime(module,  # type: str
+               repeat=3  # type: Optional(int)
+               ):
+    # type: (...) -> dict
+    """
+    Times importing a module in a new interpreter each run, as a worker process or the command line would.
+
+    Compiled bytecode and the operating system's file cache are kept between runs, so this measures the cost of
+    loading the modules rather than reading them from disk.
+
+    Parameters
+    ----------
+    module : str
+        The full name of the module, such as 'IdentiCyte.ProcessFiles'
+    repeat : int
+        The number of times the module is imported
+
+    Returns
+    -------
+    timing : dict
+        As from timeStage, plus the 'gui' modules from GUI_MODULES the import loaded.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_SCRIPT % module], cwd=root,
+                                         universal_newlines=True)
+        seconds, modules = output.splitlines()[-2:]
+        runs.append(float(seconds))
+        loaded = modules.split()
+    gui = [name for name in GUI_MODULES if name in loaded]
+    return {'best': min(runs), 'median': float(np.median(runs)), 'runs': runs, 'gui': gui}
+
+
+def cellMatrix(image,  # type: ndarray
+               locations,  # type: List[List[int]]
+               cropRadius,  # type: int
+               bits=3,  # type: Optional(int)
+               color='B'  # type: Optional(str)
+               ):
+    # type: (...) -> ndarray
+    """
+    Cuts out and normalizes each cell as ProcessFiles does. Cells on the edge are left as zeros.
+    """
+    side = 2*cropRadius + 1
+    cellData = np.zeros([len(locations), side*side])
+    for k, (y, x) in enumerate(locations):
+        if cropRadius < y < np.shape(image)[0] - cropRadius and cropRadius < x < np.shape(image)[1] - cropRadius:
+            cell = greyalize(image[y - cropRadius:y + cropRadius + 1, x - cropRadius:x + cropRadius + 1], bits, color)
+            cellData[k] = np.ravel(cell/np.max(cell))
+    return cellData
+
+
+def runBenchmarks(height=2048,  # type: Optional(int)
+                  width=2048,  # type: Optional(int)
+                  density=20,  # type: Optional(float)
+                  librarySize=60,  # type: Optional(int)
+                  images=4,  # type: Optional(int)
+                  repeat=3,  # type: Optional(int)
+                  radius=(30, 50),  # type: Optional(Tuple[int, int])
+                  cropRadius=60,  # type: Optional(int)
+                  seed=0  # type: Optional(int)
+                  ):
+    # type: (...) -> dict
+    """
+    Times every stage of the analysis on synthetic bright field and fluorescence images.
+
+    detect, segment, analyze and greyalize are timed on one image of each illumination, and driver on a folder of
+    them. compileLibrary and PCARecognition are timed once against a synthetic library. The cold import of each of
+    IMPORT_MODULES is timed as 'import/' and the module name.
+
+    Parameters
+    ----------
+    height, width : int
+        The size of the synthetic images
+    density : float
+        The number of cells per million pixels
+    librarySize : int
+        The number of images in the synthetic library
+    images : int
+        The number of images in the folder analysed by driver
+    repeat : int
+        The number of times each stage is run
+    radius : tuple
+        The smallest and largest cell radius in pixels
+    cropRadius : int
+        Sets the size of the library images
+    seed : int
+        The random seed
+
+    Returns
+    -------
+    results : dict
+        The 'environment' and 'parameters' of the run, and the timing of each stage in 'stages', as from timeStage.
+        The stages that depend on the illumination are prefixed with 'bf/' or 'fluorescent/'.
+    """
+    minSize = int(0.5*np.pi*radius[0]**2)
+    stages = {}
+    counts = {}
+    for module in IMPORT_MODULES:
+        stages['import/' + module.split('.')[-1]] = importTime(module, repeat)
+
+    with tempfile.TemporaryDirectory() as work:
+        l_dir = os.path.join(work, 'Library')
+        typeArray = syntheticLibrary(l_dir, librarySize, cropRadius, radius, seed=seed)
+        stages['compileLibrary'] = timeStage(lambda: compileLibrary(l_dir), repeat)
+        library = loadLibrary(l_dir)
+        index = loadIndex(l_dir, library)
+
+        for bf, mode in [(True, 'bf'), (False, 'fluorescent')]:
+            image = syntheticField(height, width, density, radius, bf, seed)
+            binIm = binarize(image, 'B', 'Otsu', bf)
+            markers = segment(binIm, image)
+            locations = analyze(markers, minSize)
+            crops = [image[max(y - cropRadius, 0):y + cropRadius + 1, max(x - cropRadius, 0):x + cropRadius + 1]
+                     for y, x in locations]
+            cellData = cellMatrix(image, locations, cropRadius)
+            counts[mode] = len(locations)
+
+            stages[mode + '/detect'] = timeStage(lambda: detect(image, 'B', 'Otsu', minSize, bf), repeat)
+            stages[mode + '/segment'] = timeStage(lambda: segment(binIm, image), repeat)
+            stages[mode + '/analyze'] = timeStage(lambda: analyze(markers, minSize), repeat)
+            stages[mode + '/greyalize'] = timeStage(lambda: [greyalize(crop) for crop in crops], repeat)
+            stages[mode + '/PCARecognition'] = timeStage(
+                lambda: PCARecognition(cellData, library, False, l_dir, typeArray, index=index), repeat)
+
+            pics_dir = os.path.join(work, mode)
+            os.mkdir(pics_dir)
+            for k in range(images):
+                cv2.imwrite(os.path.join(pics_dir, '%d.tif' % k), syntheticField(height, width, density, radius, bf,
+                                                                                   seed + k))
+            stages[mode + '/driver'] = timeStage(lambda: _quietDriver(l_dir, pics_dir, minSize, bf), repeat)
+
+    return {'version': BENCHMARK_VERSION,
+            'created': datetime.now().isoformat(),
+            'environment': environment(),
+            'parameters': {'height': height, 'width': width, 'density': density, 'librarySize': librarySize,
+                           'images': images, 'repeat': repeat, 'radius': list(radius), 'cropRadius': cropRadius,
+                           'seed': seed, 'cells': counts},
+            'stages': stages}
+
+
+def environment():
+    # type: () -> dict
+    """
+    Describes the machine and library versions a benchmark was run with.
+    """
+    import sklearn
+    import scipy
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'opencv': cv2.__version__,
+            'sklearn': sklearn.__version__}
+
+
+def compareResults(baseline,  # type: dict
+                   current,  # type: dict
+                   tolerance=0.1  # type: Optional(float)
+                   ):
+    # type: (...) -> List[dict]
+    """
+    Compares the best time of each stage between two benchmark runs.
+
+    Parameters
+    ----------
+    baseline : dict
+        The results of the earlier run, from runBenchmarks
+    current : dict
+        The results of the later run
+    tolerance : float
+        The fraction a stage may slow down by before it counts as a regression
+
+    Returns
+    -------
+    comparison : list
+        For each stage in both runs, its 'stage' name, 'baseline' and 'current' best times, their 'ratio' and whether
+        it 'regressed'.
+    """
+    comparison = []
+    for stage in sorted(current['stages']):
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['best']
+        after = current['stages'][stage]['best']
+        ratio = after/before if before > 0 else float('inf')
+        comparison.append({'stage': stage, 'baseline': before, 'current': after, 'ratio': ratio,
+                           'regressed': ratio > 1 + tolerance})
+    return comparison
+
+
+def formatResults(results,  # type: dict
+                  comparison=None  # type: Optional(List[dict])
+                  ):
+    # type: (...) -> str
+    """
+    Lays out the timings of a run, and the comparison with an earlier run if given, as a table.
+    """
+    lines = ['%-28s %10s %10s' % ('Stage', 'Best (s)', 'Median (s)')]
+    for stage in sorted(results['stages']):
+        timing = results['stages'][stage]
+        lines.append('%-28s %10.4f %10.4f' % (stage, timing['best'], timing['median']))
+    if comparison:
+        lines.append('')
+        lines.append('%-28s %10s %10s %8s' % ('Stage', 'Before (s)', 'After (s)', 'Ratio'))
+        for row in comparison:
+            lines.append('%-28s %10.4f %10.4f %7.2fx%s' % (row['stage'], row['baseline'], row['current'],
+                                                           row['ratio'], '  REGRESSED' if row['regressed'] else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None  # type: Optional(List[str])
+         ):
+    # type: (...) -> int
+    """
+    Runs the benchmarks from the command line. Returns 1 if a stage regressed against the --compare results.
+    """
+    parser = argparse.ArgumentParser(prog='python -m IdentiCyte.Benchmark',
+                                     description='Times each stage of IdentiCyte on synthetic images.')
+    parser.add_argument('--height', type=int, default=2048)
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--density', type=float, default=20, help='cells per million pixels')
+    parser.add_argument('--library', type=int, default=60, help='number of library images')
+    parser.add_argument('--images', type=int, default=4, help='number of images analysed end to end')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slow down before a regression')
+    args = parser.parse_args(argv)
+
+    results = runBenchmarks(args.height, args.width, args.density, args.library, args.images, args.repeat,
+                            seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    comparison = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            comparison = compareResults(json.load(f), results, args.tolerance)
+    print(formatResults(results, comparison))
+    if comparison and any(row['regressed'] for row in comparison):
+        return 1
+    return 0
+
+
+def _quietDriver(l_dir,  # type: str
+                 pics_dir,  # type: str
+                 minSize,  # type: int
+                 bf  # type: bool
+                 ):
+    # type: (...) -> None
+    """
+    Runs driver on a folder without its progress messages.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        driver(l_dir, pics_dir, method='Otsu', cellSize=minSize, bf=bf)
+    Globs.end = False
+
+
+if __name__ == '__main__':
+    sys.exit(main())
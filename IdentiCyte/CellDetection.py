@@ -2,23 +2,37 @@
    File Name: CellDetection.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Locates all the cells in a batch of images
 """
 import cv2
 from scipy.ndimage.morphology import binary_fill_holes
+from scipy.ndimage import find_objects
 import numpy as np
+import IdentiCyte.Instrument as Instrument
+
+# The fields of the per-cell table returned by regionStats
+REGION_DTYPE = np.dtype([('label', np.int32),
+                         ('area', np.int64),
+                         ('y', np.int64),
+                         ('x', np.int64),
+                         ('ymin', np.int32),
+                         ('xmin', np.int32),
+                         ('ymax', np.int32),
+                         ('xmax', np.int32),
+                         ('intensity', np.float64)])
 
 
 def detect(image,  # type: ndarray
            channel='B',  # type: Opional(str)
            method='Otsu',  # type: Opional(str)
            minSize=9000,  # type: Opional(int)
-           bf=True  # type: Opional(bool)
+           bf=True,  # type: Opional(bool)
+           table=False  # type: Optional(bool)
            ):
-    # type: (...) -> List[List[int]]
+    # type: (...) -> Union[List[List[int]], ndarray]
     """
     Detects cells in an image
 
@@ -37,21 +51,63 @@ def detect(image,  # type: ndarray
         The minimum number of pixels in a blob for it to be considered a cell and not small debris.
     bf : bool
         Indicates whether the image is bright field(True) or fluorescent(False)
+    table : bool
+        Return the per-cell statistics table from regionStats instead of the list of centroids.
 
     Returns
     -------
-    imInfo : list
-        A list of the approximate centroid for each cell detected in an image.
+    imInfo : list or ndarray
+        A list of the approximate centroid for each cell detected in an image, or a structured array with one row
+        per cell if table is True.
     """
 
     imBinar = process(image,
                       channel,
                       method,
                       bf)
+    if table:
+        return analyze(imBinar, minSize, image=channelImage(image, channel), table=True)
     imInfo = analyze(imBinar, minSize)
     return imInfo
 
 
+def channelImage(image,  # type: ndarray
+                 channel='B'  # type: Optional(str)
+                 ):
+    # type: (ndarray, Optional(str)) -> ndarray
+    """
+    Selects the colour channel which is inspected when detecting cells.
+
+    Parameters
+    ----------
+    image : ndarray
+        An array containing the pixel values of the image. Can be 3 channel colour or grey scale
+    channel : str
+        The colour channel that will be inspected, ignored if analyzing grey scale images
+
+    Returns
+    -------
+    img : ndarray
+        A view of the selected channel of the image.
+    """
+    # Select the correct color channel
+    if channel == 'R':
+        select = 2
+    elif channel == 'G':
+        select = 1
+    else:
+        select = 0
+
+    if len(np.shape(image)) == 3:
+        try:
+            img = image[:, :, select]
+        except IndexError:
+            img = image[:, :, 0]
+    else:
+        img = image
+    return img
+
+
 def process(image,  # type: ndarray
             channel='B',  # type: Opional(str)
             method='Otsu',  # type: Opional(str)
@@ -80,22 +136,41 @@ def process(image,  # type: ndarray
         An array of the same size as the input image. The elements along the edge have a value -1, the background
         of the image is 1 and each detected cell has a unique positive integer value.
     """
-    # Select the correct color channel
-    if channel is 'R':
-        select = 2
-    elif channel is 'G':
-        select = 1
-    else:
-        select = 0
+    imtst = binarize(image, channel, method, bf)
+    outim = segment(imtst, image)
+    return outim
 
-    if len(np.shape(image)) == 3:
-        try:
-            img = image[:, :, select]
-        except IndexError:
-            img = image[:, :, 0]
-    else:
-        img = image
 
+def binarize(image,  # type: ndarray
+             channel='B',  # type: Optional(str)
+             method='Otsu',  # type: Optional(str)
+             bf=True,  # type: Optional(bool)
+             level=None  # type: Optional(float)
+             ):
+    # type: (...) -> ndarray
+    """
+    Thresholds the image into cells and background and fills the holes in the cells.
+
+    Parameters
+    ----------
+    image : ndarray
+        An array containing the pixel values of the image. Can be 3 channel colour or grey scale
+    channel : str
+        The colour channel that will be inspected, ignored if analyzing grey scale images
+    method : str
+        The algorithm used to threshold the image into binary when detecting cells. Either 'Otsu' or 'Triangle'.
+    bf : bool
+        Indicates whether the image is bright field(True) or fluorescent(False)
+    level : float
+        A fixed threshold to use instead of the one found by method. Pixels above it are background in bright field
+        images.
+
+    Returns
+    -------
+    imtst : ndarray
+        A uint8 array of the same size as the image where cells are 255 and the background is 0.
+    """
+    img = channelImage(image, channel)
 
     # Perform the thresholding
     if method == 'Triangle':
@@ -108,7 +183,11 @@ def process(image,  # type: ndarray
         img = np.multiply(img, 255)
         img = img.astype(np.uint8)
         print('Hold')
-    ret, binIm = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+meth)
+    with Instrument.stage('threshold'):
+        if level is None:
+            ret, binIm = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+meth)
+        else:
+            ret, binIm = cv2.threshold(img, level, 255, cv2.THRESH_BINARY)
 
     # Fill the holes in the cells
     if bf:
@@ -117,20 +196,20 @@ def process(image,  # type: ndarray
     else:
         binIm[binIm == 0] = False
         binIm[binIm == 255] = True
-    filIm = binary_fill_holes(binIm)
+    with Instrument.stage('fillHoles'):
+        filIm = binary_fill_holes(binIm)
     imtst = np.zeros(np.shape(filIm), np.uint8)
 
     imtst[filIm == False] = 0
     imtst[filIm == True] = 255
-
-    outim = segment(imtst, image)
-    return outim
+    return imtst
 
 
 def segment(img,  # type: ndarray
-            image  # type: ndarray
+            image,  # type: ndarray
+            fgLevel=None  # type: Optional(float)
             ):
-    # type: (ndarray, ndarray) -> ndarray
+    # type: (ndarray, ndarray, Optional(float)) -> ndarray
     """
     Separates cells from the background of the image.
 
@@ -143,6 +222,9 @@ def segment(img,  # type: ndarray
         Numbers must have type uint8.
     image : ndarray
         An array containing the pixel values of a single channel image. Numbers must have type uint8.
+    fgLevel : float
+        The distance from the background above which pixels are certainly part of a cell. Defaults to 60% of the
+        largest distance in img.
 
     Returns
     -------
@@ -153,19 +235,75 @@ def segment(img,  # type: ndarray
     if (len(np.shape(image)) != 3) or (np.shape(image)[2] == 1):
         image = np.stack((image,) * 3, axis=-1)
 
+    with Instrument.stage('seeds'):
+        markers = seeds(img, fgLevel)
+
+    # Segment the images
+    with Instrument.stage('watershed'):
+        markers = cv2.watershed(image, markers)
+    return markers
+
+
+def distance(img  # type: ndarray
+             ):
+    # type: (ndarray) -> (ndarray, ndarray)
+    """
+    Cleans up a binary image and finds how far each cell pixel is from the background.
+
+    Parameters
+    ----------
+    img : ndarray
+        An array representing a binary image with cells as 255 on a background of 0. Numbers must have type uint8.
+
+    Returns
+    -------
+    op : ndarray
+        The binary image with small noise spots removed.
+    dstTransf : ndarray
+        The distance of each pixel in op from the background, rounded to uint8.
+    """
     # Remove any small black noise spots
     kernel = np.ones((3, 3), np.uint8)
 
     op = cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel, iterations=2)
     op = np.uint8(op)
 
-    # Prepare the image for watershedding
-    sureBg = cv2.dilate(op, kernel, iterations=3)
-
     dstTransf = cv2.distanceTransform(op, cv2.DIST_L2, 5)
 
     dstTransf = np.rint(dstTransf).astype('uint8')
-    _, sureFg = cv2.threshold(dstTransf, 0.6*np.max(dstTransf), 255, cv2.THRESH_BINARY)
+    return op, dstTransf
+
+
+def seeds(img,  # type: ndarray
+          fgLevel=None  # type: Optional(float)
+          ):
+    # type: (ndarray, Optional(float)) -> ndarray
+    """
+    Builds the markers that the watershed grows into cells.
+
+    Parameters
+    ----------
+    img : ndarray
+        An array representing a binary image with cells as 255 on a background of 0. Numbers must have type uint8.
+    fgLevel : float
+        The distance from the background above which pixels are certainly part of a cell. Defaults to 60% of the
+        largest distance in img.
+
+    Returns
+    -------
+    markers : ndarray
+        An int32 array where the background is 1, the unknown region around each cell is 0 and the centre of each
+        cell has a unique integer value of 2 or more.
+    """
+    kernel = np.ones((3, 3), np.uint8)
+    op, dstTransf = distance(img)
+
+    # Prepare the image for watershedding
+    sureBg = cv2.dilate(op, kernel, iterations=3)
+
+    if fgLevel is None:
+        fgLevel = 0.6*np.max(dstTransf)
+    _, sureFg = cv2.threshold(dstTransf, fgLevel, 255, cv2.THRESH_BINARY)
 
     sureFg = np.uint8(sureFg)
     unknown = cv2.subtract(sureBg, sureFg)
@@ -173,21 +311,91 @@ def segment(img,  # type: ndarray
 
     markers = markers + 1
     markers[unknown == 255] = 0
-
-    # Segment the images
-    markers = cv2.watershed(image, markers)
     return markers
 
 
+def regionStats(segIm,  # type: ndarray
+                image=None  # type: Optional(ndarray)
+                ):
+    # type: (ndarray, Optional(ndarray)) -> ndarray
+    """
+    Measures every labelled region of a segmented image in a single pass.
+
+    The pixel count, centroid, bounding box and mean intensity of every label are gathered with bincount reductions
+    over the flattened image, so the cost does not grow with the number of labels.
+
+    Parameters
+    ----------
+    segIm : ndarray
+        An array of integer labels, such as the output of segment().
+    image : ndarray
+        An optional single channel image of the same size as segIm. Its values are averaged over each region.
+
+    Returns
+    -------
+    stats : ndarray
+        A structured array with one row per label, sorted by label, with the fields of REGION_DTYPE. The centroid
+        (y, x) is rounded to the nearest pixel. The bounding box is inclusive. intensity is NaN if no image was given.
+    """
+    labels = np.asarray(segIm).ravel()
+    if labels.size == 0:
+        return np.zeros(0, dtype=REGION_DTYPE)
+
+    # Map the labels onto 0..n-1. Labels from the watershed are small consecutive integers, so a plain offset is
+    # enough, otherwise fall back to sorting.
+    low = int(labels.min())
+    high = int(labels.max())
+    if high - low < labels.size:
+        flat = labels - low
+        count = np.bincount(flat)
+        present = np.flatnonzero(count)
+        values = present + low
+        if len(present) < len(count):
+            lookup = np.full(len(count), -1, dtype=np.intp)
+            lookup[present] = np.arange(len(present))
+            flat = lookup[flat]
+            count = count[present]
+    else:
+        values, flat, count = np.unique(labels, return_inverse=True, return_counts=True)
+        flat = flat.ravel()
+    n = len(values)
+    rows, cols = np.shape(segIm)
+
+    stats = np.zeros(n, dtype=REGION_DTYPE)
+    stats['label'] = values
+    stats['area'] = count
+
+    # Sum the row and column co-ordinates of every pixel in each region
+    ySum = np.bincount(flat, weights=np.repeat(np.arange(rows, dtype=np.float64), cols), minlength=n)
+    xSum = np.bincount(flat, weights=np.tile(np.arange(cols, dtype=np.float64), rows), minlength=n)
+    stats['y'] = np.round(ySum/count)
+    stats['x'] = np.round(xSum/count)
+
+    # find_objects needs labels starting from 1
+    for k, box in enumerate(find_objects(flat.reshape(rows, cols) + 1)):
+        stats['ymin'][k] = box[0].start
+        stats['ymax'][k] = box[0].stop - 1
+        stats['xmin'][k] = box[1].start
+        stats['xmax'][k] = box[1].stop - 1
+
+    if image is None:
+        stats['intensity'] = np.nan
+    else:
+        stats['intensity'] = np.bincount(flat, weights=np.ravel(image).astype(np.float64), minlength=n)/count
+    return stats
+
+
 def analyze(segIm,  # type: ndarray
-            minSize  # type: int
+            minSize,  # type: int
+            image=None,  # type: Optional(ndarray)
+            table=False  # type: Optional(bool)
             ):
-    # type: (ndarray, int) -> List[List[int]]
+    # type: (...) -> Union[List[List[int]], ndarray]
     """
     Counts the segmented cells in an image
 
-    This counts the number of pixels with a unique value in an array and notes their co-ordinates within the array.
-    For values with a high enough pixel count, it averages the co-ordinates and returns a centroid.
+    This measures every region in the array with regionStats. Regions with a high enough pixel count are kept as
+    cells. The first two regions (the edges and the background after watershedding) are never counted.
 
     Parameters
     ----------
@@ -196,22 +404,20 @@ def analyze(segIm,  # type: ndarray
         of the image is 1 and each detected cell has a unique positive integer value.
     minSize : int
         The minimum number of pixels in a blob for it to be considered a cell and not small debris.
-
+    image : ndarray
+        An optional single channel image of the same size as segIm, used for the mean intensity of each cell.
+    table : bool
+        Return the rows of the regionStats table for the cells instead of a list of centroids.
 
     Returns
     -------
-    list
-        A list of the approximate centroid for each cell detected in an image.
+    list or ndarray
+        A list of the approximate centroid for each cell detected in an image, or a structured array with one row
+        per cell if table is True.
     """
-    # Counts the number of dark blobs in the image
-    segment, count = np.unique(segIm, return_counts=True)
-    resArr = []
-    # Get all the relevant information from any cells.
-    for j in range(len(segment)):
-        if j > 1 and count[j] >= minSize:
-            y, x = np.where(segIm == segment[j])
-            resArr.append([int(np.round(np.mean(y))), int(np.round(np.mean(x)))])
-
-    return resArr
-
-
+    with Instrument.stage('regions'):
+        stats = regionStats(segIm, image)
+    cells = stats[2:][stats['area'][2:] >= minSize]
+    if table:
+        return cells
+    return [[int(y), int(x)] for y, x in zip(cells['y'], cells['x'])]
@@ -2,20 +2,33 @@
    File Name: CellRecognitionDriver.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Calls all the individual elements of the analysis
 """
-from IdentiCyte.ProcessFiles import ProcessFiles
+from IdentiCyte.ProcessFiles import ProcessFiles, iterProcessFiles, imageNames
 from IdentiCyte.CellStatistics import CellStats
 from IdentiCyte.WriteResult import WriteResults
+from IdentiCyte.ResultSinks import PickleSink, CsvSink, WorkbookSink
+from IdentiCyte.CellTable import CellTableSink
+from IdentiCyte.ResultsDatabase import DatabaseSink, recordResults
+from IdentiCyte.LibraryStore import libraryExists
 import IdentiCyte.Globs as Globs
-import xlsxwriter
+import IdentiCyte.Instrument as Instrument
 import numpy as np
+import itertools
 import os
 import timeit
 
+# How a run of driver or batch ended
+RUN_DONE = 'done'
+RUN_FAILED = 'failed'
+RUN_MISSING = 'missing'
+RUN_NO_IMAGES = 'no images'
+RUN_CANCELLED = 'cancelled'
+
+
 def driver(l_dir,  # type: str
            pics_dir,  # type: str
            window=None,  # type: Opional(MainWindow)
@@ -27,9 +40,18 @@ def driver(l_dir,  # type: str
            pcThresh=90,  # type: Opional(float)
            confThresh=50,  # type: Opional(float)
            bf=True,  # type: Opional(bool)
-           near=10  # type: Opional(int)
+           near=10,  # type: Opional(int)
+           workers=1,  # type: Optional(int)
+           stream=False,  # type: Optional(bool)
+           prefetch=2,  # type: Optional(int)
+           instrument=False,  # type: Optional(bool)
+           cache=None,  # type: Optional(DiskCache)
+           detections=None,  # type: Optional(DiskCache)
+           database=None,  # type: Optional(ResultsDatabase)
+           probes=None,  # type: Optional(int)
+           tileMemory=None  # type: Optional(int)
            ):
-    # type: (...) -> None
+    # type: (...) -> str
     """
     Drives the analysis
 
@@ -64,82 +86,153 @@ def driver(l_dir,  # type: str
         Indicates whether the image is bright field(True) or fluorescent(False)
     near : int
         The number of nearest neighbours in the library that will be considered when classifying a cell
+    workers : int
+        The number of processes used to analyse the images in parallel
+    stream : bool
+        Write the results of each image as soon as it is analysed, rather than keeping every result until the end.
+        A per-cell IdentifiedCells.csv is written as well, and the results so far are kept if the analysis stops.
+    prefetch : int
+        The number of images read ahead on background threads while an image is analysed
+    instrument : bool
+        Record the time spent in each stage of the analysis and write it to a JSON file next to the workbook.
+    cache : DiskCache
+        A cache of results, so images that have not changed since they were last analysed with the same settings and
+        library are not analysed again.
+    detections : DiskCache
+        A cache of the cells found in each image, so images that have not changed since they were last analysed with
+        the same detection settings are not segmented again. Only the recognition is run when only pcThresh,
+        confThresh, near or the library have changed.
+    database : ResultsDatabase
+        A database the run, its images and their cells are added to, as well as the files in pics_dir
+    probes : int
+        The number of clusters an approximate library index searches for each cell, instead of the number it was
+        compiled with. More clusters miss fewer neighbours but search more slowly.
+    tileMemory : int
+        The most memory in bytes that finding the cells in an image may use. Larger images are segmented a tile at a
+        time.
+
+    Returns
+    -------
+    status : str
+        RUN_DONE, or RUN_FAILED if the workbook could not be written or the library could not be loaded, RUN_MISSING if
+        the library has not been compiled, RUN_NO_IMAGES if there were no images and RUN_CANCELLED if the analysis was
+        stopped.
    """
     start = timeit.default_timer()
+    status = RUN_DONE
 
     file_name = os.path.join(pics_dir, os.path.split(pics_dir)[-1] + '.xlsx')
 
     Globs.end = False
 
     # Check to see if the book can be opened
+    import xlsxwriter
     try:
         workbook = xlsxwriter.Workbook(file_name)
         workbook.close()
     except:
-        window.printout('There was an error. Please close any open Excel documents and try again.')
+        if window:
+            window.printout('There was an error. Please close any open Excel documents and try again.')
+        else:
+            print('There was an error. Please close any open Excel documents and try again.')
+        status = RUN_FAILED
         Globs.end = True
     if not Globs.end:
         if window:
             window.printout('Starting Identification')
         else:
             print('Starting Identification')
-        typeArray = []
-
-        for item in os.listdir(l_dir):
-            if os.path.isdir(os.path.join(l_dir, item)):
-                typeArray.append(item)
-
-        types, confidences, locations = ProcessFiles(l_dir=l_dir,
-                                                     pics_dir=pics_dir,
-                                                     typeArray=typeArray,
-                                                     window=window,
-                                                     userVer=userver,
-                                                     bits=bits,
-                                                     color=color,
-                                                     method=method,
-                                                     minSize=cellSize,
-                                                     pcThresh=pcThresh,
-                                                     confThresh=confThresh,
-                                                     bf=bf,
-                                                     near=near)
-
-        if not Globs.end:
-            if 'Other' not in typeArray:
-                typeArray.append('Other')
-            else:
-                othInd = typeArray.index('Other')
-                inds = list(range(len(typeArray)))
-                inds.pop(othInd)
-                inds.append(othInd)
-                typeArray = np.array(typeArray)[inds].tolist()
-            typeArray.append('Edge')
-            cellCount = CellStats(types, typeArray)
-
-            if window and (not Globs.end):
-                window.printout('Recognition Complete')
-                window.printout('Outputting to Excel')
-            elif (not window) and (not Globs.end):
-                print('Recognition Complete')
-                print('Outputting to Excel')
-            if len(cellCount) > 0 and not Globs.end:
-                WriteResults(cellCount,
-                             typeArray,
-                             locations,
-                             pics_dir,
-                             l_dir,
-                             types,
-                             confidences,
-                             pcThresh,
-                             confThresh,
-                             userver,
-                             bits,
-                             color,
-                             method,
-                             cellSize,
-                             near,
-                             bf)
+        if instrument:
+            Instrument.reset()
+            Instrument.enable()
+        try:
+            typeArray = []
+
+            for item in os.listdir(l_dir):
+                if os.path.isdir(os.path.join(l_dir, item)):
+                    typeArray.append(item)
+
+            if stream:
+                analysed = streamResults(l_dir, pics_dir, typeArray, window, userver, bits, color, method, cellSize,
+                                         pcThresh, confThresh, bf, near, workers, prefetch, cache, detections,
+                                         database, probes, tileMemory)
+                if not analysed:
+                    status = _haltedStatus(l_dir, pics_dir) if Globs.end else RUN_NO_IMAGES
             else:
-                window.printout('There were no images in the Input Folder.')
+                types, confidences, locations, areas, names = ProcessFiles(l_dir=l_dir,
+                                                                           pics_dir=pics_dir,
+                                                                           typeArray=typeArray,
+                                                                           window=window,
+                                                                           userVer=userver,
+                                                                           bits=bits,
+                                                                           color=color,
+                                                                           method=method,
+                                                                           minSize=cellSize,
+                                                                           pcThresh=pcThresh,
+                                                                           confThresh=confThresh,
+                                                                           bf=bf,
+                                                                           near=near,
+                                                                           workers=workers,
+                                                                           prefetch=prefetch,
+                                                                           cache=cache,
+                                                                           detections=detections,
+                                                                           probes=probes,
+                                                                           tileMemory=tileMemory,
+                                                                           withAreas=True,
+                                                                           withNames=True)
+
+                if types == 0:
+                    # The analysis could not be started
+                    status = _haltedStatus(l_dir, pics_dir)
+                elif not Globs.end:
+                    typeArray = resultTypes(typeArray)
+                    cellCount = CellStats(types, typeArray)
+
+                    if window and (not Globs.end):
+                        window.printout('Recognition Complete')
+                        window.printout('Outputting to Excel')
+                    elif (not window) and (not Globs.end):
+                        print('Recognition Complete')
+                        print('Outputting to Excel')
+                    if len(cellCount) > 0 and not Globs.end:
+                        WriteResults(cellCount,
+                                     typeArray,
+                                     locations,
+                                     pics_dir,
+                                     l_dir,
+                                     types,
+                                     confidences,
+                                     pcThresh,
+                                     confThresh,
+                                     userver,
+                                     bits,
+                                     color,
+                                     method,
+                                     cellSize,
+                                     near,
+                                     bf,
+                                     areas,
+                                     names)
+                        if database is not None:
+                            recordResults(database, pics_dir, l_dir, names, types, confidences, locations, areas,
+                                          pcThresh=pcThresh, confThresh=confThresh, userver=userver, bits=bits,
+                                          color=color, method=method, cellSize=cellSize, near=near, bf=bf)
+                    else:
+                        status = RUN_NO_IMAGES
+                        window.printout('There were no images in the Input Folder.')
+        finally:
+            if instrument:
+                Instrument.disable()
+
+        if instrument:
+            report_file = os.path.join(pics_dir, os.path.split(pics_dir)[-1] + '_timing.json')
+            Instrument.writeReport(report_file,
+                                   seconds=timeit.default_timer() - start,
+                                   completed=not Globs.end,
+                                   settings={'userver': userver, 'bits': bits, 'color': color, 'method': method,
+                                             'cellSize': cellSize, 'pcThresh': pcThresh, 'confThresh': confThresh,
+                                             'bf': bf, 'near': near, 'workers': workers, 'stream': stream,
+                                             'prefetch': prefetch, 'probes': probes, 'tileMemory': tileMemory})
 
         if window and (not Globs.end):
             window.printout('Done.')
@@ -151,6 +244,9 @@ def driver(l_dir,  # type: str
             print('Identification Cancelled')
 
 
+    if status == RUN_DONE and Globs.end:
+        status = RUN_CANCELLED
+
     # This needs to be here. If it's not, the program uses unbounded memory.
     stop = timeit.default_timer()
     if not Globs.end:
@@ -160,5 +256,121 @@ def driver(l_dir,  # type: str
         time = "Analysis stopped after %.0lf seconds." % (stop - start)
 
     print(time)
+    return status
+
+
+def _haltedStatus(l_dir,  # type: str
+                  pics_dir  # type: str
+                  ):
+    # type: (...) -> str
+    """
+    Finds why an analysis could not be started, for the status of driver.
+    """
+    if not libraryExists(l_dir):
+        return RUN_MISSING
+    if not imageNames(pics_dir):
+        return RUN_NO_IMAGES
+    return RUN_FAILED
 
 
+
+
+
+def resultTypes(typeArray  # type: List[str]
+                ):
+    # type: (List[str]) -> List[str]
+    """
+    Orders the library categories for the results, with 'Other' and then 'Edge' last.
+    """
+    if 'Other' not in typeArray:
+        typeArray = typeArray + ['Other']
+    else:
+        othInd = typeArray.index('Other')
+        inds = list(range(len(typeArray)))
+        inds.pop(othInd)
+        inds.append(othInd)
+        typeArray = np.array(typeArray)[inds].tolist()
+    return typeArray + ['Edge']
+
+
+def streamResults(l_dir,  # type: str
+                  pics_dir,  # type: str
+                  typeArray,  # type: List[str]
+                  window,  # type: Optional(MainWindow)
+                  userver,  # type: bool
+                  bits,  # type: int
+                  color,  # type: str
+                  method,  # type: str
+                  cellSize,  # type: int
+                  pcThresh,  # type: float
+                  confThresh,  # type: float
+                  bf,  # type: bool
+                  near,  # type: int
+                  workers,  # type: int
+                  prefetch,  # type: int
+                  cache=None,  # type: Optional(DiskCache)
+                  detections=None,  # type: Optional(DiskCache)
+                  database=None,  # type: Optional(ResultsDatabase)
+                  probes=None,  # type: Optional(int)
+                  tileMemory=None  # type: Optional(int)
+                  ):
+    # type: (...) -> bool
+    """
+    Analyses a folder and passes the results of each image straight to the output files.
+
+    The parameters are as described in driver. Whether any image was analysed is returned.
+    """
+    records = iterProcessFiles(l_dir=l_dir,
+                               pics_dir=pics_dir,
+                               typeArray=typeArray,
+                               window=window,
+                               userVer=userver,
+                               bits=bits,
+                               color=color,
+                               method=method,
+                               minSize=cellSize,
+                               pcThresh=pcThresh,
+                               confThresh=confThresh,
+                               bf=bf,
+                               near=near,
+                               workers=workers,
+                               prefetch=prefetch,
+                               cache=cache,
+                               detections=detections,
+                               probes=probes,
+                               tileMemory=tileMemory)
+
+    # Only replace the output files once there is an image to write
+    first = next(records, None)
+    if first is None:
+        if window and not Globs.end:
+            window.printout('There were no images in the Input Folder.')
+        return False
+
+    outTypes = resultTypes(typeArray)
+    sinks = [PickleSink(pics_dir, outTypes),
+             CsvSink(pics_dir),
+             CellTableSink(pics_dir, outTypes, library=os.path.abspath(l_dir), pcThresh=pcThresh,
+                           confThresh=confThresh, userver=userver, bits=bits, color=color, method=method,
+                           cellSize=cellSize, near=near, bf=bf),
+             WorkbookSink(pics_dir, l_dir, outTypes, pcThresh=pcThresh, confThresh=confThresh, userver=userver,
+                          bits=bits, color=color, method=method, cellSize=cellSize, near=near, bf=bf)]
+    if database is not None:
+        sinks.append(DatabaseSink(database, pics_dir, l_dir, pcThresh=pcThresh, confThresh=confThresh,
+                                  userver=userver, bits=bits, color=color, method=method, cellSize=cellSize,
+                                  near=near, bf=bf))
+    try:
+        for record in itertools.chain([first], records):
+            for sink in sinks:
+                sink.add(*record)
+        if window and (not Globs.end):
+            window.printout('Recognition Complete')
+            window.printout('Outputting to Excel')
+        elif (not window) and (not Globs.end):
+            print('Recognition Complete')
+            print('Outputting to Excel')
+    finally:
+        # Keep whatever was analysed, even if the analysis stopped part way
+        for sink in sinks:
+            sink.close()
+    return True
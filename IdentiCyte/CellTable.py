@@ -0,0 +1,246 @@
+"""
+   File Name: CellTable.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Writes and reads the per-cell results as a compact binary table of typed columns
+"""
+import json
+import os
+import struct
+import numpy as np
+import IdentiCyte.Instrument as Instrument
+
+TABLE_NAME = 'IdentifiedCells.ict'
+
+# The first bytes of a cell table and of each block of rows in it
+TABLE_MAGIC = b'ICYTCELL'
+BLOCK_MAGIC = b'ICYTBLCK'
+TABLE_VERSION = 1
+
+# The columns of the table, in the order they are stored in each block. Every value is little-endian.
+TABLE_COLUMNS = [('image', '<u4'),
+                 ('cell', '<u4'),
+                 ('label', '<u2'),
+                 ('confidence', '<f4'),
+                 ('row', '<i4'),
+                 ('column', '<i4'),
+                 ('area', '<i4')]
+
+# The length of a block header: its magic, the number of rows and the length of its JSON description
+_BLOCK_HEADER = struct.Struct('<8sII')
+_TABLE_HEADER = struct.Struct('<8sII')
+
+
+class CellTableSink(object):
+    """
+    Writes one row per cell to IdentifiedCells.ict, a block of rows at a time.
+
+    The file starts with a short JSON description of the analysis, which holds the settings of the run, and is followed
+    by one block per image. A block holds the name of the image and any cell types not seen before, then each column of
+    the block's rows as a packed array. The file is flushed after every image, so the results of the images analysed so
+    far can be read if the analysis does not finish.
+
+    A table is normally replaced by each analysis of its folder. With append, the blocks of this analysis are added
+    after those already in the table instead. The images are numbered on from the last image in the table, and the
+    settings of the analysis are kept with its first block.
+
+    Attributes
+    ----------
+    table_file : str
+        The path to the table
+    labels : list
+        The cell types, in the order of their codes in the label column
+    """
+    def __init__(self,
+                 pics_dir,  # type: str
+                 typeArray,  # type: List[str]
+                 append=False,  # type: Optional(bool)
+                 **settings
+                 ):
+        # type: (...) -> None
+        self.table_file = os.path.abspath(os.path.join(pics_dir, TABLE_NAME))
+        self.labels = list(typeArray)
+        self._firstImage = 0
+        self._settings = None
+        # The cell types written in the next block
+        self._pendingLabels = []
+        if append and os.path.isfile(self.table_file) and os.path.getsize(self.table_file):
+            existing, end = _readTable(self.table_file)
+            if existing['version'] != TABLE_VERSION or existing['columns'] != [list(c) for c in TABLE_COLUMNS]:
+                raise ValueError('%s was written by another version of IdentiCyte and cannot be appended to.'
+                                 % self.table_file)
+            # Keep the codes of the cell types already in the table
+            self._pendingLabels = [label for label in self.labels if label not in existing['types']]
+            self.labels = existing['types'] + self._pendingLabels
+            self._firstImage = len(existing['images'])
+            self._settings = settings
+            self._file = open(self.table_file, 'ab')
+            # Drop a block cut short by an analysis that did not finish
+            self._file.truncate(end)
+        else:
+            self._file = open(self.table_file, 'wb')
+            header = json.dumps({'columns': TABLE_COLUMNS, 'labels': self.labels, 'settings': settings},
+                                sort_keys=True).encode('utf-8')
+            self._file.write(_TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, len(header)) + header)
+            self._file.flush()
+        self._codes = dict((label, code) for code, label in enumerate(self.labels))
+
+    def add(self,
+            j,  # type: int
+            name,  # type: str
+            cellTypes,  # type: List[str]
+            cellConf,  # type: ndarray
+            imInfo,  # type: List[List[int]]
+            areas=None  # type: Optional(List[int])
+            ):
+        # type: (...) -> None
+        """
+        Appends the cells of one image. The area column is -1 where the areas of the cells are not given.
+        """
+        with Instrument.stage('table'):
+            if type(cellTypes) is np.ndarray:
+                cellTypes = cellTypes.tolist()
+            added = [label for label in dict.fromkeys(cellTypes) if label not in self._codes]
+            for label in added:
+                self._codes[label] = len(self.labels)
+                self.labels.append(label)
+            added = self._pendingLabels + added
+            self._pendingLabels = []
+
+            count = len(cellTypes)
+            location = np.reshape(np.asarray(imInfo, dtype=np.int64), [count, 2])
+            image = self._firstImage + j
+            columns = {'image': np.full(count, image),
+                       'cell': np.arange(count),
+                       'label': [self._codes[label] for label in cellTypes],
+                       'confidence': np.ravel(cellConf)[0:count],
+                       'row': location[:, 0],
+                       'column': location[:, 1],
+                       'area': np.full(count, -1) if areas is None else areas}
+
+            block = {'image': image, 'name': name, 'labels': added}
+            if self._settings is not None:
+                block['settings'] = self._settings
+                self._settings = None
+            block = json.dumps(block, sort_keys=True).encode('utf-8')
+            self._file.write(_BLOCK_HEADER.pack(BLOCK_MAGIC, count, len(block)) + block)
+            for column, dtype in TABLE_COLUMNS:
+                self._file.write(np.asarray(columns[column]).astype(dtype).tobytes())
+            self._file.flush()
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the table.
+        """
+        self._file.close()
+
+
+def writeCellTable(pics_dir,  # type: str
+                   typeArray,  # type: List[str]
+                   names,  # type: List[str]
+                   results,  # type: List[List[str]]
+                   conf,  # type: List[ndarray]
+                   locations,  # type: List[List[List[int]]]
+                   areas=None,  # type: Optional(List[List[int]])
+                   **settings
+                   ):
+    # type: (...) -> str
+    """
+    Writes the table for a whole folder at once, for the results of ProcessFiles. The areas of the cells in each image
+    are written if given.
+
+    Returns
+    -------
+    table_file : str
+        The path to the table
+    """
+    sink = CellTableSink(pics_dir, typeArray, **settings)
+    try:
+        for j in range(len(results)):
+            sink.add(j, names[j], results[j], conf[j], locations[j], areas[j] if areas is not None else None)
+    finally:
+        sink.close()
+    return sink.table_file
+
+
+def readCellTable(table_file  # type: str
+                  ):
+    # type: (str) -> dict
+    """
+    Reads a table written by CellTableSink.
+
+    A block cut short, as when the analysis was stopped while it was being written, is ignored along with anything
+    after it.
+
+    Parameters
+    ----------
+    table_file : str
+        The path to the table, or the folder of images it was written to
+
+    Returns
+    -------
+    table : dict
+        An array for each column, with one entry per cell, along with the cell 'types' the label codes stand for, the
+        'images' as a list of names indexed by the image column and the 'settings' of the analysis. If analyses were
+        appended to the table, 'runs' has the 'settings' of each analysis and the 'firstImage' it wrote.
+    """
+    if os.path.isdir(table_file):
+        table_file = os.path.join(table_file, TABLE_NAME)
+    table, _ = _readTable(table_file)
+    if table['version'] > TABLE_VERSION:
+        raise ValueError('%s was written by a newer version of IdentiCyte.' % table_file)
+    del table['version'], table['columns']
+    return table
+
+
+def _readTable(table_file  # type: str
+               ):
+    # type: (str) -> (dict, int)
+    """
+    Reads a table as readCellTable does, also giving its 'version' and 'columns' and where its last whole block ends.
+    """
+    with open(table_file, 'rb') as f:
+        data = f.read()
+
+    magic, version, length = _TABLE_HEADER.unpack_from(data, 0)
+    if magic != TABLE_MAGIC:
+        raise ValueError('%s is not a cell table.' % table_file)
+    offset = _TABLE_HEADER.size + length
+    header = json.loads(data[_TABLE_HEADER.size:offset].decode('utf-8'))
+    columns = [(column, np.dtype(dtype)) for column, dtype in header['columns']]
+    rowSize = sum(dtype.itemsize for _, dtype in columns)
+
+    labels = header['labels']
+    images = []
+    runs = [{'settings': header['settings'], 'firstImage': 0}]
+    pieces = dict((column, []) for column, _ in columns)
+    while offset + _BLOCK_HEADER.size <= len(data):
+        magic, count, length = _BLOCK_HEADER.unpack_from(data, offset)
+        start = offset + _BLOCK_HEADER.size + length
+        if magic != BLOCK_MAGIC or start + count*rowSize > len(data):
+            break
+        block = json.loads(data[offset + _BLOCK_HEADER.size:start].decode('utf-8'))
+        labels.extend(block['labels'])
+        if 'settings' in block:
+            runs.append({'settings': block['settings'], 'firstImage': block['image']})
+        while len(images) <= block['image']:
+            images.append(None)
+        images[block['image']] = block['name']
+        for column, dtype in columns:
+            pieces[column].append(np.frombuffer(data, dtype=dtype, count=count, offset=start))
+            start += count*dtype.itemsize
+        offset = start
+
+    table = dict((column, np.concatenate(pieces[column]) if pieces[column] else np.zeros(0, dtype=dtype))
+                 for column, dtype in columns)
+    table['types'] = labels
+    table['images'] = images
+    table['settings'] = header['settings']
+    table['runs'] = runs
+    table['version'] = version
+    table['columns'] = [[column, dtype] for column, dtype in header['columns']]
+    return table, offset
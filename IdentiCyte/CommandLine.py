@@ -0,0 +1,425 @@
+"""
+   File Name: CommandLine.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Runs the analysis from the command line without the GUI
+"""
+import argparse
+import json
+import os
+import sys
+import traceback
+import IdentiCyte.Globs as Globs
+
+# Exit codes
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_MISSING = 3
+EXIT_NO_IMAGES = 4
+EXIT_CANCELLED = 5
+
+# The settings of each command and their defaults, which match those of driver, batch, ExCells and compileLibrary
+RECOGNITION_SETTINGS = {'bits': 3, 'color': 'B', 'method': 'Triangle', 'cellSize': 9000, 'pcThresh': 90,
+                        'confThresh': 50, 'bf': True, 'near': 10, 'workers': 1, 'stream': False, 'prefetch': 2,
+                        'instrument': False, 'cache': None, 'cacheSize': 1024, 'detections': None,
+                        'database': None, 'probes': None, 'tileMemory': None}
+BATCH_SETTINGS = {'bits': 3, 'color': 'B', 'method': 'Triangle', 'cellSize': 9000, 'pcThresh': 90, 'confThresh': 50,
+                  'bf': True, 'near': 10, 'workers': 1, 'cache': None, 'cacheSize': 1024, 'detections': None,
+                  'database': None, 'probes': None, 'tileMemory': None}
+EXTRACT_SETTINGS = {'bits': 3, 'color': 'B', 'method': 'Otsu', 'cellSize': 9000, 'bf': True, 'radius': 155,
+                    'prefetch': 2}
+COMPILE_SETTINGS = {'pcThresh': 90, 'incremental': False, 'maxVariance': None, 'precision': None, 'index': 'tree',
+                    'probes': 8, 'measureMemory': False}
+CONDENSE_SETTINGS = {'output': None, 'pcThresh': 90, 'near': 10, 'sample': 2000}
+
+
+class ConsoleWindow(object):
+    """
+    Stands in for the MainWindow, printing the progress messages of the analysis to the console.
+
+    Attributes
+    ----------
+    quiet : bool
+        Discard the messages instead of printing them
+    """
+    def __init__(self,
+                 quiet=False  # type: Optional(bool)
+                 ):
+        # type: (Optional(bool)) -> None
+        self.quiet = quiet
+
+    def printout(self,
+                 string  # type: str
+                 ):
+        # type: (str) -> None
+        """
+        Prints a progress message.
+        """
+        if not self.quiet:
+            print(string)
+            sys.stdout.flush()
+
+
+def buildParser():
+    # type: () -> argparse.ArgumentParser
+    """
+    Defines the commands and flags. Flags that are not given are left as None so the config file can fill them in.
+    """
+    parser = argparse.ArgumentParser(prog='python -m IdentiCyte',
+                                     description='Counts and classifies cells without the GUI. Run without arguments '
+                                                 'to start the GUI.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def common(sub):
+        sub.add_argument('--config', help='a JSON file of settings. Flags given on the command line take precedence.')
+        sub.add_argument('--quiet', action='store_true', default=None, help='only report errors')
+        sub.add_argument('--library', help='the library folder')
+
+    def detection(sub):
+        sub.add_argument('--bits', type=int, help='bit depth of the cells, between 1 and 8')
+        sub.add_argument('--color', choices=['R', 'G', 'B'], help='colour channel inspected in colour images')
+        sub.add_argument('--method', choices=['Otsu', 'Triangle'], help='thresholding method')
+        sub.add_argument('--cell-size', dest='cellSize', type=int, help='minimum cell size in pixels')
+        illumination = sub.add_mutually_exclusive_group()
+        illumination.add_argument('--bright-field', dest='bf', action='store_const', const=True,
+                                  help='the images are bright field (default)')
+        illumination.add_argument('--fluorescent', dest='bf', action='store_const', const=False,
+                                  help='the images are fluorescent')
+
+    def recognition(sub):
+        sub.add_argument('--images', help='the folder of images to analyse')
+        detection(sub)
+        sub.add_argument('--pc-thresh', dest='pcThresh', type=float,
+                         help='percentage of the variance used to compare cells')
+        sub.add_argument('--conf-thresh', dest='confThresh', type=float,
+                         help='confidence needed to classify a cell')
+        sub.add_argument('--near', type=int, help='number of nearest library cells considered')
+        sub.add_argument('--probes', type=int,
+                         help='the number of clusters an approximate library index searches for each cell, instead '
+                              'of the number it was compiled with')
+        sub.add_argument('--tile-memory', dest='tileMemory', type=float,
+                         help='segment images that need more than this many MB a tile at a time')
+        sub.add_argument('--cache', help='a folder to keep results in, so unchanged images are not analysed again')
+        sub.add_argument('--cache-size', dest='cacheSize', type=float, help='the most space the cache takes, in MB')
+        sub.add_argument('--detection-cache', dest='detections',
+                         help='a folder to keep the cells found in each image in, so images are not segmented again '
+                              'when only the recognition settings change')
+        sub.add_argument('--database',
+                         help='an SQLite database the results are also added to, to query them across runs and folders')
+
+    extract = commands.add_parser('extract', help='cut the cells out of images to build a library')
+    common(extract)
+    extract.add_argument('--images', help='the folder of images to extract cells from')
+    detection(extract)
+    extract.add_argument('--radius', type=int, help='half the side length of the extracted cells')
+    extract.add_argument('--prefetch', type=int, help='number of images read ahead')
+
+    compile_ = commands.add_parser('compile', help='compile the library')
+    common(compile_)
+    compile_.add_argument('--pc-thresh', dest='pcThresh', type=float,
+                          help='percentage of the variance the library index is built for')
+    compile_.add_argument('--incremental', action='store_const', const=True,
+                          help='only read the library images that changed since the last incremental compile')
+    compile_.add_argument('--max-variance', dest='maxVariance', type=float,
+                          help='keep only the components explaining this percentage of the variance')
+    compile_.add_argument('--precision', choices=['float64', 'float32'],
+                          help='store the library, and identify cells against it, in double or single precision')
+    compile_.add_argument('--index', choices=['tree', 'clusters'],
+                          help='an exact index, or an approximate one for very large libraries')
+    compile_.add_argument('--probes', type=int,
+                          help='the number of clusters the approximate index searches for each cell')
+    compile_.add_argument('--measure-memory', dest='measureMemory', action='store_const', const=True,
+                          help='report the most memory allocated while compiling, which slows compilation')
+
+    recognize = commands.add_parser('recognize', help='identify the cells in a folder of images')
+    common(recognize)
+    recognition(recognize)
+    recognize.add_argument('--workers', type=int, help='number of processes analysing images')
+    recognize.add_argument('--stream', action='store_const', const=True,
+                           help='write the results of each image as soon as it is analysed')
+    recognize.add_argument('--prefetch', type=int, help='number of images read ahead')
+    recognize.add_argument('--instrument', action='store_const', const=True,
+                           help='write the time spent in each stage next to the workbook')
+
+    batch = commands.add_parser('batch', help='identify the cells in a folder and its sub folders')
+    common(batch)
+    recognition(batch)
+    batch.add_argument('--workers', type=int, help='number of folders analysed at once')
+
+    condense = commands.add_parser('condense', help='copy the library, leaving out cells not needed to classify the '
+                                                    'others')
+    common(condense)
+    condense.add_argument('--output', help='the folder of the condensed library')
+    condense.add_argument('--pc-thresh', dest='pcThresh', type=float,
+                          help='percentage of the variance used to compare cells')
+    condense.add_argument('--near', type=int, help='number of nearest library cells used to measure the accuracy')
+    condense.add_argument('--sample', type=int, help='the most library cells used to measure the accuracy')
+    return parser
+
+
+def loadSettings(args,  # type: argparse.Namespace
+                 defaults  # type: dict
+                 ):
+    # type: (...) -> dict
+    """
+    Combines the defaults, the config file and the flags, in increasing order of precedence.
+
+    Parameters
+    ----------
+    args : Namespace
+        The parsed command line
+    defaults : dict
+        The settings of the command and their default values
+
+    Returns
+    -------
+    settings : dict
+        The value of each setting, plus 'library', 'images' and 'quiet'.
+    """
+    settings = dict(defaults, library=None, images=None, quiet=False)
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError('The config file must hold a JSON object.')
+        unknown = [key for key in config if key not in settings]
+        if unknown:
+            raise ValueError('Unknown settings in the config file: ' + ', '.join(sorted(unknown)))
+        settings.update(config)
+    for key in settings:
+        value = getattr(args, key, None)
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def main(argv=None  # type: Optional(List[str])
+         ):
+    # type: (...) -> int
+    """
+    Runs a command given on the command line.
+
+    Parameters
+    ----------
+    argv : list
+        The command line arguments, not including the program name. sys.argv is used if None.
+
+    Returns
+    -------
+    code : int
+        0 on success, 1 if the command failed, 2 if the command line or config file is invalid, 3 if a folder or
+        library is missing, 4 if there were no images and 5 if the analysis was stopped.
+    """
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    defaults = {'extract': EXTRACT_SETTINGS, 'compile': COMPILE_SETTINGS, 'recognize': RECOGNITION_SETTINGS,
+                'batch': BATCH_SETTINGS, 'condense': CONDENSE_SETTINGS}[args.command]
+    try:
+        settings = loadSettings(args, defaults)
+    except (OSError, ValueError) as error:
+        print('Invalid config file: %s' % error, file=sys.stderr)
+        return EXIT_USAGE
+    required = {'compile': ['library'], 'condense': ['library', 'output']}.get(args.command, ['library', 'images'])
+    for key in required:
+        if not settings[key]:
+            print('The --%s folder is required.' % key, file=sys.stderr)
+            return EXIT_USAGE
+
+    window = ConsoleWindow(settings.pop('quiet'))
+    Globs.end = False
+    Globs.batchEnd = False
+    try:
+        return {'extract': runExtract, 'compile': runCompile, 'recognize': runRecognize,
+                'batch': runBatch, 'condense': runCondense}[args.command](window, settings)
+    except KeyboardInterrupt:
+        Globs.end = True
+        print('Stopped.', file=sys.stderr)
+        return EXIT_CANCELLED
+    except Exception:
+        traceback.print_exc()
+        return EXIT_FAILED
+
+
+def runExtract(window,  # type: ConsoleWindow
+               settings  # type: dict
+               ):
+    # type: (...) -> int
+    """
+    Extracts the cells from a folder of images into the library folder.
+    """
+    from IdentiCyte.ExtractCells import ExCells
+    from IdentiCyte.ProcessFiles import imageNames
+
+    if not os.path.isdir(settings['images']):
+        print('The image folder does not exist: ' + settings['images'], file=sys.stderr)
+        return EXIT_MISSING
+    if not imageNames(settings['images']):
+        print('There are no images in ' + settings['images'], file=sys.stderr)
+        return EXIT_NO_IMAGES
+    ExCells(settings['images'], settings['library'], window, bits=settings['bits'], color=settings['color'],
+            method=settings['method'], minSize=settings['cellSize'], bf=settings['bf'], radius=settings['radius'],
+            prefetch=settings['prefetch'])
+    return EXIT_CANCELLED if Globs.end else EXIT_OK
+
+
+def runCompile(window,  # type: ConsoleWindow
+               settings  # type: dict
+               ):
+    # type: (...) -> int
+    """
+    Compiles the library folder.
+    """
+    from IdentiCyte.ConstructLibrary import compileLibrary
+
+    if not os.path.isdir(settings['library']):
+        print('The library folder does not exist: ' + settings['library'], file=sys.stderr)
+        return EXIT_MISSING
+    report = compileLibrary(settings['library'], window, pcThresh=settings['pcThresh'],
+                            incremental=settings['incremental'], maxVariance=settings['maxVariance'],
+                            precision=settings['precision'], index=settings['index'], probes=settings['probes'],
+                            measureMemory=settings['measureMemory'])
+    if report is None:
+        return EXIT_NO_IMAGES
+    return EXIT_OK
+
+
+def runRecognize(window,  # type: ConsoleWindow
+                 settings  # type: dict
+                 ):
+    # type: (...) -> int
+    """
+    Identifies the cells in one folder of images.
+    """
+    from IdentiCyte.CellRecognitionDriver import driver
+    from IdentiCyte.ProcessFiles import imageNames
+
+    code = _checkFolders(settings)
+    if code != EXIT_OK:
+        return code
+    if not imageNames(settings['images']):
+        print('There are no images in ' + settings['images'], file=sys.stderr)
+        return EXIT_NO_IMAGES
+    l_dir = settings.pop('library')
+    pics_dir = settings.pop('images')
+    settings['cache'] = _openCache(settings.pop('cache'), settings['cacheSize'])
+    settings['detections'] = _openCache(settings.pop('detections'), settings.pop('cacheSize'))
+    settings['database'] = _openDatabase(settings.pop('database'))
+    settings['tileMemory'] = _bytes(settings['tileMemory'])
+    return _exitCode(driver(l_dir, pics_dir, window, userver=False, **settings))
+
+
+def runBatch(window,  # type: ConsoleWindow
+             settings  # type: dict
+             ):
+    # type: (...) -> int
+    """
+    Identifies the cells in a folder and each of its sub folders.
+    """
+    from IdentiCyte.FolderBatch import batch
+
+    code = _checkFolders(settings)
+    if code != EXIT_OK:
+        return code
+    l_dir = settings.pop('library')
+    pics_dir = settings.pop('images')
+    settings['cache'] = _openCache(settings.pop('cache'), settings['cacheSize'])
+    settings['detections'] = _openCache(settings.pop('detections'), settings.pop('cacheSize'))
+    settings['database'] = _openDatabase(settings.pop('database'))
+    settings['tileMemory'] = _bytes(settings['tileMemory'])
+    return _exitCode(batch(l_dir, pics_dir, window, userver=False, **settings))
+
+
+def runCondense(window,  # type: ConsoleWindow
+                settings  # type: dict
+                ):
+    # type: (...) -> int
+    """
+    Copies the library into a smaller library of prototypes.
+    """
+    from IdentiCyte.CondenseLibrary import condenseLibrary
+    from IdentiCyte.LibraryStore import libraryExists
+
+    if not libraryExists(settings['library']):
+        print('The library has not been compiled: ' + settings['library'], file=sys.stderr)
+        return EXIT_MISSING
+    if os.path.isdir(settings['output']) and os.listdir(settings['output']):
+        print('The output folder is not empty: ' + settings['output'], file=sys.stderr)
+        return EXIT_USAGE
+    report = condenseLibrary(settings['library'], settings['output'], window, pcThresh=settings['pcThresh'],
+                             near=settings['near'], sample=settings['sample'])
+    if report is None:
+        return EXIT_NO_IMAGES
+    return EXIT_OK
+
+
+def _exitCode(status  # type: str
+              ):
+    # type: (str) -> int
+    """
+    Gives the exit code for the status of driver or batch.
+    """
+    from IdentiCyte.CellRecognitionDriver import RUN_DONE, RUN_FAILED, RUN_MISSING, RUN_NO_IMAGES, RUN_CANCELLED
+
+    return {RUN_DONE: EXIT_OK, RUN_FAILED: EXIT_FAILED, RUN_MISSING: EXIT_MISSING, RUN_NO_IMAGES: EXIT_NO_IMAGES,
+            RUN_CANCELLED: EXIT_CANCELLED}[status]
+
+
+def _checkFolders(settings  # type: dict
+                  ):
+    # type: (dict) -> int
+    """
+    Checks that the image and library folders exist and the library has been compiled.
+    """
+    from IdentiCyte.LibraryStore import libraryExists
+
+    if not os.path.isdir(settings['images']):
+        print('The image folder does not exist: ' + settings['images'], file=sys.stderr)
+        return EXIT_MISSING
+    if not os.path.isdir(settings['library']):
+        print('The library folder does not exist: ' + settings['library'], file=sys.stderr)
+        return EXIT_MISSING
+    if not libraryExists(settings['library']):
+        print('The library has not been compiled: ' + settings['library'], file=sys.stderr)
+        return EXIT_MISSING
+    return EXIT_OK
+
+
+def _openCache(directory,  # type: Optional(str)
+               megabytes  # type: float
+               ):
+    # type: (...) -> Optional(DiskCache)
+    """
+    Opens a cache in a folder, or gives None if no folder was given.
+    """
+    if not directory:
+        return None
+    from IdentiCyte.ResultCache import DiskCache
+    return DiskCache(directory, int(megabytes*2**20))
+
+
+def _bytes(megabytes  # type: Optional(float)
+           ):
+    # type: (...) -> Optional(int)
+    """
+    Converts a size given in MB on the command line to bytes, keeping None.
+    """
+    if megabytes is None:
+        return None
+    return int(megabytes*2**20)
+
+
+def _openDatabase(path  # type: Optional(str)
+                  ):
+    # type: (...) -> Optional(ResultsDatabase)
+    """
+    Opens a results database, or gives None if no path was given.
+    """
+    if not path:
+        return None
+    from IdentiCyte.ResultsDatabase import ResultsDatabase
+    return ResultsDatabase(path)
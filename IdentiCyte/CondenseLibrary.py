@@ -0,0 +1,246 @@
+"""
+   File Name: CondenseLibrary.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Removes library cells that are not needed to classify the rest of the library
+"""
+import os
+import shutil
+import timeit
+import numpy as np
+from IdentiCyte.ConstructLibrary import libraryImages, readImage
+from IdentiCyte.LibraryIndex import buildIndex
+from IdentiCyte.LibraryStore import loadLibrary, saveLibrary
+from IdentiCyte.PCARecognition import componentCount, nearestNeighbours, scoreNeighbours
+
+
+def condenseLibrary(l_dir,  # type: str
+                    out_dir,  # type: str
+                    window=None,  # type: Optional(MainWindow)
+                    pcThresh=90,  # type: Optional(float)
+                    near=10,  # type: Optional(int)
+                    sample=2000,  # type: Optional(int)
+                    seed=0  # type: Optional(int)
+                    ):
+    # type: (...) -> Optional(dict)
+    """
+    Makes a smaller copy of a compiled library, keeping only the library cells needed to classify the others.
+
+    Each library image is projected onto the compiled library and the prototypes are chosen with condensed nearest
+    neighbours: starting from one cell of each category, any cell whose nearest prototype is of another category
+    becomes a prototype, until every cell is classified correctly. Near-duplicates of a prototype are dropped. The
+    kept images are copied to out_dir and saved as a compiled library with the same principal components, so cells
+    are compared in the same way as before.
+
+    Parameters
+    ----------
+    l_dir : str
+        The compiled library folder. It is not changed.
+    out_dir : str
+        The folder of the condensed library. It must not hold a library already.
+    window : MainWindow
+        Shows progress if given
+    pcThresh : float
+        The proportion of principal components the cells are compared with, as in PCARecognition
+    near : int
+        The number of nearest library cells used to measure the accuracy, as in PCARecognition
+    sample : int
+        The most library cells classified to measure the accuracy
+    seed : int
+        Sets the order the cells are visited in and picks the sample
+
+    Returns
+    -------
+    report : dict
+        The number of 'exemplars' before and 'kept' after, the images 'removed', the number of cells of each of the
+        'categories' before and after, the leave-one-out accuracy of the 'sample' of library cells against the whole
+        library ('fullAccuracy') and the condensed one ('condensedAccuracy'), and the time taken to find their nearest
+        neighbours in each ('fullSeconds' and 'condensedSeconds'). None if the library has no images.
+    """
+    categories, images = libraryImages(l_dir)
+    if not images:
+        if window:
+            window.printout('There were no images in the library.')
+        return None
+    if os.path.exists(out_dir) and os.listdir(out_dir):
+        raise ValueError('The folder for the condensed library is not empty: %s' % out_dir)
+
+    library = loadLibrary(l_dir)
+    eigenV = np.asarray(library['eigenV'])
+    pcNum = componentCount(library['latent'], pcThresh, library.get('totalVar'))
+
+    # Project every library image, as compileLibrary does, so each row is known to belong to its image
+    if window:
+        window.printout('Projecting %d library images' % len(images))
+    rows = np.zeros([len(images), np.shape(eigenV)[0]], dtype=eigenV.dtype)
+    for k, image in enumerate(images):
+        row = np.ravel(readImage(os.path.join(l_dir, image)))
+        if np.size(row) != len(rows[k]):
+            raise ValueError('%s does not match the compiled library. Compile the library first.' % image)
+        rows[k] = row/np.max(row)
+    score = np.matmul(rows - library['meanV'], eigenV)
+    features = np.ascontiguousarray(score[:, 0:pcNum])
+    colTypes = [os.path.dirname(image) for image in images]
+    typeNames, codes = np.unique(np.asarray(colTypes, dtype=str), return_inverse=True)
+    codes = codes.ravel()
+
+    if window:
+        window.printout('Choosing prototypes')
+    kept = condensePrototypes(features, codes, seed)
+    prototypes = np.flatnonzero(kept)
+
+    # Compare the accuracy and search time of the whole and condensed libraries on the same cells
+    rng = np.random.RandomState(seed)
+    tested = np.sort(rng.permutation(len(images))[0:sample])
+    fullAccuracy, fullSeconds = leaveOneOut(features, codes, tested, np.arange(len(images)), near, len(typeNames))
+    condensedAccuracy, condensedSeconds = leaveOneOut(features, codes, tested, prototypes, near, len(typeNames))
+
+    # Save the kept images and their scores as a library with the same components
+    for category in categories:
+        os.makedirs(os.path.join(out_dir, category), exist_ok=True)
+    for k in prototypes:
+        shutil.copy2(os.path.join(l_dir, images[k]), os.path.join(out_dir, images[k]))
+    dicti = {'latent': library['latent'], 'SCORE': score[prototypes], 'eigenV': eigenV,
+             'colTypes': [colTypes[k] for k in prototypes], 'meanV': library['meanV']}
+    if 'totalVar' in library:
+        dicti['totalVar'] = library['totalVar']
+    condensed = saveLibrary(out_dir, dicti)
+    buildIndex(out_dir, condensed, pcThresh)
+
+    report = {'exemplars': len(images),
+              'kept': len(prototypes),
+              'removed': [images[k] for k in np.flatnonzero(~kept)],
+              'categories': dict((category, [colTypes.count(category), int(np.sum(kept[codes == code]))])
+                                 for code, category in enumerate(typeNames.tolist())),
+              'sample': len(tested),
+              'fullAccuracy': fullAccuracy,
+              'condensedAccuracy': condensedAccuracy,
+              'fullSeconds': fullSeconds,
+              'condensedSeconds': condensedSeconds}
+    if window:
+        window.printout(formatReport(report))
+    return report
+
+
+def condensePrototypes(features,  # type: ndarray
+                       codes,  # type: ndarray
+                       seed=0,  # type: Optional(int)
+                       block=256  # type: Optional(int)
+                       ):
+    # type: (...) -> ndarray
+    """
+    Chooses prototypes with condensed nearest neighbours.
+
+    The cells are visited in a random order, a block at a time. Every cell of the block whose nearest prototype is of
+    another category becomes a prototype, and the passes repeat until none are added.
+
+    Parameters
+    ----------
+    features : ndarray
+        The scores of the library cells, one row per cell
+    codes : ndarray
+        The category code of each cell
+    seed : int
+        Sets the order the cells are visited in
+    block : int
+        The number of cells compared with the prototypes at once
+
+    Returns
+    -------
+    kept : ndarray
+        Whether each cell is a prototype
+    """
+    order = np.random.RandomState(seed).permutation(len(features))
+    kept = np.zeros(len(features), dtype=bool)
+    _, first = np.unique(codes[order], return_index=True)
+    kept[order[first]] = True
+
+    added = True
+    while added:
+        added = False
+        for start in range(0, len(order), block):
+            cells = order[start:start + block]
+            cells = cells[~kept[cells]]
+            if len(cells) == 0:
+                continue
+            prototypes = np.flatnonzero(kept)
+            _, idx = nearestNeighbours(features[cells], features[prototypes], 1)
+            wrong = codes[prototypes[idx[:, 0]]] != codes[cells]
+            if np.any(wrong):
+                kept[cells[wrong]] = True
+                added = True
+    return kept
+
+
+def leaveOneOut(features,  # type: ndarray
+                codes,  # type: ndarray
+                tested,  # type: ndarray
+                gallery,  # type: ndarray
+                near,  # type: int
+                typeNum  # type: int
+                ):
+    # type: (...) -> (float, float)
+    """
+    Classifies library cells against part of the library, leaving each cell out of its own comparison.
+
+    Parameters
+    ----------
+    features : ndarray
+        The scores of every library cell
+    codes : ndarray
+        The category code of every library cell
+    tested : ndarray
+        The library cells classified
+    gallery : ndarray
+        The sorted library cells they are compared with
+    near : int
+        The number of nearest library cells considered
+    typeNum : int
+        The number of category codes
+
+    Returns
+    -------
+    accuracy : float
+        The fraction of the tested cells given their own category
+    seconds : float
+        The time taken to find the nearest library cells
+    """
+    near = min(near, len(gallery) - 1)
+    if near < 1 or len(tested) == 0:
+        return 0., 0.
+    start = timeit.default_timer()
+    dist, idx = nearestNeighbours(features[tested], features[gallery], near + 1)
+    seconds = timeit.default_timer() - start
+
+    # Drop each cell from its own neighbours, or the furthest neighbour if it is not in the gallery
+    position = np.searchsorted(gallery, tested)
+    inside = (position < len(gallery)) & (gallery[np.minimum(position, len(gallery) - 1)] == tested)
+    own = np.where(inside, position, -1)
+    keep = np.argsort(idx == own[:, None], axis=1, kind='stable')[:, 0:near]
+    dist = np.take_along_axis(dist, keep, axis=1)
+    idx = np.take_along_axis(idx, keep, axis=1)
+
+    # Identical library cells would otherwise get an infinite vote
+    dist = np.maximum(dist, np.finfo(np.float64).eps)
+    labels, _ = scoreNeighbours(dist, codes[gallery[idx]], typeNum)
+    return float(np.mean(labels == codes[tested])), seconds
+
+
+def formatReport(report  # type: dict
+                 ):
+    # type: (dict) -> str
+    """
+    Lays out a condensing report as text.
+    """
+    lines = ['Kept %d of %d library cells.' % (report['kept'], report['exemplars'])]
+    for category in sorted(report['categories']):
+        before, after = report['categories'][category]
+        lines.append('  %-20s %6d -> %6d' % (category, before, after))
+    lines.append('Leave-one-out accuracy on %d library cells: %.2f%% with the whole library, %.2f%% condensed.'
+                 % (report['sample'], 100*report['fullAccuracy'], 100*report['condensedAccuracy']))
+    lines.append('Nearest neighbour search: %.4f s with the whole library, %.4f s condensed.'
+                 % (report['fullSeconds'], report['condensedSeconds']))
+    return '\n'.join(lines)
@@ -2,39 +2,260 @@
    File Name: ConstructLibrary.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
-   Description: Compiles all the images in the library into a single pickle file for use in the analysis.
+   Description: Compiles all the images in the library into a single library file for use in the analysis.
 """
-from sklearn import decomposition as skde
 import numpy as np
 import os
-import matplotlib; matplotlib.use("TkAgg")
-import matplotlib.pyplot as plt
-import pickle
+import timeit
+import tracemalloc
+from PIL import Image
+from IdentiCyte.LibraryStore import saveLibrary
+from IdentiCyte.LibraryIndex import buildIndex, compareIndex
+from IdentiCyte.FeatureCache import FeatureCache
 
 
 def compileLibrary(l_dir,  # type: str
-                   window=None  # type: Optional(MainWindow)
+                   window=None,  # type: Optional(MainWindow)
+                   pcThresh=90,  # type: Optional(float)
+                   incremental=False,  # type: Optional(bool)
+                   maxVariance=None,  # type: Optional(float)
+                   precision=None,  # type: Optional(str)
+                   index='tree',  # type: Optional(str)
+                   probes=8,  # type: Optional(int)
+                   measureMemory=False  # type: Optional(bool)
                    ):
-    # type: (str, Optional(MainWindow)) -> None
+    # type: (...) -> Optional(dict)
     """
-    Compiles the images in the library folder into a LibraryInfo.pkl with relevant information.
+    Compiles the images in the library folder into a LibraryInfo.json with relevant information.
 
     The cell images are compiled in a matrix which has Principal Component Analysis applied to it. The results of this
     are saved so that these calculations do not need to be run at each execution.
 
+    When compiling incrementally, the pixels of every image and the fitted decomposition are kept in a FeatureCache.
+    Only new or changed images are read. If images were only added, the decomposition is updated with the new images
+    alone, otherwise it is fitted again from the cached pixels.
+
+    Setting maxVariance keeps only the leading components that explain that percentage of the variance. Outside of
+    incremental compilation the images are then held in single precision and a randomized solver finds just those
+    components, which is much faster and smaller for large libraries. Recognition with a pcThresh up to maxVariance
+    is unaffected apart from rounding.
+
+    A library compiled in 'float32' precision is stored in single precision, and recognition against it is then
+    carried out in single precision as well. This halves the memory read for every cell. See Validation for how much
+    the results change.
+
     Parameters
     ----------
     l_dir : str
         The path to the library folder with images if cells categorized in folders.
     window : MainWindow
         The main GUI window
+    pcThresh : float
+        The proportion of principal components the nearest neighbour index is built for. Recognition with a different
+        pcThresh still works but compares every library cell.
+    incremental : bool
+        Reuse the images and decomposition from the last incremental compilation.
+    maxVariance : float
+        The percentage of the variance kept in the library, between 0 and 100. All components are kept if None.
+    precision : str
+        'float64' or 'float32'. If None, libraries compiled with maxVariance are single precision and others double.
+    index : str
+        'tree' for an exact nearest neighbour index, or 'clusters' for an approximate one that is much faster for
+        libraries of hundreds of thousands of cells. See LibraryIndex.ClusterIndex.
+    probes : int
+        The number of clusters an approximate index searches for each cell. More clusters miss fewer neighbours.
+    measureMemory : bool
+        Trace the memory allocated while compiling, for the 'peakMemory' of the report. Tracing slows compilation, so
+        it is off by default.
+
+    Returns
+    -------
+    report : dict
+        The relative paths of the images that were 'added', 'changed' and 'removed' since the last incremental
+        compilation, the number 'unchanged' and whether the decomposition was fitted from scratch ('refit'). Also the
+        number of 'components' kept, the 'precision' of the library, the compile time in 'seconds' and the
+        'peakMemory' in bytes allocated while compiling, or None if it was not measured. An approximate index adds its
+        comparison with an exact search on held out library cells ('index', see LibraryIndex.compareIndex). None if there were no images.
+    LibraryInfo.json: library manifest
+        A file describing the .npy files which hold the results from the PCA as well as the types of the cells in the
+        library. See LibraryStore.
+    LibraryIndex.pkl: pickle file
+        A file containing a nearest neighbour index over the library.
+    """
+    categories, images = libraryImages(l_dir)
+    colTypes = [os.path.dirname(image) for image in images]
+
+    if len(images) == 0:
+        if window:
+            window.printout('There were no images to compile in the library.')
+        return None
+
+    for category in categories:
+        if window:
+            window.printout(category)
+
+    start = timeit.default_timer()
+    tracing = measureMemory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    elif measureMemory and hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    try:
+        report = _compile(l_dir, images, colTypes, window, pcThresh, incremental, maxVariance, precision, index,
+                          probes)
+        report['peakMemory'] = tracemalloc.get_traced_memory()[1] if measureMemory else None
+    finally:
+        if tracing:
+            tracemalloc.stop()
+    report['seconds'] = timeit.default_timer() - start
+
+    if window and incremental:
+        window.printout('%d images added, %d changed, %d removed and %d unchanged.' %
+                        (len(report['added']), len(report['changed']), len(report['removed']), report['unchanged']))
+    if window:
+        message = 'Kept %d components. Compiled in %.1f s' % (report['components'], report['seconds'])
+        if report['peakMemory'] is not None:
+            message += ' using at most %.1f MB' % (report['peakMemory']/2**20)
+        window.printout(message + '.')
+    return report
+
+
+def _compile(l_dir,  # type: str
+             images,  # type: List[str]
+             colTypes,  # type: List[str]
+             window,  # type: Optional(MainWindow)
+             pcThresh,  # type: float
+             incremental,  # type: bool
+             maxVariance,  # type: Optional(float)
+             precision,  # type: Optional(str)
+             index,  # type: str
+             probes  # type: int
+             ):
+    # type: (...) -> dict
+    """
+    Reads, decomposes, saves and indexes the library, the work of compileLibrary. The parameters are as described
+    there, along with the library images and their categories from libraryImages.
+    """
+    # scikit-learn takes longer to import than the rest of the analysis, so it is only loaded to compile a library
+    from sklearn import decomposition as skde
+
+    truncated = maxVariance is not None and not incremental
+    if precision is None:
+        precision = 'float32' if truncated else 'float64'
+    if precision not in ('float32', 'float64'):
+        raise ValueError('Unsupported precision: %s' % precision)
+    dtype = np.dtype(precision)
+
+    # Read in every image, each as a 'row'
+    if incremental:
+        cache = FeatureCache.load(l_dir)
+        libraryData, report = cache.update(images, readImage)
+    else:
+        libraryData = np.zeros([len(images), np.size(readImage(os.path.join(l_dir, images[0])))],
+                               dtype=dtype)
+        for img in range(len(images)):
+            imline = np.ravel(readImage(os.path.join(l_dir, images[img])))
+            libraryData[img, :] = imline/np.max(imline)
+        report = {'added': images, 'changed': [], 'removed': [], 'unchanged': 0}
+
+    if window:
+        window.printout('Library Loaded')
+        window.printout('Compiling Library. This may take several minutes and the program may become unresponsive.')
+
+    # Perform PCA and save everything to file
+    if incremental and cache.pca is not None and not (report['changed'] or report['removed']):
+        # Only fold the new images into the decomposition
+        added = set(report['added'])
+        newRows = [k for k in range(len(images)) if images[k] in added]
+        pca = cache.pca
+        if newRows:
+            extendDecomposition(pca, normalize(libraryData[newRows]))
+        report['refit'] = False
+    else:
+        pca = skde.PCA()
+        if incremental:
+            data = normalize(libraryData)
+            pca = seedDecomposition(pca.fit(data), data)
+        elif truncated:
+            pca, SCORE = truncatedDecomposition(libraryData, maxVariance)
+        else:
+            SCORE = pca.fit_transform(libraryData)
+        report['refit'] = True
+
+    if incremental:
+        # Project the library in blocks so the whole library is never held as floats
+        SCORE = np.zeros([len(images), len(pca.components_)])
+        meanV = np.zeros(np.shape(libraryData)[1])
+        for start in range(0, len(images), 256):
+            block = normalize(libraryData[start:start + 256])
+            SCORE[start:start + 256] = pca.transform(block)
+            meanV += np.sum(block, axis=0)
+        meanV /= len(images)
+        cache.pca = pca
+        cache.save()
+    else:
+        meanV = np.mean(libraryData, axis=0)
+    COEFF = np.transpose(pca.components_)
+    latent = pca.explained_variance_
+    dicti = {'latent': latent, 'SCORE': SCORE, 'eigenV': COEFF,
+             'colTypes': colTypes, 'meanV': meanV}
+
+    if maxVariance is not None:
+        # Keep the total so that pcThresh is still a proportion of all of the variance
+        totalVar = pca.totalVar_ if truncated else np.sum(latent)
+        keep = varianceCount(latent, totalVar, maxVariance)
+        dicti['latent'] = latent[0:keep]
+        dicti['SCORE'] = SCORE[:, 0:keep]
+        dicti['eigenV'] = COEFF[:, 0:keep]
+        dicti['totalVar'] = totalVar
+    for key in ('SCORE', 'eigenV', 'meanV'):
+        dicti[key] = np.asarray(dicti[key], dtype=dtype)
+    report['components'] = len(dicti['latent'])
+    report['precision'] = dtype.name
+
+    if window:
+        window.printout('Library Compiled')
+        window.printout('Saving Library to File')
+
+    library = saveLibrary(l_dir, dicti)
+
+    if window:
+        window.printout('Building Library Index')
+    if index == 'clusters':
+        buildIndex(l_dir, library, pcThresh, method=index, probes=probes)
+        report['index'] = compareIndex(library, pcThresh, probes=probes)
+        if window:
+            window.printout('The approximate index found %.1f%% of the nearest library cells and gave the same type to '
+                            '%.1f%% of %d held out cells, in %.3f s against %.3f s for an exact search.' %
+                            (100*report['index']['recall'], 100*report['index']['agreement'],
+                             report['index']['sample'], report['index']['indexSeconds'],
+                             report['index']['exactSeconds']))
+    else:
+        buildIndex(l_dir, library, pcThresh, method=index)
+
+    return report
+
+
+def libraryImages(l_dir  # type: str
+                  ):
+    # type: (str) -> (List[str], List[str])
+    """
+    Lists the categories of a library and the TIFF images in each one.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder with images if cells categorized in folders.
+
     Returns
     -------
-    Libraryinfo.plk: pickle file
-        A file containing a dictionary with the results from the PCA as well as the types of the cells in the library.
+    categories : list
+        The name of each category folder
+    images : list
+        The path of every image relative to the library folder, grouped by category
     """
     sub_dirs = os.listdir(l_dir)
 
@@ -43,82 +264,176 @@ def compileLibrary(l_dir,  # type: str
         if not os.path.isdir(os.path.abspath(os.path.join(l_dir, sub_dirs[entry]))):
             sub_dirs.pop(entry)
 
-    colTypes = []
-    libraryData = []
-
-    # Prepare the data to be saved
+    images = []
     for category in sub_dirs:
-        if window:
-            window.printout(category)
         curr_dir = os.path.abspath(os.path.join(l_dir, category))
 
-        imageList = os.listdir(curr_dir)
-
         # Discard all entries that are not TIFF images
-        for file in range(len(imageList)-1, -1, -1):
-            if not imageList[file].endswith('.tif'):
-                imageList.pop(file)
+        for file in os.listdir(curr_dir):
+            if file.endswith('.tif'):
+                images.append(os.path.join(category, file))
+    return sub_dirs, images
 
-        # If there are any images
-        if len(imageList) > 0:
-            # Look at the first image to get the size of every image. Images must be the same size
-            currImage = os.path.abspath(os.path.join(curr_dir, imageList[0]))
-            tst = plt.imread(currImage)
-            imsize = np.size(tst)
 
+def readImage(image_path  # type: str
+              ):
+    # type: (str) -> ndarray
+    """
+    Reads in a library image.
+    """
+    with Image.open(image_path) as image:
+        return np.asarray(image)
 
-            tmpTrainData = np.zeros([len(imageList), imsize])
-            tmpColTypes = ['---'] * len(imageList)
 
-            # Prepare the data in each image for PCA
-            for img in range(len(imageList)):
-                # Read in the current image
-                image_path = os.path.abspath(os.path.join(curr_dir, imageList[img]))
-                image = plt.imread(image_path)
+def normalize(rows  # type: ndarray
+              ):
+    # type: (ndarray) -> ndarray
+    """
+    Scales each row of pixels so that its brightest pixel is 1.
+    """
+    rows = np.asarray(rows, dtype=np.float64)
+    return rows/np.max(rows, axis=1)[:, None]
 
-                # Data needs to be in a 'row', make it so
-                imline = np.reshape(image, [1, np.size(image)])
 
-                # Save the type of cell as well
-                tmpColTypes[img] = str(category)
+def seedDecomposition(pca,  # type: PCA
+                      data  # type: ndarray
+                      ):
+    # type: (...) -> IncrementalPCA
+    """
+    Converts a fitted PCA into an IncrementalPCA that can be updated with new images.
 
-                # Add the row to the matrix
-                tmpTrainData[img, :] = imline/np.max(imline)
+    Parameters
+    ----------
+    pca : PCA
+        A PCA fitted to data
+    data : ndarray
+        The data the PCA was fitted to, one row per image
 
-            # Collect all of the temporary data for future use
-            colTypes.append(tmpColTypes[:])
-            if libraryData == []:
-                libraryData = tmpTrainData
-            else:
-                libraryData = np.concatenate((libraryData, tmpTrainData))
+    Returns
+    -------
+    ipca : IncrementalPCA
+        An IncrementalPCA in the state it would have after being fitted to data
+    """
+    from sklearn import decomposition as skde
 
-    # Collapse colTypes List
-    colTypes = [item for sublist in colTypes for item in sublist]
+    ipca = skde.IncrementalPCA()
+    ipca.components_ = pca.components_
+    ipca.singular_values_ = pca.singular_values_
+    ipca.explained_variance_ = pca.explained_variance_
+    ipca.mean_ = pca.mean_
+    ipca.var_ = np.var(data, axis=0)
+    ipca.n_samples_seen_ = len(data)
+    ipca.n_components_ = len(pca.components_)
+    ipca.n_features_in_ = np.shape(data)[1]
+    return ipca
 
-    if not libraryData == []:
-        if window:
-            window.printout('Library Loaded')
-            window.printout('Compiling Library. This may take several minutes and the program may become unresponsive.')
 
-        # Perform PCA and save everything to a .mat file
-        pca = skde.PCA()
-        pca.fit(libraryData)
-        SCORE = pca.fit_transform(libraryData)
-        COEFF = np.transpose(pca.components_)
-        latent = pca.explained_variance_
-        meanV = np.mean(libraryData, axis=0)
-        dicti = {'latent': latent, 'SCORE': SCORE, 'eigenV': COEFF,
-                'colTypes': colTypes, 'meanV': meanV}
-        name = 'LibraryInfo'
+def extendDecomposition(ipca,  # type: IncrementalPCA
+                        data  # type: ndarray
+                        ):
+    # type: (...) -> None
+    """
+    Adds new images to a decomposition.
 
-        if window:
-            window.printout('Library Compiled')
-            window.printout('Saving Library to File')
+    The decomposition is given room for one more component per new image. The extra components start at zero so
+    they do not change the existing basis, and the update is then exact rather than an approximation.
 
-        library_file = os.path.abspath(os.path.join(l_dir, name + '.pkl'))
-        with open(library_file, 'wb') as f:
-            pickle.dump(dicti, f)
-    else:
-        if window:
-            window.printout('There were no images to compile in the library.')
+    Parameters
+    ----------
+    ipca : IncrementalPCA
+        The decomposition to update
+    data : ndarray
+        The normalized new images, one row per image
+    """
+    pixels = np.shape(data)[1]
+    components = min(int(ipca.n_samples_seen_) + len(data), pixels)
+    pad = components - len(ipca.components_)
+    if pad > 0:
+        ipca.components_ = np.concatenate((ipca.components_, np.zeros([pad, pixels])))
+        ipca.singular_values_ = np.concatenate((ipca.singular_values_, np.zeros(pad)))
+    ipca.n_components = components
+    ipca.partial_fit(data)
+
+
+def varianceCount(latent,  # type: ndarray
+                  totalVar,  # type: float
+                  maxVariance  # type: float
+                  ):
+    # type: (...) -> int
+    """
+    Counts the leading components needed to explain maxVariance percent of totalVar. All are counted if too few.
+    """
+    reached = np.flatnonzero(np.cumsum(latent) >= totalVar*(maxVariance/100))
+    if len(reached) == 0:
+        return len(latent)
+    return int(reached[0]) + 1
+
+
+def columnVariance(data,  # type: ndarray
+                   rows=256  # type: Optional(int)
+                   ):
+    # type: (...) -> ndarray
+    """
+    The sample variance of each column of data, accumulated in double precision a block of rows at a time so that no
+    double precision copy of the whole of data is made.
+    """
+    count = np.shape(data)[0]
+    total = np.zeros(np.shape(data)[1])
+    for start in range(0, count, rows):
+        total += np.sum(data[start:start + rows], axis=0, dtype=np.float64)
+    mean = total/count
+    # The squares are summed about the mean, which keeps the precision a sum of squares about zero would lose
+    squares = np.zeros(np.shape(data)[1])
+    for start in range(0, count, rows):
+        squares += np.sum(np.square(data[start:start + rows] - mean), axis=0)
+    return squares/(count - 1)
+
+
+def truncatedDecomposition(data,  # type: ndarray
+                           maxVariance,  # type: float
+                           components=32  # type: Optional(int)
+                           ):
+    # type: (...) -> (PCA, ndarray)
+    """
+    Finds only the leading principal components of the library with a randomized solver.
+
+    The number of components fitted starts small and is doubled until they explain maxVariance percent of the
+    variance, so a library with a few dominant components is decomposed in a single fit.
+
+    Parameters
+    ----------
+    data : ndarray
+        The normalized images, one row per image
+    maxVariance : float
+        The percentage of the variance the components should explain
+    components : int
+        The number of components in the first fit
+
+    Returns
+    -------
+    pca : PCA
+        The fitted decomposition, cut down to the components needed. Its totalVar_ is the variance of all of data.
+    SCORE : ndarray
+        The projection of data onto the kept components
+    """
+    from sklearn import decomposition as skde
+
+    totalVar = float(np.sum(columnVariance(data)))
+    most = min(np.shape(data))
+    components = min(components, most)
+    while True:
+        # The full solver is used when only a few components would be left out
+        pca = skde.PCA(n_components=components, svd_solver='randomized' if components < 0.8*most else 'full',
+                       random_state=0)
+        SCORE = pca.fit_transform(data)
+        if np.sum(pca.explained_variance_) >= totalVar*(maxVariance/100) or components == most:
+            break
+        components = min(2*components, most)
 
+    keep = varianceCount(pca.explained_variance_, totalVar, maxVariance)
+    pca.components_ = pca.components_[0:keep]
+    pca.explained_variance_ = pca.explained_variance_[0:keep]
+    pca.singular_values_ = pca.singular_values_[0:keep]
+    pca.n_components_ = keep
+    pca.totalVar_ = totalVar
+    return pca, SCORE[:, 0:keep]
@@ -2,7 +2,7 @@
    File Name: ExtractCells.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Extracts the cells to build a library
@@ -13,6 +13,7 @@ from IdentiCyte.ToGreyScale import greyalize
 import cv2
 from IdentiCyte.CellDetection import detect
 import IdentiCyte.Globs as Globs
+from IdentiCyte.Prefetch import ImagePrefetcher
 import re
 
 
@@ -25,7 +26,8 @@ def ExCells(im_dir,  # type: str
             method='Otsu',  # type: Opional(str)
             minSize=9000,  # type: Opional(int)
             bf=True,  # type: Opional(bool)
-            radius=155  # type: Opional(int)
+            radius=155,  # type: Opional(int)
+            prefetch=2  # type: Optional(int)
             ):
     # type: (...) -> None
     """
@@ -56,6 +58,8 @@ def ExCells(im_dir,  # type: str
     radius: int
         Defines the size of the section of image cut out for each cell. The section will be radius pixels out from the
         centroid as found in detect() in both the positive x and y directions in the image.
+    prefetch : int
+        The number of images read ahead on background threads while cells are extracted from an image.
 
     Returns
     -------
@@ -68,16 +72,14 @@ def ExCells(im_dir,  # type: str
     imageNum = 1
 
     # Iterate through only images
-    for file in os.listdir(im_dir):
-        exp = re.compile("\.png$|\.tif$|\.jpg$|\.jpeg$|\.tiff$", re.I)
-        an_image = bool(exp.search(file))
-        if an_image:
+    exp = re.compile("\.png$|\.tif$|\.jpg$|\.jpeg$|\.tiff$", re.I)
+    files = [file for file in os.listdir(im_dir) if exp.search(file)]
+    with ImagePrefetcher([os.path.join(im_dir, file) for file in files], depth=prefetch) as images:
+        for file, (_, image) in zip(files, images):
             if window:
                 window.printout(file)
 
             # Import the image and define its edges
-            im_path = os.path.join(im_dir, file)
-            image = cv2.imread(im_path)
             image = np.array(image)
             if len(np.shape(image)) == 3:
                 bounds = np.shape(image[:, :, 0])
@@ -106,9 +108,10 @@ def ExCells(im_dir,  # type: str
                 # Increment the counts so that each cell has a unique filename
                 cell += 1
             imageNum += 1
-        if Globs.end:
-            window.printout('Cell Extraction Cancelled')
-            break
+            if Globs.end:
+                window.printout('Cell Extraction Cancelled')
+                break
     if window:
+        window.printout(images.report())
         window.printout("Done")
 
@@ -0,0 +1,127 @@
+"""
+   File Name: FeatureCache.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Remembers the library images and the decomposition between compilations of the library
+"""
+import os
+import pickle
+import numpy as np
+
+CACHE_NAME = 'LibraryCache.pkl'
+ROWS_NAME = 'LibraryCache.npy'
+CACHE_VERSION = 1
+
+
+class FeatureCache(object):
+    """
+    The pixels of every library image from the last compilation, and the decomposition fitted to them.
+
+    Each image is keyed by its path relative to the library folder, its modification time and its size. Only images
+    that are new or have changed are read when the library is compiled again. The pixels are kept in the type of
+    the image files, so the cache is no bigger than the images.
+
+    Attributes
+    ----------
+    l_dir : str
+        The path to the library folder
+    entries : dict
+        The row, modification time and size of each cached image, keyed by its relative path
+    rows : ndarray
+        The flattened pixels of each cached image, one row per image
+    pca : IncrementalPCA
+        The decomposition fitted to the cached images, or None
+    """
+    def __init__(self,
+                 l_dir  # type: str
+                 ):
+        # type: (str) -> None
+        self.l_dir = l_dir
+        self.entries = {}
+        self.rows = None
+        self.pca = None
+
+    @classmethod
+    def load(cls,
+             l_dir  # type: str
+             ):
+        # type: (str) -> FeatureCache
+        """
+        Loads the cache of a library folder. An empty cache is returned if there is none or it cannot be read.
+        """
+        cache = cls(l_dir)
+        try:
+            with open(os.path.join(l_dir, CACHE_NAME), 'rb') as f:
+                saved = pickle.load(f)
+            if saved.get('version') != CACHE_VERSION:
+                return cache
+            rows = np.load(os.path.join(l_dir, ROWS_NAME), mmap_mode='r')
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return cache
+        if len(rows) != len(saved['entries']):
+            return cache
+        cache.entries = saved['entries']
+        cache.rows = rows
+        cache.pca = saved['pca']
+        return cache
+
+    def update(self,
+               images,  # type: List[str]
+               read  # type: Callable[[str], ndarray]
+               ):
+        # type: (...) -> (ndarray, dict)
+        """
+        Brings the cache up to date with the images in the library.
+
+        Parameters
+        ----------
+        images : list
+            The path of every library image relative to the library folder, in the order of the compiled library
+        read : function
+            Reads an image given its full path
+
+        Returns
+        -------
+        rows : ndarray
+            The flattened pixels of each image, in the order of images
+        report : dict
+            The relative paths of the images that were 'added', 'changed' and 'removed', and the number 'unchanged'.
+        """
+        report = {'added': [], 'changed': [], 'removed': [], 'unchanged': 0}
+        stamps = []
+        rows = None
+        for k, image in enumerate(images):
+            stat = os.stat(os.path.join(self.l_dir, image))
+            stamp = (stat.st_mtime, stat.st_size)
+            stamps.append(stamp)
+            cached = self.entries.get(image)
+            if cached is not None and (cached[1], cached[2]) == stamp:
+                row = self.rows[cached[0]]
+                report['unchanged'] += 1
+            else:
+                row = np.ravel(read(os.path.join(self.l_dir, image)))
+                report['changed' if cached is not None else 'added'].append(image)
+            if rows is None:
+                rows = np.zeros([len(images), np.size(row)], dtype=row.dtype)
+            rows[k] = row
+        present = set(images)
+        report['removed'] = [image for image in self.entries if image not in present]
+
+        self.entries = dict((image, (k, stamp[0], stamp[1])) for k, (image, stamp) in enumerate(zip(images, stamps)))
+        self.rows = rows
+        return rows, report
+
+    def save(self):
+        # type: () -> None
+        """
+        Writes the cache to the library folder.
+        """
+        rows_file = os.path.join(self.l_dir, ROWS_NAME)
+        with open(rows_file + '.tmp', 'wb') as f:
+            np.save(f, self.rows)
+        os.replace(rows_file + '.tmp', rows_file)
+        with open(os.path.join(self.l_dir, CACHE_NAME), 'wb') as f:
+            pickle.dump({'version': CACHE_VERSION, 'entries': self.entries, 'pca': self.pca}, f)
@@ -2,35 +2,51 @@
    File Name: CellRecognitionDriver.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2019-01-31
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Recursively performs analysis on folders and subfolders
 """
 import os
+from collections import deque
 import IdentiCyte.Globs as Globs
-from IdentiCyte.CellRecognitionDriver import driver
+from IdentiCyte.CellRecognitionDriver import driver, RUN_DONE, RUN_FAILED, RUN_MISSING, RUN_NO_IMAGES, RUN_CANCELLED
+from concurrent.futures import ProcessPoolExecutor
+
+# The deepest sub folder analysed, counting the folder the batch was started on as 0
+MAX_DEPTH = 6
+
+# Folders that are never analysed. Labelled holds the labelled copies of analysed images.
+SKIPPED_FOLDERS = ['Labelled']
 
 
 def batch(l_dir,  # type: str
-           pics_dirs,  # type: str
-           window=None,  # type: Opional(MainWindow)
-           userver=False,  # type: Opional(bool)
-           bits=3,  # type: Opional(int)
-           color='B',  # type: Opional(str)
-           method='Triangle',  # type: Opional(str)
-           cellSize=9000,  # type: Opional(int)
-           pcThresh=90,  # type: Opional(float)
-           confThresh=50,  # type: Opional(float)
-           bf=True,  # type: Opional(bool)
-           near=10,  # type: Opional(int)
-           depth=0  # type: Optional(int)
-           ):
-    # type: (...) -> None
+          pics_dirs,  # type: str
+          window=None,  # type: Opional(MainWindow)
+          userver=False,  # type: Opional(bool)
+          bits=3,  # type: Opional(int)
+          color='B',  # type: Opional(str)
+          method='Triangle',  # type: Opional(str)
+          cellSize=9000,  # type: Opional(int)
+          pcThresh=90,  # type: Opional(float)
+          confThresh=50,  # type: Opional(float)
+          bf=True,  # type: Opional(bool)
+          near=10,  # type: Opional(int)
+          workers=1,  # type: Optional(int)
+          maxDepth=MAX_DEPTH,  # type: Optional(int)
+          cache=None,  # type: Optional(DiskCache)
+          detections=None,  # type: Optional(DiskCache)
+          database=None,  # type: Optional(ResultsDatabase)
+          probes=None,  # type: Optional(int)
+          tileMemory=None  # type: Optional(int)
+          ):
+    # type: (...) -> str
     """
     Drives the analysis
 
-    This detects the cell categories in the library and runs both the analysis ant the output file writing.
+    This detects the cell categories in the library and runs both the analysis ant the output file writing, for the
+    folder and each of its sub folders. The folder tree is listed once before any analysis, and each folder is
+    analysed exactly once.
 
     Parameters
     ----------
@@ -61,52 +77,157 @@ def batch(l_dir,  # type: str
         Indicates whether the image is bright field(True) or fluorescent(False)
     near : int
         The number of nearest neighbours in the library that will be considered when classifying a cell
-    depth : int
-    The current recursion depth
+    workers : int
+        The number of folders analysed at once, each in its own process. Folders are analysed one at a time if this is
+        1 or the user verifies cells.
+    maxDepth : int
+        The deepest sub folder analysed
+    cache : DiskCache
+        A cache of results shared by every folder, so unchanged images are not analysed again
+    detections : DiskCache
+        A cache of the cells found in each image shared by every folder, so unchanged images are not segmented again
+    database : ResultsDatabase
+        A database every folder's results are added to, each folder as its own run
+    probes : int
+        The number of clusters an approximate library index searches for each cell, instead of the number it was
+        compiled with
+    tileMemory : int
+        The most memory in bytes that finding the cells in an image may use. Larger images are segmented a tile at a
+        time.
+
+    Returns
+    -------
+    status : str
+        The status of the batch, as for driver. It is RUN_MISSING or RUN_FAILED if any folder was, RUN_CANCELLED if the
+        batch was stopped and RUN_NO_IMAGES only if no folder had images. Folders without images are otherwise not a
+        problem.
    """
+    folders = batchFolders(pics_dirs, maxDepth)
+    settings = {'userver': userver, 'bits': bits, 'color': color, 'method': method, 'cellSize': cellSize,
+                'pcThresh': pcThresh, 'confThresh': confThresh, 'bf': bf, 'near': near, 'cache': cache,
+                'detections': detections, 'database': database, 'probes': probes, 'tileMemory': tileMemory}
+    if window:
+        window.printout('Found %d folders to analyse.' % len(folders))
+
+    statuses = []
+    if workers <= 1 or userver or len(folders) < 2:
+        for k, folder in enumerate(folders):
+            if Globs.batchEnd:
+                break
+            statuses.append(driver(l_dir, folder, window=window, **settings))
+            if window:
+                window.printout('Finished folder %d of %d: %s' % (k + 1, len(folders), folder))
+        return batchStatus(statuses, len(folders))
+
+    # Analyse several folders at once. The messages of each folder are shown when it is finished.
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = [pool.submit(_driveFolder, l_dir, folder, settings) for folder in folders]
+        for k, future in enumerate(pending):
+            if Globs.batchEnd:
+                future.cancel()
+                continue
+            messages, stopBatch, status = future.result()
+            statuses.append(status)
+            if window:
+                for message in messages:
+                    window.printout(message)
+                window.printout('Finished folder %d of %d: %s' % (k + 1, len(folders), folders[k]))
+            if stopBatch:
+                Globs.batchEnd = True
+    return batchStatus(statuses, len(folders))
+
+
+def batchStatus(statuses,  # type: List[str]
+                folders  # type: int
+                ):
+    # type: (...) -> str
+    """
+    Combines the statuses of the folders analysed by batch, out of the given number of folders, into its status.
+    """
+    for status in [RUN_MISSING, RUN_FAILED, RUN_CANCELLED]:
+        if status in statuses:
+            return status
+    if len(statuses) < folders:
+        return RUN_CANCELLED
+    if statuses and all(status == RUN_NO_IMAGES for status in statuses):
+        return RUN_NO_IMAGES
+    return RUN_DONE
 
-    max_depth = 5
-    driver(l_dir,  # type: str
-           pics_dirs,  # type: str
-           window=window,  # type: Opional(MainWindow)
-           userver=userver,  # type: Opional(bool)
-           bits=bits,  # type: Opional(int)
-           color=color,  # type: Opional(str)
-           method=method,  # type: Opional(str)
-           cellSize=cellSize,  # type: Opional(int)
-           pcThresh=pcThresh,  # type: Opional(float)
-           confThresh=confThresh,  # type: Opional(float)
-           bf=bf,  # type: Opional(bool)
-           near=near  # type: Opional(int)
-           )
-    for item in os.listdir(pics_dirs):
-        if os.path.isdir(os.path.join(pics_dirs, item)) and not item == 'Labelled' and not Globs.batchEnd:
-
-            if depth < max_depth:
-                batch(l_dir,  # type: str
-                      os.path.join(os.path.join(pics_dirs, item)),  # type: str
-                      window=window,  # type: Opional(MainWindow)
-                      userver=userver,  # type: Opional(bool)
-                      bits=bits,  # type: Opional(int)
-                      color=color,  # type: Opional(str)
-                      method=method,  # type: Opional(str)
-                      cellSize=cellSize,  # type: Opional(int)
-                      pcThresh=pcThresh,  # type: Opional(float)
-                      confThresh=confThresh,  # type: Opional(float)
-                      bf=bf,  # type: Opional(bool)
-                      near=near,  # type: Opional(int)
-                      depth=depth+1)  # type: Optional(int)
-
-            driver(l_dir,  # type: str
-                   os.path.join(os.path.join(pics_dirs, item)),  # type: str
-                   window=window,  # type: Opional(MainWindow)
-                   userver=userver,  # type: Opional(bool)
-                   bits=bits,  # type: Opional(int)
-                   color=color,  # type: Opional(str)
-                   method=method,  # type: Opional(str)
-                   cellSize=cellSize,  # type: Opional(int)
-                   pcThresh=pcThresh,  # type: Opional(float)
-                   confThresh=confThresh,  # type: Opional(float)
-                   bf=bf,  # type: Opional(bool)
-                   near=near  # type: Opional(int)
-                   )
+
+def batchFolders(pics_dir,  # type: str
+                 maxDepth=MAX_DEPTH  # type: Optional(int)
+                 ):
+    # type: (str, Optional(int)) -> List[str]
+    """
+    Lists a folder and every sub folder to be analysed, shallowest first.
+
+    Hidden folders and those in SKIPPED_FOLDERS are left out, along with anything below them. A folder reached
+    more than once through links is only listed once, at its shallowest path.
+
+    Parameters
+    ----------
+    pics_dir : str
+        The top folder
+    maxDepth : int
+        The deepest sub folder listed, counting pics_dir as 0
+
+    Returns
+    -------
+    folders : list
+        The path of each folder
+    """
+    folders = []
+    seen = set()
+    queue = deque([(pics_dir, 0)])
+    while queue:
+        folder, depth = queue.popleft()
+        real = os.path.realpath(folder)
+        if real in seen:
+            continue
+        seen.add(real)
+        folders.append(folder)
+        if depth >= maxDepth:
+            continue
+        for item in sorted(os.listdir(folder)):
+            child = os.path.join(folder, item)
+            if item not in SKIPPED_FOLDERS and not item.startswith('.') and os.path.isdir(child):
+                queue.append((child, depth + 1))
+    return folders
+
+
+class _MessageLog(object):
+    """
+    Keeps the progress messages of a folder analysed in a worker process, to be shown by the main window later.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def printout(self,
+                 string  # type: str
+                 ):
+        # type: (str) -> None
+        self.messages.append(string)
+
+
+def _driveFolder(l_dir,  # type: str
+                 folder,  # type: str
+                 settings  # type: dict
+                 ):
+    # type: (...) -> (List[str], bool, str)
+    """
+    Analyses one folder in a worker process.
+
+    Returns
+    -------
+    messages : list
+        The progress messages of the analysis
+    stopBatch : bool
+        Whether the analysis found a problem, such as an uncompiled library, that stops the whole batch
+    status : str
+        The status of the folder, from driver
+    """
+    Globs.end = False
+    Globs.batchEnd = False
+    log = _MessageLog()
+    status = driver(l_dir, folder, window=log, **settings)
+    return log.messages, Globs.batchEnd, status
@@ -0,0 +1,202 @@
+"""
+   File Name: Instrument.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Optionally records the time spent in each stage of the analysis
+"""
+import json
+import platform
+import threading
+import timeit
+from datetime import datetime
+
+# Nothing is recorded unless this is True. Set it with enable() and disable().
+enabled = False
+
+# The calls, seconds and counters of each stage, keyed by stage name
+_stats = {}
+_lock = threading.Lock()
+
+
+class _Stage(object):
+    """
+    Times one pass through a stage.
+    """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = timeit.default_timer() - self.start
+        with _lock:
+            entry = _entry(self.name)
+            entry['calls'] += 1
+            entry['seconds'] += elapsed
+        return False
+
+
+class _NullStage(object):
+    """
+    Stands in for a stage when nothing is being recorded.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name  # type: str
+          ):
+    # type: (str) -> ContextManager
+    """
+    Times the code in a with block as part of a stage.
+
+    When recording is disabled the same do-nothing context is returned every time, so the only cost is this call.
+
+    Parameters
+    ----------
+    name : str
+        The name of the stage, such as 'watershed'
+
+    Returns
+    -------
+    context : ContextManager
+        Adds a call and the time taken to the stage when the block exits.
+    """
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name,  # type: str
+          counter,  # type: str
+          value=1  # type: Optional(float)
+          ):
+    # type: (...) -> None
+    """
+    Adds to a counter of a stage, such as the number of cells found or bytes read. Does nothing when disabled.
+    """
+    if not enabled:
+        return
+    with _lock:
+        entry = _entry(name)
+        entry[counter] = entry.get(counter, 0) + value
+
+
+def enable():
+    # type: () -> None
+    """
+    Starts recording.
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    # type: () -> None
+    """
+    Stops recording. What has been recorded so far is kept.
+    """
+    global enabled
+    enabled = False
+
+
+def reset():
+    # type: () -> None
+    """
+    Forgets everything recorded so far.
+    """
+    with _lock:
+        _stats.clear()
+
+
+def snapshot():
+    # type: () -> dict
+    """
+    Copies what has been recorded so far, so it can be sent from a worker process to be merged.
+    """
+    with _lock:
+        return dict((name, dict(entry)) for name, entry in _stats.items())
+
+
+def merge(other  # type: dict
+          ):
+    # type: (dict) -> None
+    """
+    Adds the calls, seconds and counters from a snapshot to what has been recorded here.
+    """
+    with _lock:
+        for name, values in other.items():
+            entry = _entry(name)
+            for key, value in values.items():
+                entry[key] = entry.get(key, 0) + value
+
+
+def report(**extra):
+    # type: (...) -> dict
+    """
+    Summarises what has been recorded.
+
+    Parameters
+    ----------
+    extra
+        Anything else to include in the report, such as the settings of the analysis
+
+    Returns
+    -------
+    report : dict
+        The 'stages', each with its calls, total seconds, mean seconds per call and counters. 'cellsPerImage' is
+        included if images were analysed.
+    """
+    stages = snapshot()
+    for entry in stages.values():
+        entry['meanSeconds'] = entry['seconds']/entry['calls'] if entry['calls'] else 0.
+    result = {'created': datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'stages': stages}
+    image = stages.get('image')
+    if image and image['calls']:
+        result['cellsPerImage'] = image.get('cells', 0)/image['calls']
+    result.update(extra)
+    return result
+
+
+def writeReport(file_name,  # type: str
+                **extra
+                ):
+    # type: (...) -> dict
+    """
+    Writes the report to a JSON file and returns it.
+    """
+    result = report(**extra)
+    with open(file_name, 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+    return result
+
+
+def _entry(name  # type: str
+           ):
+    # type: (str) -> dict
+    """
+    Gets the record of a stage, adding it if needed. The lock must be held.
+    """
+    entry = _stats.get(name)
+    if entry is None:
+        entry = {'calls': 0, 'seconds': 0.}
+        _stats[name] = entry
+    return entry
@@ -0,0 +1,426 @@
+"""
+   File Name: LibraryIndex.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Builds, saves and queries a nearest neighbour index over the library
+"""
+import hashlib
+import itertools
+import os
+import pickle
+import timeit
+import numpy as np
+from IdentiCyte.PCARecognition import componentCount, neighbourPairs, nearestNeighbours, scoreNeighbours
+
+INDEX_NAME = 'LibraryIndex.pkl'
+INDEX_VERSION = 1
+
+
+class LibraryIndex(object):
+    """
+    A KD-tree over the leading principal component scores of the library.
+
+    The tree finds the nearest library cells without comparing a cell to the whole library. It only answers queries
+    that use the same number of principal components it was built with.
+
+    Attributes
+    ----------
+    pcNum : int
+        The number of principal components in the tree
+    trainNum : int
+        The number of library cells in the tree
+    checksum : str
+        A hash of the scores the tree was built from, used to tell if the library has changed
+    tree : cKDTree
+        The tree itself
+    """
+    def __init__(self,
+                 score,  # type: ndarray
+                 pcNum,  # type: int
+                 leafsize=16  # type: Optional(int)
+                 ):
+        # type: (...) -> None
+        # Only loaded to build a tree. Unpickling a saved index imports it as needed.
+        from scipy.spatial import cKDTree
+
+        gallery = np.ascontiguousarray(score[:, 0:pcNum])
+        self.pcNum = pcNum
+        self.trainNum = len(gallery)
+        self.checksum = galleryChecksum(gallery)
+        self.tree = cKDTree(gallery, leafsize=leafsize)
+
+    def usable(self,
+               pcNum,  # type: int
+               near  # type: int
+               ):
+        # type: (...) -> bool
+        """
+        Checks if the index can answer a query with this many components and neighbours.
+        """
+        return pcNum == self.pcNum and 0 < near <= self.trainNum
+
+    def neighbours(self,
+                   features,  # type: ndarray
+                   gallery,  # type: ndarray
+                   near  # type: int
+                   ):
+        # type: (...) -> (ndarray, ndarray)
+        """
+        Finds the closest library cells to each cell.
+
+        The tree gives the distance to the near-th closest library cell. Every library cell within that distance is
+        then compared exactly, so the result is the same as PCARecognition.nearestNeighbours.
+
+        Parameters
+        ----------
+        features : ndarray
+            The projection of each cell onto the principal components, one row per cell
+        gallery : ndarray
+            The scores of the library cells on the same components
+        near : int
+            The number of nearest neighbours to find
+
+        Returns
+        -------
+        dist : ndarray
+            The squared distances to the nearest library cells, closest first. One row per cell.
+        idx : ndarray
+            The library positions of the nearest library cells, in the same order as dist.
+        """
+        kth, _ = self.tree.query(features, k=near)
+        kth = np.reshape(kth, [len(features), near])[:, -1]
+
+        # Allow for rounding so that ties at the boundary are all compared
+        inside = self.tree.query_ball_point(features, kth*(1 + 1e-9) + 1e-300)
+        counts = np.fromiter((len(cells) for cells in inside), dtype=np.intp, count=len(features))
+        rows = np.repeat(np.arange(len(features)), counts)
+        cols = np.fromiter(itertools.chain.from_iterable(inside), dtype=np.intp, count=int(np.sum(counts)))
+        return neighbourPairs(features, gallery, rows, cols, near)
+
+
+class ClusterIndex(object):
+    """
+    Groups the library cells into clusters of nearby cells, for approximate searches of very large libraries.
+
+    The library cells are split into clusters with k-means over their leading principal component scores. A cell is
+    only compared exactly with the library cells in the probes clusters whose centres are closest to it, so the
+    nearest library cells can occasionally be missed when they sit just across the border of a cluster that was not
+    searched. Searching more clusters finds more of them, more slowly. A cell whose clusters hold fewer than near
+    library cells is compared with the whole library.
+
+    Attributes
+    ----------
+    pcNum : int
+        The number of principal components clustered
+    trainNum : int
+        The number of library cells in the index
+    checksum : str
+        A hash of the scores the index was built from, used to tell if the library has changed
+    probes : int
+        The number of clusters searched for each cell. This trades recall for speed and can be changed at any time.
+    centres : ndarray
+        The centre of each cluster
+    order : ndarray
+        The library cells sorted by cluster
+    starts : ndarray
+        Where each cluster starts in order, with the number of library cells at the end
+    """
+    def __init__(self,
+                 score,  # type: ndarray
+                 pcNum,  # type: int
+                 clusters=None,  # type: Optional(int)
+                 probes=8,  # type: Optional(int)
+                 iterations=10,  # type: Optional(int)
+                 trainSize=256,  # type: Optional(int)
+                 seed=0  # type: Optional(int)
+                 ):
+        # type: (...) -> None
+        gallery = np.ascontiguousarray(score[:, 0:pcNum])
+        self.pcNum = pcNum
+        self.trainNum = len(gallery)
+        self.checksum = galleryChecksum(gallery)
+        if clusters is None:
+            clusters = int(np.sqrt(self.trainNum))
+        clusters = int(np.clip(clusters, 1, self.trainNum))
+        self.probes = int(np.clip(probes, 1, clusters))
+
+        # Fit the centres to a sample of about trainSize cells per cluster, starting from random library cells
+        rng = np.random.RandomState(seed)
+        train = gallery[rng.permutation(self.trainNum)[0:min(self.trainNum, trainSize*clusters)]]
+        centres = train[rng.permutation(len(train))[0:clusters]].copy()
+        for _ in range(iterations):
+            labels = nearestCentres(train, centres, 1)[:, 0]
+            sums = np.zeros_like(centres)
+            np.add.at(sums, labels, train)
+            counts = np.bincount(labels, minlength=clusters)
+            # A cluster that lost every cell keeps its old centre
+            filled = counts > 0
+            centres[filled] = sums[filled]/counts[filled, None]
+        self.centres = centres
+
+        labels = nearestCentres(gallery, centres, 1)[:, 0]
+        self.order = np.argsort(labels, kind='stable').astype(np.int32 if self.trainNum < 2**31 else np.intp)
+        self.starts = np.searchsorted(labels[self.order], np.arange(clusters + 1))
+
+    def usable(self,
+               pcNum,  # type: int
+               near  # type: int
+               ):
+        # type: (...) -> bool
+        """
+        Checks if the index can answer a query with this many components and neighbours.
+        """
+        return pcNum == self.pcNum and 0 < near <= self.trainNum
+
+    def neighbours(self,
+                   features,  # type: ndarray
+                   gallery,  # type: ndarray
+                   near,  # type: int
+                   chunk=2**24  # type: Optional(int)
+                   ):
+        # type: (...) -> (ndarray, ndarray)
+        """
+        Finds library cells close to each cell, as LibraryIndex.neighbours does, comparing only the library cells in
+        the clusters closest to the cell.
+
+        Each cluster is compared with all the cells that search it at once. The distances are estimated with one matrix
+        product, as in PCARecognition.nearestNeighbours, and the library cells that could be among the nearest of a
+        cell are then compared exactly. chunk is the most distance estimates held in memory at once.
+
+        Returns
+        -------
+        dist : ndarray
+            The squared distances to the nearest library cells found, closest first. One row per cell.
+        idx : ndarray
+            The library positions of those library cells, in the same order as dist.
+        """
+        chosen = nearestCentres(features, self.centres, self.probes)
+        counts = np.sum(self.starts[chosen + 1] - self.starts[chosen], axis=1)
+        dist = np.zeros([len(features), near], dtype=np.result_type(features, gallery))
+        idx = np.zeros([len(features), near], dtype=np.intp)
+
+        few = np.flatnonzero(counts < near)
+        if len(few):
+            dist[few], idx[few] = nearestNeighbours(features[few], gallery, near)
+        cells = np.flatnonzero(counts >= near)
+        if len(cells) == 0:
+            return dist, idx
+
+        # The cells searching each cluster, as positions in cells
+        searching = np.repeat(np.arange(len(cells)), self.probes)
+        searched = chosen[cells].ravel()
+        byCluster = np.argsort(searched, kind='stable')
+        clusters, firsts = np.unique(searched[byCluster], return_index=True)
+        bounds = np.append(firsts, len(byCluster))
+        eps = np.finfo(dist.dtype).eps
+
+        rows = []
+        cols = []
+        for c, first, last in zip(clusters, bounds[:-1], bounds[1:]):
+            members = self.order[self.starts[c]:self.starts[c + 1]].astype(np.intp)
+            probing = searching[byCluster[first:last]]
+            if len(members) <= near:
+                # Every library cell of a small cluster is a candidate
+                rows.append(np.repeat(probing, len(members)))
+                cols.append(np.tile(members, len(probing)))
+                continue
+            m = gallery[members]
+            mSq = np.einsum('ij,ij->i', m, m)
+            step = max(1, chunk//len(members))
+            for start in range(0, len(probing), step):
+                f = features[cells[probing[start:start + step]]]
+                fSq = np.einsum('ij,ij->i', f, f)
+                approx = fSq[:, None] - 2*np.matmul(f, m.T) + mSq[None, :]
+                kth = np.partition(approx, near - 1, axis=1)[:, near - 1]
+                margin = 64*np.shape(m)[1]*eps*(fSq + np.max(mSq))
+                r, k = np.nonzero(approx <= (kth + 2*margin)[:, None])
+                rows.append(probing[start + r])
+                cols.append(members[k])
+        dist[cells], idx[cells] = neighbourPairs(features[cells], gallery, np.concatenate(rows), np.concatenate(cols),
+                                                 near)
+        return dist, idx
+
+
+def nearestCentres(features,  # type: ndarray
+                   centres,  # type: ndarray
+                   count,  # type: int
+                   chunk=2**24  # type: Optional(int)
+                   ):
+    # type: (...) -> ndarray
+    """
+    Finds the count closest centres to each row of features, closest first. The distances are estimated as in
+    PCARecognition.nearestNeighbours, without the exact check, as a centre that is almost as close will do.
+    """
+    cenSq = np.einsum('ij,ij->i', centres, centres)
+    closest = np.zeros([len(features), count], dtype=np.intp)
+    step = max(1, chunk//max(len(centres), 1))
+    for start in range(0, len(features), step):
+        f = features[start:start + step]
+        approx = cenSq[None, :] - 2*np.matmul(f, centres.T)
+        if count < len(centres):
+            part = np.argpartition(approx, count - 1, axis=1)[:, 0:count]
+        else:
+            part = np.tile(np.arange(len(centres)), [len(f), 1])
+        ranked = np.argsort(np.take_along_axis(approx, part, axis=1), axis=1, kind='stable')
+        closest[start:start + step] = np.take_along_axis(part, ranked, axis=1)
+    return closest
+
+
+def galleryChecksum(gallery  # type: ndarray
+                    ):
+    # type: (ndarray) -> str
+    """
+    Hashes the library scores an index is built from.
+    """
+    gallery = np.ascontiguousarray(gallery)
+    digest = hashlib.sha1(str(gallery.shape).encode())
+    digest.update(gallery.view(np.uint8).ravel())
+    return digest.hexdigest()
+
+
+def buildIndex(l_dir,  # type: str
+               resDict,  # type: dict
+               pcThresh=90,  # type: Optional(float)
+               method='tree',  # type: Optional(str)
+               **options
+               ):
+    # type: (...) -> Union(LibraryIndex, ClusterIndex)
+    """
+    Builds the index for a compiled library and saves it next to the library.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder
+    resDict : dict
+        A dictionary containing the information from the LibraryInfo.pkl
+    pcThresh : float
+        The proportion of principal components the index is built for, as used in PCARecognition.
+    method : str
+        'tree' for an exact LibraryIndex, or 'clusters' for an approximate ClusterIndex
+    options
+        The keyword arguments of the index, such as clusters and probes for a ClusterIndex
+
+    Returns
+    -------
+    index : LibraryIndex or ClusterIndex
+        The new index
+    """
+    pcNum = componentCount(resDict['latent'], pcThresh, resDict.get('totalVar'))
+    if method == 'tree':
+        index = LibraryIndex(resDict['SCORE'], pcNum, **options)
+    elif method == 'clusters':
+        index = ClusterIndex(resDict['SCORE'], pcNum, **options)
+    else:
+        raise ValueError('Unsupported index: %s' % method)
+    with open(os.path.join(l_dir, INDEX_NAME), 'wb') as f:
+        pickle.dump({'version': INDEX_VERSION, 'index': index}, f)
+    return index
+
+
+def compareIndex(resDict,  # type: dict
+                 pcThresh=90,  # type: Optional(float)
+                 near=10,  # type: Optional(int)
+                 sample=500,  # type: Optional(int)
+                 seed=0,  # type: Optional(int)
+                 **options
+                 ):
+    # type: (...) -> dict
+    """
+    Checks an approximate ClusterIndex against an exact search by holding out a sample of the library cells and
+    identifying them with the rest of the library.
+
+    Parameters
+    ----------
+    resDict : dict
+        The compiled library
+    pcThresh : float
+        The proportion of principal components used, as in PCARecognition
+    near : int
+        The number of nearest library cells considered
+    sample : int
+        The number of library cells held out
+    seed : int
+        Picks the sample
+    options
+        The keyword arguments of ClusterIndex, such as clusters and probes
+
+    Returns
+    -------
+    report : dict
+        The number of cells in the 'sample', the fraction whose type is the same with both searches ('agreement'),
+        the fraction of the exact nearest library cells found by the index ('recall'), the 'exactSeconds' and
+        'indexSeconds' taken to search and the number of 'clusters' and 'probes' of the index.
+    """
+    pcNum = componentCount(resDict['latent'], pcThresh, resDict.get('totalVar'))
+    score = np.ascontiguousarray(resDict['SCORE'][:, 0:pcNum])
+    typeNames, codes = np.unique(np.asarray(resDict['colTypes'], dtype=str), return_inverse=True)
+    codes = codes.ravel()
+
+    held = np.zeros(len(score), dtype=bool)
+    held[np.random.RandomState(seed).permutation(len(score))[0:max(0, min(sample, len(score) - near))]] = True
+    features, gallery, galleryCodes = score[held], score[~held], codes[~held]
+    index = ClusterIndex(gallery, pcNum, **options)
+
+    start = timeit.default_timer()
+    exactDist, exactIdx = nearestNeighbours(features, gallery, near)
+    exactSeconds = timeit.default_timer() - start
+    start = timeit.default_timer()
+    dist, idx = index.neighbours(features, gallery, near)
+    indexSeconds = timeit.default_timer() - start
+
+    exactLabels, _ = scoreNeighbours(exactDist, galleryCodes[exactIdx], len(typeNames))
+    labels, _ = scoreNeighbours(dist, galleryCodes[idx], len(typeNames))
+    found = sum(len(np.intersect1d(idx[k], exactIdx[k])) for k in range(len(features)))
+    cells = len(features)
+    return {'sample': cells,
+            'agreement': float(np.mean(labels == exactLabels)) if cells else 1.,
+            'recall': found/np.size(exactIdx) if cells else 1.,
+            'exactSeconds': exactSeconds,
+            'indexSeconds': indexSeconds,
+            'clusters': len(index.centres),
+            'probes': index.probes}
+
+
+def loadIndex(l_dir,  # type: str
+              resDict,  # type: dict
+              probes=None  # type: Optional(int)
+              ):
+    # type: (...) -> Optional(LibraryIndex)
+    """
+    Loads the index saved with a library.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder
+    resDict : dict
+        The library the index should belong to
+    probes : int
+        The number of clusters an approximate index searches for each cell, instead of the number it was compiled
+        with. Ignored by an exact index.
+
+    Returns
+    -------
+    index : LibraryIndex
+        The index, or None if there is no index or it was built from a different library.
+    """
+    try:
+        with open(os.path.join(l_dir, INDEX_NAME), 'rb') as f:
+            saved = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+    if not isinstance(saved, dict) or saved.get('version') != INDEX_VERSION:
+        return None
+    index = saved['index']
+    score = resDict['SCORE']
+    if len(score) != index.trainNum or np.shape(score)[1] < index.pcNum:
+        return None
+    if galleryChecksum(score[:, 0:index.pcNum]) != index.checksum:
+        return None
+    if probes is not None and isinstance(index, ClusterIndex):
+        index.probes = int(np.clip(probes, 1, len(index.centres)))
+    return index
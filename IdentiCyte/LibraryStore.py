@@ -0,0 +1,235 @@
+"""
+   File Name: LibraryStore.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Saves and loads the compiled library as memory-mapped arrays
+"""
+import hashlib
+import json
+import os
+import pickle
+import uuid
+from collections.abc import Mapping
+from datetime import datetime
+import numpy as np
+
+MANIFEST_NAME = 'LibraryInfo.json'
+PICKLE_NAME = 'LibraryInfo.pkl'
+FORMAT_VERSION = 1
+
+# The arrays that make up a compiled library
+ARRAY_NAMES = ['latent', 'SCORE', 'eigenV', 'meanV', 'colTypes']
+
+
+class LibraryInfo(Mapping):
+    """
+    A compiled library whose arrays are loaded from disk when first used.
+
+    This behaves like the dictionary in LibraryInfo.pkl. Each array is memory-mapped, so only the parts that are
+    used are read, and processes that open the same library share its pages. When pickled, only the path and the
+    manifest are stored.
+
+    The arrays of each compilation are saved under file names of their own, and all of them are mapped when the
+    library is opened. A library that is open therefore keeps reading the compilation it was opened with, even if the
+    folder is compiled again.
+
+    Attributes
+    ----------
+    l_dir : str
+        The path to the library folder
+    manifest : dict
+        The contents of LibraryInfo.json
+    """
+    def __init__(self,
+                 l_dir,  # type: str
+                 manifest=None  # type: Optional(dict)
+                 ):
+        # type: (...) -> None
+        self.l_dir = l_dir
+        if manifest is None:
+            with open(os.path.join(l_dir, MANIFEST_NAME), 'r') as f:
+                manifest = json.load(f)
+        if manifest.get('format') != FORMAT_VERSION:
+            raise ValueError('Unsupported library format: %s' % manifest.get('format'))
+        self.manifest = manifest
+        # Mapping an array only reads its header
+        self._arrays = dict((key, np.load(os.path.join(l_dir, name), mmap_mode='r'))
+                            for key, name in manifest['arrays'].items())
+
+    def __getitem__(self, key):
+        return self._arrays[key]
+
+    def __iter__(self):
+        return iter(self.manifest['arrays'])
+
+    def __len__(self):
+        return len(self.manifest['arrays'])
+
+    def __reduce__(self):
+        return LibraryInfo, (self.l_dir, self.manifest)
+
+    @property
+    def version(self):
+        # type: () -> str
+        """
+        A unique identifier of this compilation of the library.
+        """
+        return self.manifest['version']
+
+
+def saveLibrary(l_dir,  # type: str
+                dicti  # type: dict
+                ):
+    # type: (...) -> LibraryInfo
+    """
+    Saves a compiled library as a set of .npy files described by LibraryInfo.json.
+
+    eigenV and SCORE are stored in column major order, so the leading principal components used in recognition are
+    contiguous on disk. The file names of the arrays include the version of the manifest, so the arrays of a library
+    that is already open are never replaced. The manifest is written last, so a library is only visible once all of its
+    arrays are saved, and the arrays of earlier compilations are then deleted.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder
+    dicti : dict
+        The compiled library, with the same keys as LibraryInfo.pkl. Any extra arrays are saved as well.
+
+    Returns
+    -------
+    library : LibraryInfo
+        The saved library
+    """
+    version = uuid.uuid4().hex
+    arrays = {}
+    for key in dicti:
+        value = dicti[key]
+        if key in ('SCORE', 'eigenV'):
+            value = np.asfortranarray(value)
+        elif key == 'colTypes':
+            value = np.asarray(value, dtype=str)
+        else:
+            value = np.asarray(value)
+        name = 'LibraryInfo.%s.%s.npy' % (version, key)
+        path = os.path.join(l_dir, name)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, value)
+        os.replace(path + '.tmp', path)
+        arrays[key] = name
+
+    manifest = {'format': FORMAT_VERSION,
+                'version': version,
+                'created': datetime.now().isoformat(),
+                'arrays': arrays}
+    manifest_file = os.path.join(l_dir, MANIFEST_NAME)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_file + '.tmp', manifest_file)
+    library = LibraryInfo(l_dir, manifest)
+
+    kept = set(arrays.values())
+    for name in os.listdir(l_dir):
+        if name.startswith('LibraryInfo.') and name.endswith('.npy') and name not in kept:
+            try:
+                os.remove(os.path.join(l_dir, name))
+            except OSError:
+                # Still mapped on a system that does not allow that. It is deleted by the next compilation.
+                pass
+    return library
+
+
+def loadLibrary(l_dir  # type: str
+                ):
+    # type: (str) -> Mapping
+    """
+    Loads a compiled library.
+
+    The memory-mapped format is used if it is there. A LibraryInfo.pkl is read instead if it is the only library in
+    the folder or if it is newer.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder
+
+    Returns
+    -------
+    library : Mapping
+        A LibraryInfo, or the dictionary from LibraryInfo.pkl.
+    """
+    manifest_file = os.path.join(l_dir, MANIFEST_NAME)
+    pickle_file = os.path.join(l_dir, PICKLE_NAME)
+    if os.path.isfile(manifest_file) and not (os.path.isfile(pickle_file) and
+                                              os.path.getmtime(pickle_file) > os.path.getmtime(manifest_file)):
+        return LibraryInfo(l_dir)
+    with open(pickle_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def libraryExists(l_dir  # type: str
+                  ):
+    # type: (str) -> bool
+    """
+    Checks if a library folder has been compiled.
+    """
+    return os.path.isfile(os.path.join(l_dir, MANIFEST_NAME)) or os.path.isfile(os.path.join(l_dir, PICKLE_NAME))
+
+
+def libraryVersion(library  # type: Mapping
+                   ):
+    # type: (Mapping) -> str
+    """
+    Identifies a compiled library so that results computed with it can be recognised later.
+
+    Parameters
+    ----------
+    library : Mapping
+        A library from loadLibrary
+
+    Returns
+    -------
+    version : str
+        The version in the manifest, or a hash of the arrays of a pickled library.
+    """
+    if isinstance(library, LibraryInfo):
+        return library.version
+    digest = hashlib.sha1()
+    for key in ARRAY_NAMES:
+        value = np.ascontiguousarray(library[key], dtype=str if key == 'colTypes' else None)
+        digest.update(key.encode())
+        digest.update(str(value.shape).encode())
+        digest.update(value.view(np.uint8).ravel())
+    return digest.hexdigest()
+
+
+def convertLibrary(l_dir  # type: str
+                   ):
+    # type: (str) -> LibraryInfo
+    """
+    Converts a LibraryInfo.pkl into the memory-mapped format. The pickle is left in place.
+
+    Parameters
+    ----------
+    l_dir : str
+        The path to the library folder
+
+    Returns
+    -------
+    library : LibraryInfo
+        The converted library
+    """
+    with open(os.path.join(l_dir, PICKLE_NAME), 'rb') as f:
+        dicti = pickle.load(f)
+    library = saveLibrary(l_dir, dicti)
+
+    # Make sure the converted library is preferred over the pickle
+    pickle_file = os.path.join(l_dir, PICKLE_NAME)
+    stamp = os.path.getmtime(pickle_file)
+    manifest_file = os.path.join(l_dir, MANIFEST_NAME)
+    if os.path.getmtime(manifest_file) <= stamp:
+        os.utime(manifest_file, (stamp + 1, stamp + 1))
+    return library
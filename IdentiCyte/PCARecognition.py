@@ -2,17 +2,16 @@
    File Name: PCARecognition.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Performs the recognition and identifies cells
 """
 import numpy as np
-from tkinter import *
-from IdentiCyte.CellVerUI import CellVerUI
 from datetime import datetime
 import os
 import IdentiCyte.Globs as Globs
+import IdentiCyte.Instrument as Instrument
 import cv2
 from typing import List
 
@@ -50,7 +49,9 @@ def PCARecognition(inputData,  # type: ndarray
                    typeArray,  # type: list[str]
                    pcThresh=90,  # type: Opional(float)
                    confThresh=50,  # type: Opional(float)
-                   near=10  # type: Opional(int)
+                   near=10,  # type: Opional(int)
+                   index=None,  # type: Optional(LibraryIndex)
+                   valid=None  # type: Optional(ndarray)
                    ):
     # type: (...) -> (List[str], ndarray)
     """
@@ -79,6 +80,12 @@ def PCARecognition(inputData,  # type: ndarray
         between 0 and 100 inclusive.
     near : int
         THe number of nearest neighbours in the library that will be considered when classifying a cell
+    index : LibraryIndex
+        A nearest neighbour index for the library. It is used if it was built for the same number of principal
+        components, otherwise every library cell is compared.
+    valid : ndarray
+        Whether each cell is clear of the edge of the image. The rows of the other cells are not read, and they are
+        classified as 'Edge'. If None, the cells whose rows are all zero are on the edge.
 
     Returns
     -------
@@ -89,128 +96,319 @@ def PCARecognition(inputData,  # type: ndarray
         classifications in resultCol.
    """
 
-    # Variables for operation.
-    pcThresh = pcThresh/100
-
     testNum = np.shape(inputData)
 
     # Set up large matrices so they do not grow with each iteration
     resultCol = ["---"]*testNum[0]
     confCol = np.zeros([testNum[0], 1])
 
-    # Determine the edge length when displaying the cells to the user
-    if userVer:
-        edgeLength = np.sqrt(testNum[1])
-
     # Read in all the relevant variables
     eigenV = resDict['eigenV']
     score = resDict['SCORE']
     latent = resDict['latent']
     meanV = resDict['meanV']
     colTypes = resDict['colTypes']
-    trainNum, _ = np.shape(score)
 
     # Determine the number of Principal components to use
-    latentCum = np.cumsum(latent)
-    threshold = np.max(latentCum)*pcThresh
-    pcNum = findThresh(latentCum, threshold)
-    if pcNum < 1:
-        pcNum = 1
+    pcNum = componentCount(latent, pcThresh, resDict.get('totalVar'))
 
     # Take the determined number of components
     eigenCells = eigenV[:, 0:pcNum]
     gallery = score[:, 0:pcNum]
 
-    # Project the data onto the eigencells
-    features = np.matmul((inputData - np.tile(meanV, (testNum[0], 1))), eigenCells)
+    # If the cell is on the edge, its entry will be set to all zeros. Using a very small number to avoid possible
+    # float errors
+    if valid is None:
+        valid = np.abs(np.sum(inputData, axis=1)) > 1e-20
+
+    # Project the cells that are not on the edge onto the eigencells, in the precision of the library
+    with Instrument.stage('projection'):
+        features = np.matmul(inputData[valid].astype(eigenCells.dtype, copy=False) - meanV, eigenCells)
+
+    # Recognise all the cells at once
+    typeNames, codes = np.unique(np.asarray(colTypes, dtype=str), return_inverse=True)
+    labels = np.zeros(testNum[0], dtype=int)
+    confs = np.zeros(testNum[0])
+    if np.any(valid):
+        with Instrument.stage('knn'):
+            if index is not None and index.usable(pcNum, near):
+                dist, idx = index.neighbours(features, gallery, near)
+            else:
+                dist, idx = nearestNeighbours(features, gallery, near)
+        with Instrument.stage('scoring'):
+            labels[valid], confs[valid] = scoreNeighbours(dist, codes.ravel()[idx], len(typeNames))
 
-    # Recognise the cells
     for k in range(testNum[0]):
         if Globs.end:
             break
-        # If the cell is on the edge, its entry will be set to all zeros. Using a very small number to avoid possible
-        # float errors
-        if np.abs(np.sum(inputData[k])) > 1e-20:
-
-            # Select the current cell
-            f = features[k]
-
-            # Determine the distance of the cell from each of the eigencells in the library
-            dist = np.sum(np.power((np.tile(f, (trainNum, 1)) - gallery), 2), axis=1)
-            idx = np.arange(0, len(dist), 1)  # type: list[int]
-
-            # Sort the lists by distance, keeping track of the original positions
-            dist, idx = ((list(t) for t in zip(*sorted(zip(dist, idx)))))
-
-            # Select the closest cells from the image library to the current cell
-            top = dist[0:near]
-
-            # Build a dictionary and a lookup array to keep track of what cell types are closest to the current cell
-            typeDic = {}
-            revTypeDic = []
-            for j in range(len(top)):
-                if not colTypes[idx[j]] in typeDic:
-                    typeDic[str(colTypes[idx[j]])] = len(typeDic)
-                    revTypeDic.append(str(colTypes[idx[j]]))
-
-            # Determine the confidence for each type of cell among the closest
-            typeScores = np.zeros(len(typeDic))
-            for i in range(len(top)):
-                cellSum = (1/(i+1))*(1/top[i])  # Since python counts indices from zero, rank is index + 1
-                typeScores[typeDic[colTypes[idx[i]]]] += cellSum
-
-            # Convert scores to percentages and find the most likely type
-            typeScores = np.multiply(np.divide(typeScores, np.sum(typeScores)), 100)
-            conf = np.max(typeScores)
-            mPos = np.argmax(typeScores)
+        if valid[k]:
+            conf = confs[k]
 
             # Perform user verification
             if userVer and (conf < confThresh):
-
-                # Prepare the cell to be displayed
-                img = np.reshape(inputData[k],
-                                 [int(np.sqrt(np.size(inputData[k]))),
-                                  int(np.sqrt(np.size(inputData[k])))])
-
-                img = np.multiply(img, 256)
-
-                # Bring up the verification window
-                wind = Toplevel()
-                verification = CellVerUI(wind, img.astype(int), typeArray)
-                wind.mainloop()
-
-                # Get the result of the selection
-                decision = verification.type.get()
-
-                # Destroy the window so the next image may be displayed correctly
-                wind.destroy()
-
-                if not (decision == "Ignore"):
-                    # Save the image with a unique name
-                    resultCol[k] = decision
-                    type_dir = os.path.abspath(os.path.join(library_dir,decision))
-
-                    name = str(datetime.now())
-                    for char in " -.:":
-                        name = name.replace(char, '')
-
-                    filename = os.path.abspath(os.path.join(type_dir, name + '.tif'))
-
-                    cv2.imwrite(filename, img)
-                else:
-                    resultCol[k] = 'Ignore'
+                resultCol[k] = verify(inputData[k], library_dir, typeArray)
                 # if the user has verified, treat the result as certain
                 conf = 100
             elif (conf < confThresh):
                 resultCol[k] = 'Other'
             else:  # elseif userVer and (conf < confThresh):
                 # Save the most likely cell type
-                resultCol[k] = revTypeDic[mPos]
+                resultCol[k] = str(typeNames[labels[k]])
 
-        else:  # elseif np.abs(np.sum(inputData[k])) > 1e-20:
+        else:  # elseif valid[k]:
             # Handle literal edge cases
             resultCol[k] = 'Edge'
             conf = 100
         # Save the confidence
         confCol[k] = conf
     return resultCol, confCol
+
+
+def componentCount(latent,  # type: array[float]
+                   pcThresh=90,  # type: Optional(float)
+                   totalVar=None  # type: Optional(float)
+                   ):
+    # type: (array, Optional(float), Optional(float)) -> int
+    """
+    Determines how many principal components are used to compare cells to the library.
+
+    Parameters
+    ----------
+    latent : array
+        The variance explained by each principal component of the library
+    pcThresh : float
+        A percentage value of which proportion of principal components are used to compare a cell to the library. Valid
+        values are between 0 and 100 inclusive.
+    totalVar : float
+        The total variance of the library. Only needed if the library was compiled with some of its components left
+        out, otherwise it is the sum of latent.
+
+    Returns
+    -------
+    pcNum : int
+        The number of leading principal components to use. This is at least 1.
+    """
+    latentCum = np.cumsum(latent)
+    if totalVar is None:
+        totalVar = np.max(latentCum)
+    threshold = totalVar*(pcThresh/100)
+    pcNum = findThresh(latentCum, threshold)
+    if pcNum < 0:
+        # The library does not keep enough components to reach the threshold, so use all of them
+        pcNum = len(latent)
+    if pcNum < 1:
+        pcNum = 1
+    return pcNum
+
+
+def nearestNeighbours(features,  # type: ndarray
+                      gallery,  # type: ndarray
+                      near,  # type: int
+                      chunk=2**24  # type: Optional(int)
+                      ):
+    # type: (...) -> (ndarray, ndarray)
+    """
+    Finds the closest library cells to each cell.
+
+    The distances from a block of cells to the whole gallery are estimated with one matrix product using the
+    precomputed squared norms of the gallery. Only the gallery entries that could be among the nearest (allowing for
+    rounding in the estimate) are kept, and their squared distances are then computed exactly. The neighbours are
+    therefore the same as sorting every exact distance, with ties broken by the position in the library.
+
+    Parameters
+    ----------
+    features : ndarray
+        The projection of each cell onto the principal components, one row per cell
+    gallery : ndarray
+        The projection of each library cell onto the same components, one row per library cell
+    near : int
+        The number of nearest neighbours to find
+    chunk : int
+        The most distance estimates held in memory at once
+
+    Returns
+    -------
+    dist : ndarray
+        The squared distances to the nearest library cells, closest first. One row per cell.
+    idx : ndarray
+        The library positions of the nearest library cells, in the same order as dist.
+    """
+    gallery = np.ascontiguousarray(gallery)
+    trainNum, pcNum = np.shape(gallery)
+    near = min(near, trainNum)
+    galSq = np.einsum('ij,ij->i', gallery, gallery)
+    eps = np.finfo(np.result_type(features, gallery)).eps
+
+    dist = np.zeros([len(features), near], dtype=np.result_type(features, gallery))
+    idx = np.zeros([len(features), near], dtype=np.intp)
+    step = max(1, chunk//max(trainNum, 1))
+    for start in range(0, len(features), step):
+        f = features[start:start + step]
+        fSq = np.einsum('ij,ij->i', f, f)
+
+        # Estimate every distance with a single BLAS call and pick out the candidates with a partial sort
+        approx = fSq[:, None] - 2*np.matmul(f, gallery.T) + galSq[None, :]
+        kth = np.partition(approx, near - 1, axis=1)[:, near - 1]
+        margin = 64*pcNum*eps*(fSq + np.max(galSq))
+        rows, cols = np.nonzero(approx <= (kth + 2*margin)[:, None])
+        candidates = neighbourPairs(f, gallery, rows, cols, near)
+        dist[start:start + step], idx[start:start + step] = candidates
+    return dist, idx
+
+
+def neighbourPairs(features,  # type: ndarray
+                   gallery,  # type: ndarray
+                   rows,  # type: ndarray
+                   cols,  # type: ndarray
+                   near  # type: int
+                   ):
+    # type: (...) -> (ndarray, ndarray)
+    """
+    Picks the nearest library cells for each cell out of a list of candidate pairs.
+
+    Parameters
+    ----------
+    features : ndarray
+        The projection of each cell onto the principal components, one row per cell
+    gallery : ndarray
+        The projection of each library cell onto the same components, one row per library cell
+    rows : ndarray
+        The cell in each candidate pair. Every cell needs at least near candidates.
+    cols : ndarray
+        The library cell in each candidate pair.
+    near : int
+        The number of nearest neighbours to keep for each cell
+
+    Returns
+    -------
+    dist : ndarray
+        The squared distances to the nearest library cells, closest first. One row per cell.
+    idx : ndarray
+        The library positions of the nearest library cells, in the same order as dist.
+    """
+    # Exact squared distances, summed the same way as for a single cell
+    exact = np.sum(np.power(features[rows] - gallery[cols], 2), axis=1)
+
+    # Sort by cell, then distance, then library position and keep the first near of each cell
+    order = np.lexsort((cols, exact, rows))
+    starts = np.searchsorted(rows[order], np.arange(len(features)))
+    take = order[starts[:, None] + np.arange(near)[None, :]]
+    return exact[take], cols[take]
+
+
+def scoreNeighbours(dist,  # type: ndarray
+                    types,  # type: ndarray
+                    typeNum  # type: int
+                    ):
+    # type: (...) -> (ndarray, ndarray)
+    """
+    Finds the most likely type of each cell from its nearest library cells.
+
+    Each neighbour votes for its type with a weight of 1/(rank*distance). The votes are converted to percentages and
+    the type with the highest percentage wins. Ties go to the type that appears first among the neighbours.
+
+    Parameters
+    ----------
+    dist : ndarray
+        The squared distances to the nearest library cells, closest first. One row per cell.
+    types : ndarray
+        The type code of each neighbour in dist
+    typeNum : int
+        The number of type codes
+
+    Returns
+    -------
+    labels : ndarray
+        The type code of the most likely type of each cell
+    confs : ndarray
+        The percentage of the votes given to the most likely type
+    """
+    cellNum, near = np.shape(dist)
+    cells = np.arange(cellNum)
+
+    # Add up the votes for each type in rank order. Since python counts indices from zero, rank is index + 1
+    votes = (1/(np.arange(near) + 1))[None, :]*(1/dist)
+    typeScores = np.zeros([cellNum, typeNum])
+    firstRank = np.full([cellNum, typeNum], near)
+    for rank in range(near):
+        typeScores[cells, types[:, rank]] += votes[:, rank]
+    for rank in range(near - 1, -1, -1):
+        firstRank[cells, types[:, rank]] = rank
+
+    # Order the types of each cell by when they first appear among the neighbours
+    order = np.argsort(firstRank, axis=1, kind='stable')
+    typeScores = np.take_along_axis(typeScores, order, axis=1)
+    present = np.sum(firstRank < near, axis=1)
+
+    # Convert scores to percentages and find the most likely type. Cells with the same number of types are summed
+    # together so the result matches summing each cell on its own.
+    labels = np.zeros(cellNum, dtype=int)
+    confs = np.zeros(cellNum)
+    for count in np.unique(present):
+        group = np.flatnonzero(present == count)
+        scores = typeScores[group, 0:count]
+        scores = np.multiply(np.divide(scores, np.sum(scores, axis=1)[:, None]), 100)
+        best = np.argmax(scores, axis=1)
+        confs[group] = scores[np.arange(len(group)), best]
+        labels[group] = order[group, best]
+    return labels, confs
+
+
+def verify(cell,  # type: ndarray
+           library_dir,  # type: str
+           typeArray  # type: List[str]
+           ):
+    # type: (...) -> str
+    """
+    Asks the user to classify a cell and saves it to the library.
+
+    Parameters
+    ----------
+    cell : ndarray
+        A flattened matrix which represents a cell from the image being analyzed.
+    library_dir : str
+        A string of the directory path to the library
+    typeArray : list
+        A list of strings, each of which represents a category
+
+    Returns
+    -------
+    decision : str
+        The category chosen by the user, or 'Ignore'
+    """
+    # Prepare the cell to be displayed
+    img = np.reshape(cell,
+                     [int(np.sqrt(np.size(cell))),
+                      int(np.sqrt(np.size(cell)))])
+
+    img = np.multiply(img, 256)
+
+    # The GUI is only loaded when a cell needs to be verified, so recognition can run without a display
+    from tkinter import Toplevel
+    from IdentiCyte.CellVerUI import CellVerUI
+
+    # Bring up the verification window
+    wind = Toplevel()
+    verification = CellVerUI(wind, img.astype(int), typeArray)
+    wind.mainloop()
+
+    # Get the result of the selection
+    decision = verification.type.get()
+
+    # Destroy the window so the next image may be displayed correctly
+    wind.destroy()
+
+    if not (decision == "Ignore"):
+        # Save the image with a unique name
+        type_dir = os.path.abspath(os.path.join(library_dir, decision))
+
+        name = str(datetime.now())
+        for char in " -.:":
+            name = name.replace(char, '')
+
+        filename = os.path.abspath(os.path.join(type_dir, name + '.tif'))
+
+        cv2.imwrite(filename, img)
+    else:
+        decision = 'Ignore'
+    return decision
@@ -0,0 +1,140 @@
+"""
+   File Name: Prefetch.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Reads images on background threads while the previous images are analysed
+"""
+import os
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import IdentiCyte.Instrument as Instrument
+
+
+class ImagePrefetcher(object):
+    """
+    Reads the next few images in a list ahead of time.
+
+    Iterating gives each path and its image in order. While an image is being analysed, up to depth of the following
+    images are read on background threads. Fewer are read ahead if they would take more than maxBytes, judged by the
+    largest image read so far. A depth of 0 reads each image only when it is needed.
+
+    Attributes
+    ----------
+    paths : list
+        The paths to the images
+    depth : int
+        The most images read ahead of the one being analysed
+    maxBytes : int
+        The most memory the images read ahead may take up
+    loader : function
+        Reads an image given its path
+    stats : dict
+        The number of 'images' and 'bytes' read, the seconds spent 'loading' them on the background threads, the
+        seconds the analysis spent waiting for an image ('ioWait') and the seconds spent on each image once it had
+        been read ('compute').
+    """
+    def __init__(self,
+                 paths,  # type: List[str]
+                 depth=2,  # type: Optional(int)
+                 maxBytes=2**30,  # type: Optional(int)
+                 loader=cv2.imread  # type: Optional(Callable[[str], ndarray])
+                 ):
+        # type: (...) -> None
+        self.paths = list(paths)
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.loader = loader
+        self.stats = {'images': 0, 'bytes': 0, 'loading': 0., 'ioWait': 0., 'compute': 0.}
+        self._largest = 0
+        self._lock = threading.Lock()
+        self._nextPath = 0
+        self._pool = None
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        # type: () -> Iterator[(str, ndarray)]
+        if self.depth > 0:
+            self._pool = ThreadPoolExecutor(max_workers=self.depth)
+        try:
+            self._nextPath = 0
+            for path in self.paths:
+                if self._pool is None:
+                    waited = timeit.default_timer()
+                    image = self._load(path)
+                else:
+                    self._fill()
+                    waited = timeit.default_timer()
+                    image = self._pending.pop(0).result()
+                    # Start on the following images before this one is analysed
+                    self._fill()
+                started = timeit.default_timer()
+                self.stats['ioWait'] += started - waited
+                yield path, image
+                self.stats['compute'] += timeit.default_timer() - started
+        finally:
+            self.close()
+
+    def close(self):
+        # type: () -> None
+        """
+        Stops reading ahead. Images that are already being read are finished and discarded.
+        """
+        for future in self._pending:
+            future.cancel()
+        self._pending = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def report(self):
+        # type: () -> str
+        """
+        Describes how long the analysis was held up reading images compared with analysing them.
+        """
+        return ('Read %d images (%.1f MB) in %.1f s. Waited %.1f s for images and spent %.1f s analysing them.' %
+                (self.stats['images'], self.stats['bytes']/2**20, self.stats['loading'], self.stats['ioWait'],
+                 self.stats['compute']))
+
+    def _fill(self):
+        # type: () -> None
+        """
+        Starts reading as many images as the depth and memory limit allow. The next image is always started, but no
+        more until the size of an image is known.
+        """
+        while self._nextPath < len(self.paths):
+            ahead = len(self._pending)
+            if ahead and (ahead >= self.depth or not self._largest or (ahead + 1)*self._largest > self.maxBytes):
+                break
+            self._pending.append(self._pool.submit(self._load, self.paths[self._nextPath]))
+            self._nextPath += 1
+
+    def _load(self,
+              path  # type: str
+              ):
+        # type: (str) -> ndarray
+        """
+        Reads one image and records how long it took.
+        """
+        start = timeit.default_timer()
+        with Instrument.stage('decode'):
+            image = self.loader(path)
+        if Instrument.enabled and os.path.isfile(path):
+            Instrument.count('decode', 'bytes', os.path.getsize(path))
+        size = getattr(image, 'nbytes', 0)
+        with self._lock:
+            self._largest = max(self._largest, size)
+            self.stats['images'] += 1
+            self.stats['bytes'] += size
+            self.stats['loading'] += timeit.default_timer() - start
+        return image
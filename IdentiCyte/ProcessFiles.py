@@ -2,21 +2,65 @@
    File Name: ProcessFiles.py
    Version: 1.0
    Author: Guillaume Garnier
-   Date Modified: 2019-01-07
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Collects the results from the detection and recognition of cells.
 """
 import os
 import numpy as np
-from IdentiCyte.ToGreyScale import greyalize
+from IdentiCyte.ToGreyScale import greyChannel, greyRows, greyLevels, levelRows
 from IdentiCyte.PCARecognition import PCARecognition
 import IdentiCyte.Globs as Globs
 from IdentiCyte.CellDetection import detect
+from IdentiCyte.TiledDetection import detectTiled, tiledHalo
+from IdentiCyte.LibraryIndex import loadIndex
+from IdentiCyte.LibraryStore import loadLibrary, libraryExists, libraryVersion
+from IdentiCyte.ResultCache import CachedReader, settingsKey, detectionKey, detectionSettingsKey
+from IdentiCyte.Prefetch import ImagePrefetcher
+import IdentiCyte.Instrument as Instrument
 import cv2
-import pickle
 import gc
 import re
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+# The library, its index and the matrix of cells used by each worker process when images are analysed in parallel
+_workerLibrary = None
+_workerIndex = None
+_workerBuffer = None
+
+# How often, in seconds, Globs.end is checked while waiting for a worker to finish an image
+POLL_SECONDS = 0.1
+
+
+class RowBuffer(object):
+    """
+    A matrix of cells that is reused from one image to the next. It is made in the precision of the library, so a
+    single precision library is compared with single precision cells.
+
+    Attributes
+    ----------
+    data : ndarray
+        The matrix, with one row per cell. It only grows, so it has room for the most cells found in an image so far.
+    """
+    def __init__(self,
+                 pixels,  # type: int
+                 dtype=np.float64  # type: Optional(type)
+                 ):
+        # type: (int, Optional(type)) -> None
+        self.data = np.empty([0, pixels], dtype=dtype)
+
+    def rows(self,
+             count  # type: int
+             ):
+        # type: (int) -> ndarray
+        """
+        Gets a matrix with room for count cells. Its contents are left over from earlier images.
+        """
+        if count > len(self.data):
+            self.data = np.empty([max(count, 2*len(self.data)), np.shape(self.data)[1]], dtype=self.data.dtype)
+        return self.data[0:count]
+
 
 def ProcessFiles(l_dir,  # type: str
                  pics_dir,# type: str
@@ -30,7 +74,16 @@ def ProcessFiles(l_dir,  # type: str
                  pcThresh=90,  # type: Opional(float)
                  confThresh=50,  # type: Opional(float)
                  bf=True,  # type: Opional(bool)
-                 near=10  # type: Opional(int)
+                 near=10,  # type: Opional(int)
+                 workers=1,  # type: Optional(int)
+                 prefetch=2,  # type: Optional(int)
+                 prefetchMemory=2**30,  # type: Optional(int)
+                 cache=None,  # type: Optional(DiskCache)
+                 detections=None,  # type: Optional(DiskCache)
+                 probes=None,  # type: Optional(int)
+                 tileMemory=None,  # type: Optional(int)
+                 withAreas=False,  # type: Optional(bool)
+                 withNames=False  # type: Optional(bool)
                  ):
     # type: (...) -> (List[List[str]], List[List[float]], List[List[int]])
     """
@@ -69,6 +122,30 @@ def ProcessFiles(l_dir,  # type: str
         Indicates whether the image is bright field(True) or fluorescent(False)
     near : int
         THe number of nearest neighbours in the library that will be considered when classifying a cell
+    workers : int
+        The number of processes used to analyse images in parallel. User verification always runs in this process.
+    prefetch : int
+        The number of images read ahead on background threads while an image is analysed. 0 reads each image when it
+        is needed. Only used when the images are analysed in this process.
+    prefetchMemory : int
+        The most memory in bytes taken up by the images read ahead.
+    cache : DiskCache
+        A cache of results. Images whose file, settings and library have not changed since they were last analysed
+        with the cache are not analysed again. Not used when the user verifies cells.
+    detections : DiskCache
+        A cache of the cells found in each image. Images whose file and detection settings have not changed since they
+        were last analysed with the cache are not segmented again, so only changing the recognition settings is quick.
+    probes : int
+        The number of clusters an approximate library index searches for each cell, instead of the number it was
+        compiled with. More clusters miss fewer neighbours but search more slowly.
+    tileMemory : int
+        The most memory in bytes that finding the cells in an image may use. Images too large to segment in one piece
+        within it are segmented a tile at a time, see TiledDetection.detectTiled. Images are always segmented in one
+        piece if None.
+    withAreas : bool
+        Return the area of each cell as well
+    withNames : bool
+        Return the file names of the images analysed as well
 
     Returns
     -------
@@ -81,8 +158,118 @@ def ProcessFiles(l_dir,  # type: str
     locations : list
         A list of lists of pairs of co-ordinates. These co-ordinates refer to an approximate centroid for all the cells
         in the analyzes images. This has the same order as cellTypes and cellConf.
+    areas : list
+        A list of lists of the number of pixels in each cell, in the same order as locations. Only returned if
+        withAreas is True.
+    img_names : list
+        The file name of each image, in the same order as cellTypes. Only returned if withNames is True.
    """
 
+    opened = openAnalysis(l_dir, pics_dir, window, probes)
+    if opened is None:
+        return (0,)*(3 + withAreas + withNames)
+    img_names, resDict, index = opened
+    imgNum = len(img_names)
+
+    cellTypes = [[]]*imgNum
+    cellConf = [[]]*imgNum
+    locations = [[]]*imgNum
+    areas = [[]]*imgNum
+    for j, _, types, conf, imInfo, cellAreas in analyseImages(pics_dir, img_names, l_dir, resDict, index, typeArray,
+                                                              window=window,
+                                                              userVer=userVer,
+                                                              bits=bits,
+                                                              color=color,
+                                                              method=method,
+                                                              minSize=minSize,
+                                                              pcThresh=pcThresh,
+                                                              confThresh=confThresh,
+                                                              bf=bf,
+                                                              near=near,
+                                                              workers=workers,
+                                                              prefetch=prefetch,
+                                                              prefetchMemory=prefetchMemory,
+                                                              cache=cache,
+                                                              detections=detections,
+                                                              probes=probes,
+                                                              tileMemory=tileMemory):
+        cellTypes[j], cellConf[j], locations[j], areas[j] = types, conf, imInfo, cellAreas
+    return (cellTypes, cellConf, locations) + ((areas,) if withAreas else ()) + ((img_names,) if withNames else ())
+
+
+def iterProcessFiles(l_dir,  # type: str
+                     pics_dir,  # type: str
+                     typeArray,  # type: List[str]
+                     window=None,  # type: Optional(MainWindow)
+                     userVer=False,  # type: Optional(bool)
+                     bits=3,  # type: Optional(int)
+                     color='B',  # type: Optional(str)
+                     method='Triangle',  # type: Optional(str)
+                     minSize=9000,  # type: Optional(int)
+                     pcThresh=90,  # type: Optional(float)
+                     confThresh=50,  # type: Optional(float)
+                     bf=True,  # type: Optional(bool)
+                     near=10,  # type: Optional(int)
+                     workers=1,  # type: Optional(int)
+                     prefetch=2,  # type: Optional(int)
+                     prefetchMemory=2**30,  # type: Optional(int)
+                     cache=None,  # type: Optional(DiskCache)
+                     detections=None,  # type: Optional(DiskCache)
+                     probes=None,  # type: Optional(int)
+                     tileMemory=None  # type: Optional(int)
+                     ):
+    # type: (...) -> Iterator[(int, str, List[str], ndarray, List[List[int]], List[int])]
+    """
+    Analyses the images in a folder, giving the results for each image as soon as it is done.
+
+    Nothing is kept once an image has been yielded, so the memory used does not grow with the number of images. The
+    parameters are as described in ProcessFiles.
+
+    Yields
+    ------
+    j : int
+        The position of the image in the folder. Images are yielded in order.
+    name : str
+        The file name of the image
+    cellTypes : list
+        The classification of each cell in the image.
+    cellConf : ndarray
+        The confidence for each cell in the image.
+    imInfo : list
+        The approximate centroid of each cell in the image.
+    areas : list
+        The number of pixels in each cell in the image.
+    """
+    opened = openAnalysis(l_dir, pics_dir, window, probes)
+    if opened is None:
+        return
+    img_names, resDict, index = opened
+    yield from analyseImages(pics_dir, img_names, l_dir, resDict, index, typeArray,
+                             window=window,
+                             userVer=userVer,
+                             bits=bits,
+                             color=color,
+                             method=method,
+                             minSize=minSize,
+                             pcThresh=pcThresh,
+                             confThresh=confThresh,
+                             bf=bf,
+                             near=near,
+                             workers=workers,
+                             prefetch=prefetch,
+                             prefetchMemory=prefetchMemory,
+                             cache=cache,
+                             detections=detections,
+                             probes=probes,
+                             tileMemory=tileMemory)
+
+
+def imageNames(pics_dir  # type: str
+               ):
+    # type: (str) -> List[str]
+    """
+    Lists the images in a folder, in the order they are analysed.
+    """
     img_names = os.listdir(pics_dir)
 
     # Remove all non image filenames from the list
@@ -91,103 +278,543 @@ def ProcessFiles(l_dir,  # type: str
         an_image = bool(exp.search(img_names[entry]))
         if os.path.isdir(os.path.join(pics_dir, img_names[entry])) or not an_image:
             img_names.pop(entry)
+    return img_names
+
+
+def openAnalysis(l_dir,  # type: str
+                 pics_dir,  # type: str
+                 window=None,  # type: Optional(MainWindow)
+                 probes=None  # type: Optional(int)
+                 ):
+    # type: (...) -> Optional((List[str], dict, Optional(LibraryIndex)))
+    """
+    Finds the images in a folder and loads the library they are compared to.
+
+    Parameters
+    ----------
+    l_dir : str
+        A string of the directory path to the library
+    pics_dir : str
+        A string of the directory path to the images to be analysed
+    window : MainWindow
+        The main GUI window
+    probes : int
+        The number of clusters an approximate index searches for each cell, as in ProcessFiles
+
+    Returns
+    -------
+    img_names : list
+        The file names of the images
+    resDict : dict
+        The library
+    index : LibraryIndex
+        The nearest neighbour index of the library, or None
+    None is returned instead if the analysis cannot go ahead, and Globs.end is set.
+    """
+    img_names = imageNames(pics_dir)
 
     if not img_names:
         Globs.end = True
-    imgNum = len(img_names)
-
-    cellTypes = [[]]*imgNum
-    cellConf = [[]]*imgNum
 
     # Import the library
     if window:
         window.printout('Loading Library')
     try:
-        lib_file = os.path.join(l_dir, 'LibraryInfo.pkl')
-        with open(lib_file, 'rb') as f:
-            resDict = pickle.load(f)
+        resDict = loadLibrary(l_dir)
+        index = loadIndex(l_dir, resDict, probes)
     except:
         Globs.end = True
 
     if not Globs.end:
-        pixels, _ = np.shape(resDict['eigenV'])
-        if window and not Globs.end:
+        if window:
             window.printout('Library Loaded')
-        elif window and Globs.end:
-            window.printout('Library file not found.')
+        return img_names, resDict, index
+
+    if not libraryExists(l_dir):
+        if window:
+            window.printout('The library has not been compiled. Either compile the library or select a folder with a '
+                            'library that has been compiled.')
+            Globs.batchEnd = True
+    elif window:
+        window.printout('Analysis halted for: ' + pics_dir)
+    Globs.end = True
+    return None
 
-        # Determine the side length of the square which will be extracted to look at the cells
-        radius = int((np.sqrt(pixels)-1)/2)
 
-        locations = []
+def analyseImages(pics_dir,  # type: str
+                  img_names,  # type: List[str]
+                  l_dir,  # type: str
+                  resDict,  # type: dict
+                  index,  # type: Optional(LibraryIndex)
+                  typeArray,  # type: List[str]
+                  window=None,  # type: Optional(MainWindow)
+                  userVer=False,  # type: Optional(bool)
+                  workers=1,  # type: Optional(int)
+                  prefetch=2,  # type: Optional(int)
+                  prefetchMemory=2**30,  # type: Optional(int)
+                  cache=None,  # type: Optional(DiskCache)
+                  detections=None,  # type: Optional(DiskCache)
+                  probes=None,  # type: Optional(int)
+                  **settings
+                  ):
+    # type: (...) -> Iterator[(int, str, List[str], ndarray, List[List[int]], List[int])]
+    """
+    Analyses each image in turn, yielding the results as in iterProcessFiles.
+
+    index should already search the given number of probes. settings holds the remaining keyword arguments of
+    processImage.
+    """
+    # The results of images the user verified are not reused
+    base = None
+    if cache is not None and not userVer:
+        base = settingsKey(dict(settings, probes=probes), libraryVersion(resDict))
+    reused = 0
+
+    if workers > 1 and not userVer:
+        # Identify the cells in every image using a pool of processes
+        paths = [os.path.join(pics_dir, name) for name in img_names]
+        settings = dict(settings, typeArray=typeArray)
+        for j, result, cached in parallelImages(paths, l_dir, settings, workers, instrument=Instrument.enabled,
+                                                cache=cache if base else None, base=base, detections=detections,
+                                                probes=probes):
+            if window:
+                window.printout(str(j + 1) + '. ' + img_names[j])
+            reused += cached
+            yield (j, img_names[j]) + tuple(result)
+        if window and base:
+            window.printout('Reused the results of %d of %d images.' % (reused, len(img_names)))
+        return
 
-        # Identify the cells in every image
-        for j in range(imgNum):
+    # Identify the cells in every image, reading the next images while the current one is analysed
+    paths = [os.path.join(pics_dir, name) for name in img_names]
+    buffer = RowBuffer(np.shape(resDict['eigenV'])[0], resDict['eigenV'].dtype)
+    reader = None
+    if base or detections is not None:
+        reader = CachedReader(cache if base else None, base, detections, _detectionBase(resDict, settings, detections),
+                              settings.get('tileMemory'))
+    with ImagePrefetcher(paths, depth=prefetch, maxBytes=prefetchMemory, loader=reader or cv2.imread) as images:
+        for j, (path, image) in enumerate(images):
             gc.collect()
             if Globs.end:
                 break
-            # Get the dimensions of the image
-            image = cv2.imread(os.path.join(pics_dir, img_names[j]))
-            xMax, yMax, *_ = np.shape(image)
 
             if window:
                 window.printout(str(j + 1) + '. ' + img_names[j])
 
-            # Find the cells in the current image
-            imInfo = detect(image,
-                            channel=color,
-                            method=method,
-                            minSize=minSize,
-                            bf=bf)
-
-            # Create the matrix that will hold the cells
-            cellData = np.zeros([len(imInfo), pixels])
-
-            # Extract the cells from each image
-            for k in range(len(imInfo)):
-                if Globs.end:
-                    break
-                xPos = imInfo[k][0]
-                yPos = imInfo[k][1]
-
-                # Check if the cell is on the edge
-                inBounds = ((xPos-radius) > 0 and (yPos-radius) > 0 and
-                            (xPos+radius) < xMax and (yPos+radius) < yMax)
-                if inBounds:
-                    thisCell = image[int(xPos-radius):int(xPos+radius+1), int(yPos-radius):int(yPos+radius+1), :]
-
-                    # Convert to greyscale by taking a  channel
-                    thisCell = greyalize(thisCell, depth=bits, colour=color)
-
-                    # Normalize
-                    thisCell = thisCell/np.max(thisCell)
-
-                    # Add to the matrix of cells, where each 'row' is a cell
-                    thisCell = np.reshape(thisCell, [1, np.size(thisCell)])
-                    cellData[k] = thisCell
-            cellTypes[j], cellConf[j] = PCARecognition(cellData,
-                                                       resDict,
-                                                       userVer,
-                                                       l_dir,
-                                                       typeArray,
-                                                       pcThresh,
-                                                       confThresh,
-                                                       near)
-            locations.append(imInfo)
-        return cellTypes, cellConf, locations
+            digest = reader.digests.pop(path) if reader else None
+            if reader and path in reader.hits:
+                result = reader.hits.pop(path)
+                reused += 1
+            else:
+                with Instrument.stage('image'):
+                    result = processImage(image, resDict, l_dir, typeArray, userVer=userVer, index=index,
+                                          buffer=buffer, detections=detections, digest=digest,
+                                          found=reader.found.pop(path, None) if reader else None, **settings)
+                if base and not Globs.end:
+                    cache.put(reader.keys.pop(path), result)
+            yield (j, img_names[j]) + tuple(result)
+    if window:
+        window.printout(images.report())
+        if base:
+            window.printout('Reused the results of %d of %d images.' % (reused, len(img_names)))
+
+
+def processImage(image,  # type: ndarray
+                 resDict,  # type: dict
+                 l_dir,  # type: str
+                 typeArray,  # type: List[str]
+                 userVer=False,  # type: Optional(bool)
+                 bits=3,  # type: Optional(int)
+                 color='B',  # type: Optional(str)
+                 method='Triangle',  # type: Optional(str)
+                 minSize=9000,  # type: Optional(int)
+                 pcThresh=90,  # type: Optional(float)
+                 confThresh=50,  # type: Optional(float)
+                 bf=True,  # type: Optional(bool)
+                 near=10,  # type: Optional(int)
+                 index=None,  # type: Optional(LibraryIndex)
+                 buffer=None,  # type: Optional(RowBuffer)
+                 detections=None,  # type: Optional(DiskCache)
+                 digest=None,  # type: Optional(str)
+                 found=None,  # type: Optional(tuple)
+                 tileMemory=None  # type: Optional(int)
+                 ):
+    # type: (...) -> (List[str], ndarray, List[List[int]], List[int])
+    """
+    Detects and recognises the cells in a single image.
+
+    Parameters
+    ----------
+    image : ndarray
+        An array containing the pixel values of the image.
+    resDict : dict
+        A dictionary containing the information from the LibraryInfo.pkl
+    l_dir : str
+        A string of the directory path to the library
+    index : LibraryIndex
+        The nearest neighbour index of the library, if there is one
+    buffer : RowBuffer
+        The matrix of cells to reuse, so one is not made for every image
+    detections : DiskCache
+        A cache of the cells found in each image and their grey scale crops. The cells found are added to it.
+    digest : str
+        The hash of the image file, which the cells found in it are cached under. The detection cache is only used
+        if this is given.
+    found : tuple
+        The cells of the image from the detection cache, as looked up by CachedReader. The image is not segmented,
+        and may be None, if these are given.
+
+    The remaining parameters are as described in ProcessFiles.
+
+    Returns
+    -------
+    cellTypes : list
+        The classification of each cell in the image.
+    cellConf : ndarray
+        The confidence for each cell in the image.
+    imInfo : list
+        The approximate centroid of each cell in the image.
+    areas : list
+        The number of pixels in each cell in the image.
+    """
+    imInfo, cellData, valid, areas = findCells(image, resDict, bits, color, method, minSize, bf, buffer, detections,
+                                               digest, found, tileMemory)
+    cellTypes, cellConf = PCARecognition(cellData,
+                                         resDict,
+                                         userVer,
+                                         l_dir,
+                                         typeArray,
+                                         pcThresh,
+                                         confThresh,
+                                         near,
+                                         index,
+                                         valid)
+    return cellTypes, cellConf, imInfo, areas
+
+
+def findCells(image,  # type: ndarray
+              resDict,  # type: dict
+              bits=3,  # type: Optional(int)
+              color='B',  # type: Optional(str)
+              method='Triangle',  # type: Optional(str)
+              minSize=9000,  # type: Optional(int)
+              bf=True,  # type: Optional(bool)
+              buffer=None,  # type: Optional(RowBuffer)
+              detections=None,  # type: Optional(DiskCache)
+              digest=None,  # type: Optional(str)
+              found=None,  # type: Optional(tuple)
+              tileMemory=None  # type: Optional(int)
+              ):
+    # type: (...) -> (List[List[int]], ndarray, ndarray, List[int])
+    """
+    Detects the cells in a single image and gathers them into the matrix of cells, the first half of processImage.
+
+    The parameters are as described in processImage.
+
+    Returns
+    -------
+    imInfo : list
+        The approximate centroid of each cell in the image.
+    cellData : ndarray
+        The matrix of cells, with a normalized grey scale row for each cell. The rows of cells on the edge are not
+        written to.
+    valid : ndarray
+        Whether each cell is clear of the edge of the image.
+    areas : list
+        The number of pixels in each cell.
+    """
+    pixels, _ = np.shape(resDict['eigenV'])
+
+    # Determine the side length of the square which will be extracted to look at the cells
+    radius = int((np.sqrt(pixels)-1)/2)
+
+    if buffer is None:
+        buffer = RowBuffer(pixels, resDict['eigenV'].dtype)
+
+    # Where the cells found are cached, unless they came from the cache
+    key = None
+    halo = tiledHalo(np.shape(image), tileMemory) if found is None else None
+    if found is None and detections is not None and digest is not None:
+        key = detectionKey(digest, detectionSettings(bits, color, method, minSize, bf, radius), halo)
+
+    if found is not None:
+        imInfo, levels, valid, areas = found
+        Instrument.count('image', 'cells', len(imInfo))
+        with Instrument.stage('crops'):
+            cellData = levelRows(levels, buffer.rows(len(imInfo)), np.flatnonzero(valid))
     else:
+        # Find the cells in the current image
+        with Instrument.stage('detect'):
+            if halo is not None:
+                cells = detectTiled(image,
+                                    channel=color,
+                                    method=method,
+                                    minSize=minSize,
+                                    bf=bf,
+                                    halo=halo,
+                                    maxMemory=tileMemory,
+                                    table=True)
+            else:
+                cells = detect(image,
+                               channel=color,
+                               method=method,
+                               minSize=minSize,
+                               bf=bf,
+                               table=True)
+        imInfo = [[int(y), int(x)] for y, x in zip(cells['y'], cells['x'])]
+        areas = cells['area'].tolist()
+        Instrument.count('image', 'cells', len(imInfo))
 
-        if not os.path.isfile(lib_file):
-            if window:
-                window.printout('The library has not been compiled. Either compile the library or select a folder with a '
-                                'library that has been compiled.')
-                Globs.end = True
-                Globs.batchEnd = True
-                return 0, 0, 0
-        else:
-            if window:
-                window.printout('Analysis halted for: ' + pics_dir)
-                Globs.end = True
-                return 0,0,0
+        # Gather the cells into the matrix of cells, where each 'row' is a cell
+        with Instrument.stage('crops'):
+            crops, valid = cropSquares(image, imInfo, radius, color)
+            cellData = buffer.rows(len(imInfo))
+            if key is not None and crops.dtype == np.uint8:
+                # Keep the grey levels rather than the rows, as they take an eighth of the space
+                levels = greyLevels(crops, bits)
+                detections.put(key, (imInfo, levels, valid, areas))
+                levelRows(levels, cellData, np.flatnonzero(valid))
+            elif len(crops):
+                greyRows(crops, bits, cellData, np.flatnonzero(valid))
+    return imInfo, cellData, valid, areas
+
+
+def detectionSettings(bits,  # type: int
+                      color,  # type: str
+                      method,  # type: str
+                      minSize,  # type: int
+                      bf,  # type: bool
+                      radius  # type: int
+                      ):
+    # type: (...) -> dict
+    """
+    Gathers the settings the cells found in an image depend on, for the keys of the detection cache.
+    """
+    return {'bits': bits, 'color': color, 'method': method, 'minSize': minSize, 'bf': bf, 'radius': radius}
+
+
+def _detectionBase(resDict,  # type: dict
+                   settings,  # type: dict
+                   detections=None  # type: Optional(DiskCache)
+                   ):
+    # type: (...) -> Optional(str)
+    """
+    Makes the settings part of the detection cache keys for the keyword arguments of processImage, or None if there is
+    no detection cache.
+    """
+    if detections is None:
+        return None
+    radius = int((np.sqrt(np.shape(resDict['eigenV'])[0]) - 1)/2)
+    return detectionSettingsKey(detectionSettings(settings['bits'], settings['color'], settings['method'],
+                                                  settings['minSize'], settings['bf'], radius))
+
+
+def cropCells(image,  # type: ndarray
+              imInfo,  # type: List[List[int]]
+              radius,  # type: int
+              bits=3,  # type: Optional(int)
+              color='B',  # type: Optional(str)
+              out=None  # type: Optional(ndarray)
+              ):
+    # type: (...) -> (ndarray, ndarray)
+    """
+    Cuts out the square around each cell that is not on the edge of the image and converts it to a normalized grey
+    scale row.
+
+    The crops are gathered in one go from a strided view of every square in the image, without copying the image.
+
+    Parameters
+    ----------
+    image : ndarray
+        The image
+    imInfo : list
+        The approximate centroid of each cell in the image
+    radius : int
+        Half the side length of the square, not counting the centre pixel
+    bits : int
+        The bit depth of the grey scale cells
+    color : str
+        The colour channel that will be inspected, ignored if analyzing grey scale images
+    out : ndarray
+        The matrix the rows are written to, with a row for each cell. A new one is made if None.
+
+    Returns
+    -------
+    cellData : ndarray
+        The matrix of cells. The rows of cells on the edge are not written to.
+    valid : ndarray
+        Whether each cell is clear of the edge of the image, and so was written to cellData.
+    """
+    side = 2*radius + 1
+    if out is None:
+        out = np.zeros([len(imInfo), side*side])
+    crops, valid = cropSquares(image, imInfo, radius, color)
+    if len(crops):
+        greyRows(crops, bits, out, np.flatnonzero(valid))
+    return out, valid
+
+
+def cropSquares(image,  # type: ndarray
+                imInfo,  # type: List[List[int]]
+                radius,  # type: int
+                color='B'  # type: Optional(str)
+                ):
+    # type: (...) -> (ndarray, ndarray)
+    """
+    Cuts out the square around each cell that is not on the edge of the image, from the colour channel inspected.
+
+    Returns
+    -------
+    crops : ndarray
+        The squares, with shape (number of cells clear of the edge, side, side)
+    valid : ndarray
+        Whether each cell is clear of the edge of the image, and so has a square in crops.
+    """
+    side = 2*radius + 1
+    grey = greyChannel(image, color)
+
+    # Check if each cell is on the edge
+    xMax, yMax = np.shape(grey)
+    centres = np.reshape(np.asarray(imInfo, dtype=int), [-1, 2])
+    valid = ((centres[:, 0] - radius > 0) & (centres[:, 1] - radius > 0) &
+             (centres[:, 0] + radius < xMax) & (centres[:, 1] + radius < yMax))
+    if not np.any(valid):
+        return np.empty([0, side, side], dtype=grey.dtype), valid
+
+    # Every side by side square in the image, indexed by its top left corner
+    squares = np.lib.stride_tricks.as_strided(grey, shape=(xMax - side + 1, yMax - side + 1, side, side),
+                                              strides=grey.strides*2, writeable=False)
+    corners = centres[valid] - radius
+    return squares[corners[:, 0], corners[:, 1]], valid
+
+
+def parallelImages(paths,  # type: List[str]
+                   l_dir,  # type: str
+                   settings,  # type: dict
+                   workers,  # type: int
+                   instrument=False,  # type: Optional(bool)
+                   cache=None,  # type: Optional(DiskCache)
+                   base=None,  # type: Optional(str)
+                   detections=None,  # type: Optional(DiskCache)
+                   probes=None  # type: Optional(int)
+                   ):
+    # type: (...) -> Iterator[(int, tuple, bool)]
+    """
+    Analyses images in a pool of worker processes.
+
+    Each worker loads the library once. Only a few images per worker are queued at a time. Globs.end is checked while
+    waiting for each image, and once it is set the queued images are cancelled and the pool is left to finish the
+    images already being analysed without waiting for them.
+
+    Parameters
+    ----------
+    paths : list
+        The paths to the images to be analysed
+    l_dir : str
+        A string of the directory path to the library
+    settings : dict
+        The keyword arguments passed to processImage for every image
+    workers : int
+        The number of worker processes
+    instrument : bool
+        Record the stages of the analysis in each worker and merge them into the Instrument records of this process.
+    cache : DiskCache
+        The cache of results the workers look images up in and add them to
+    base : str
+        The settings key of the results, from settingsKey
+    detections : DiskCache
+        The cache of the cells found in each image the workers look images up in and add them to
+    probes : int
+        The number of clusters each worker's approximate index searches for each cell, as in ProcessFiles
+
+    Yields
+    ------
+    j : int
+        The index of the image in paths. Images are yielded in order.
+    result : tuple
+        The output of processImage for the image.
+    cached : bool
+        Whether the result came from the cache
+    """
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(l_dir, instrument, probes))
+    pending = []
+    try:
+        nextPath = 0
+        for j in range(len(paths)):
+            # Keep every worker busy without queueing the whole folder
+            while nextPath < len(paths) and len(pending) < 2*workers and not Globs.end:
+                pending.append(pool.submit(_processPath, paths[nextPath], l_dir, settings, cache, base,
+                                           detections))
+                nextPath += 1
+            outcome = None
+            while outcome is None and not Globs.end:
+                try:
+                    outcome = pending[0].result(timeout=POLL_SECONDS)
+                except TimeoutError:
+                    pass
+            if Globs.end:
+                return
+            pending.pop(0)
+            result, stages, cached = outcome
+            if stages:
+                Instrument.merge(stages)
+            yield j, result, cached
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=not Globs.end)
 
 
+def _initWorker(l_dir,  # type: str
+                instrument=False,  # type: Optional(bool)
+                probes=None  # type: Optional(int)
+                ):
+    # type: (str, Optional(bool), Optional(int)) -> None
+    """
+    Loads the library into a worker process.
+    """
+    global _workerLibrary, _workerIndex, _workerBuffer
+    # The pool already provides the parallelism
+    cv2.setNumThreads(1)
+    if instrument:
+        Instrument.enable()
+    _workerLibrary = loadLibrary(l_dir)
+    _workerIndex = loadIndex(l_dir, _workerLibrary, probes)
+    _workerBuffer = RowBuffer(np.shape(_workerLibrary['eigenV'])[0], _workerLibrary['eigenV'].dtype)
+
+
+def _processPath(path,  # type: str
+                 l_dir,  # type: str
+                 settings,  # type: dict
+                 cache=None,  # type: Optional(DiskCache)
+                 base=None,  # type: Optional(str)
+                 detections=None  # type: Optional(DiskCache)
+                 ):
+    # type: (...) -> ((List[str], ndarray, List[List[int]], List[int]), Optional(dict), bool)
+    """
+    Reads and analyses one image in a worker process, unless its result is cached. The stages recorded for the image
+    and whether the result was cached are returned with the result.
+    """
+    reader = None
+    if cache is not None or detections is not None:
+        reader = CachedReader(cache, base, detections, _detectionBase(_workerLibrary, settings, detections),
+                              settings.get('tileMemory'))
+    with Instrument.stage('decode'):
+        image = reader(path) if reader else cv2.imread(path)
+    if Instrument.enabled:
+        Instrument.count('decode', 'bytes', os.path.getsize(path))
+    cached = reader is not None and path in reader.hits
+    if cached:
+        result = reader.hits[path]
+    else:
+        with Instrument.stage('image'):
+            result = processImage(image, _workerLibrary, l_dir, index=_workerIndex, buffer=_workerBuffer,
+                                  detections=detections, digest=reader.digests[path] if reader else None,
+                                  found=reader.found.get(path) if reader else None, **settings)
+        if cache is not None:
+            cache.put(reader.keys[path], result)
+    if not Instrument.enabled:
+        return result, None, cached
+    stages = Instrument.snapshot()
+    Instrument.reset()
+    return result, stages, cached
@@ -0,0 +1,317 @@
+"""
+   File Name: ResultCache.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Remembers the results of analysing an image so unchanged images are not analysed again
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+import cv2
+import numpy as np
+from IdentiCyte.TiledDetection import tiledHalo
+
+# Changed whenever the keys or the values stored change, so entries from older versions are never read
+CACHE_VERSION = 4
+
+# The settings that change the result of analysing an image
+RESULT_SETTINGS = ['bits', 'color', 'method', 'minSize', 'pcThresh', 'confThresh', 'near', 'bf', 'probes']
+
+# The settings that change the cells found in an image and their grey scale crops
+DETECTION_SETTINGS = ['bits', 'color', 'method', 'minSize', 'bf', 'radius']
+
+
+class DiskCache(object):
+    """
+    A folder of pickled values, each stored under a key.
+
+    The values used least recently are deleted once the folder grows past its size limit. Several processes can
+    share the same folder, as every file is written to a temporary name and then renamed. The folder is added up
+    again whenever a value is stored, so the limit counts the values every process has stored.
+
+    Attributes
+    ----------
+    directory : str
+        The cache folder. It is created if needed.
+    maxBytes : int
+        The most space the cached values may take up
+    stats : dict
+        The number of 'hits', 'misses', values 'stored' and values 'evicted' by this process
+    """
+    def __init__(self,
+                 directory,  # type: str
+                 maxBytes=2**30  # type: Optional(int)
+                 ):
+        # type: (str, Optional(int)) -> None
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return DiskCache, (self.directory, self.maxBytes)
+
+    def get(self,
+            key  # type: str
+            ):
+        # type: (str) -> Any
+        """
+        Gets the value stored under a key, or None if there is none.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # Mark the value as recently used
+            os.utime(path, None)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits'] += 1
+        return value
+
+    def put(self,
+            key,  # type: str
+            value  # type: Any
+            ):
+        # type: (str, Any) -> None
+        """
+        Stores a value under a key, then evicts the least recently used values if the cache is too big.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+        with self._lock:
+            self.stats['stored'] += 1
+            self._evict()
+
+    def size(self):
+        # type: () -> int
+        """
+        Adds up the space taken by the cached values.
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def clear(self):
+        # type: () -> None
+        """
+        Deletes every cached value.
+        """
+        with self._lock:
+            for path, _, _ in self._entries():
+                _remove(path)
+
+    def _evict(self):
+        # type: () -> None
+        """
+        Deletes the least recently used values until the cache fits in maxBytes. The lock must be held.
+
+        The values are listed afresh each time, as other processes sharing the folder may have stored values too.
+        """
+        entries = list(self._entries())
+        total = sum(size for _, size, _ in entries)
+        if total <= self.maxBytes:
+            return
+        entries.sort(key=lambda entry: entry[2])
+        for path, size, _ in entries:
+            if total <= self.maxBytes:
+                break
+            if _remove(path):
+                self.stats['evicted'] += 1
+            total -= size
+
+    def _entries(self):
+        # type: () -> Iterator[(str, int, float)]
+        """
+        Lists the path, size and last use of each cached value.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.listdir(self.directory):
+            folder = os.path.join(self.directory, prefix)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.endswith('.pkl'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _path(self,
+              key  # type: str
+              ):
+        # type: (str) -> str
+        """
+        Finds the file of a key. Files are spread over sub folders named after the start of the key.
+        """
+        return os.path.join(self.directory, key[0:2], key + '.pkl')
+
+
+class CachedReader(object):
+    """
+    Reads images as cv2.imread does, hashing each file and looking up its cached result first.
+
+    The file is hashed as it is read, so an image is only decoded if it has no cached result. Used as the loader of
+    an ImagePrefetcher, a cached image is given as None and its result is kept in hits. If a cache of detected cells is
+    given as well, an image with no cached result whose cells are cached is not decoded either, and its cells are kept
+    in found.
+
+    Whether an image is segmented in tiles depends on its size, which goes into its keys. When a tile memory is given,
+    each image is therefore decoded before it is looked up, and only the work after decoding is saved.
+
+    Attributes
+    ----------
+    cache : DiskCache
+        The cache of results, or None to only hash the files
+    base : str
+        The part of the key that depends on the settings and library, from settingsKey
+    detections : DiskCache
+        The cache of detected cells, or None
+    detectionBase : str
+        The part of the key of the detected cells that depends on the detection settings, from detectionSettingsKey
+    tileMemory : int
+        The most memory in bytes that finding the cells in an image may use, as in ProcessFiles, or None
+    digests : dict
+        The hash of the contents of each image read, by path
+    keys : dict
+        The result key of each image read, by path
+    hits : dict
+        The cached result of each image that was not decoded, by path
+    found : dict
+        The cached cells of each image that was not decoded, by path
+    """
+    def __init__(self,
+                 cache=None,  # type: Optional(DiskCache)
+                 base=None,  # type: Optional(str)
+                 detections=None,  # type: Optional(DiskCache)
+                 detectionBase=None,  # type: Optional(str)
+                 tileMemory=None  # type: Optional(int)
+                 ):
+        # type: (...) -> None
+        self.cache = cache
+        self.base = base
+        self.detections = detections
+        self.detectionBase = detectionBase
+        self.tileMemory = tileMemory
+        self.digests = {}
+        self.keys = {}
+        self.hits = {}
+        self.found = {}
+
+    def __call__(self,
+                 path  # type: str
+                 ):
+        # type: (str) -> Optional(ndarray)
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        self.digests[path] = digest
+        image = None
+        halo = None
+        if self.tileMemory is not None:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            halo = tiledHalo(np.shape(image), self.tileMemory)
+        if self.cache is not None:
+            key = imageKey(digest, self.base, halo)
+            self.keys[path] = key
+            result = self.cache.get(key)
+            if result is not None:
+                self.hits[path] = result
+                return None
+        if self.detections is not None and self.detectionBase is not None:
+            found = self.detections.get(imageKey(digest, self.detectionBase, halo))
+            if found is not None:
+                self.found[path] = found
+                return None
+        if image is None:
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return image
+
+
+def settingsKey(settings,  # type: dict
+                version  # type: str
+                ):
+    # type: (dict, str) -> str
+    """
+    Hashes the settings in RESULT_SETTINGS and the version of the library.
+
+    Parameters
+    ----------
+    settings : dict
+        The keyword arguments of processImage
+    version : str
+        The version of the library, from libraryVersion
+
+    Returns
+    -------
+    base : str
+        A hex digest that goes into the key of every image analysed with these settings and library
+    """
+    chosen = dict((name, settings.get(name)) for name in RESULT_SETTINGS)
+    text = json.dumps({'cache': CACHE_VERSION, 'settings': chosen, 'library': version}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def imageKey(digest,  # type: str
+             base,  # type: str
+             halo=None  # type: Optional(int)
+             ):
+    # type: (...) -> str
+    """
+    Makes the key of an image from the hash of its file and a settings key. halo is the halo of the tiles the cells of
+    the image are found in, from tiledHalo, or None if the image is segmented in one piece.
+    """
+    if halo is not None:
+        base = base + ':halo=%d' % halo
+    return hashlib.sha256((digest + base).encode()).hexdigest()
+
+
+def detectionSettingsKey(settings  # type: dict
+                         ):
+    # type: (dict) -> str
+    """
+    Hashes the settings in DETECTION_SETTINGS, for the keys of the cells detected in each image.
+    """
+    chosen = dict((name, settings.get(name)) for name in DETECTION_SETTINGS)
+    text = json.dumps({'cache': CACHE_VERSION, 'detection': chosen}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def detectionKey(digest,  # type: str
+                 settings,  # type: dict
+                 halo=None  # type: Optional(int)
+                 ):
+    # type: (...) -> str
+    """
+    Makes the key of the cells detected in an image from the hash of its file, the settings in DETECTION_SETTINGS and
+    the halo as in imageKey. The library does not change which cells are found, so it is not part of the key.
+    """
+    return imageKey(digest, detectionSettingsKey(settings), halo)
+
+
+def _remove(path  # type: str
+            ):
+    # type: (str) -> bool
+    """
+    Deletes a file, which another process may already have deleted. Returns True if this call deleted it.
+    """
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,188 @@
+"""
+   File Name: ResultSinks.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Writes the results of the analysis one image at a time as they are produced
+"""
+import csv
+import io
+import os
+import pickle
+import numpy as np
+from IdentiCyte.CellStatistics import CellStats
+from IdentiCyte.WriteResult import RESULTS_NAME, cellRecords, imageConfidence, writeWorkbook
+import IdentiCyte.Instrument as Instrument
+
+CELLS_NAME = 'IdentifiedCells.csv'
+
+
+class PickleSink(object):
+    """
+    Writes IdentifiedCellInfo.pkl one image at a time.
+
+    The file is written as a pickle of a list that grows by one image at a time, so it can be read by
+    pickle.load exactly like the one written by WriteResults. It is written to a .part file which is
+    renamed once the last image and the list of categories have been added.
+
+    Attributes
+    ----------
+    results_file : str
+        The path to the finished pickle file
+    typeArray : list
+        The categories, which are saved as the last entry in the list
+    """
+    def __init__(self,
+                 pics_dir,  # type: str
+                 typeArray  # type: List[str]
+                 ):
+        # type: (...) -> None
+        self.results_file = os.path.abspath(os.path.join(pics_dir, RESULTS_NAME))
+        self.typeArray = typeArray
+        self._file = open(self.results_file + '.part', 'wb')
+        self._file.write(pickle.PROTO + bytes([2]) + pickle.EMPTY_LIST)
+
+    def add(self,
+            j,  # type: int
+            name,  # type: str
+            cellTypes,  # type: List[str]
+            cellConf,  # type: ndarray
+            imInfo,  # type: List[List[int]]
+            areas=None  # type: Optional(List[int])
+            ):
+        # type: (...) -> None
+        """
+        Appends the results for one image. The areas of the cells are not saved in the pickle.
+        """
+        with Instrument.stage('pickle'):
+            self._append(cellRecords(cellTypes, cellConf, imInfo))
+            self._file.flush()
+
+    def close(self):
+        # type: () -> None
+        """
+        Finishes the pickle file.
+        """
+        if self._file.closed:
+            return
+        self._append(self.typeArray)
+        self._file.write(pickle.STOP)
+        self._file.close()
+        os.replace(self.results_file + '.part', self.results_file)
+
+    def _append(self,
+                item  # type: Any
+                ):
+        # type: (...) -> None
+        """
+        Writes the opcodes that push item and append it to the list.
+        """
+        buffer = io.BytesIO()
+        # Without a memo every item is self contained, so items pickled separately can share one stream
+        pickler = pickle.Pickler(buffer, 2)
+        pickler.fast = True
+        pickler.dump(item)
+        # Drop the protocol header and the stop opcode
+        self._file.write(buffer.getvalue()[2:-1] + pickle.APPEND)
+
+
+class CsvSink(object):
+    """
+    Writes one row per cell to IdentifiedCells.csv. The file is flushed after every image, so the results of the
+    images analysed so far are kept if the analysis does not finish.
+
+    Attributes
+    ----------
+    cells_file : str
+        The path to the csv file
+    """
+    def __init__(self,
+                 pics_dir  # type: str
+                 ):
+        # type: (str) -> None
+        self.cells_file = os.path.abspath(os.path.join(pics_dir, CELLS_NAME))
+        self._file = open(self.cells_file, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(['Image', 'Cell', 'Type', 'Confidence', 'Row', 'Column'])
+
+    def add(self,
+            j,  # type: int
+            name,  # type: str
+            cellTypes,  # type: List[str]
+            cellConf,  # type: ndarray
+            imInfo,  # type: List[List[int]]
+            areas=None  # type: Optional(List[int])
+            ):
+        # type: (...) -> None
+        """
+        Writes the cells of one image. The areas of the cells are not written to the csv file.
+        """
+        conf = np.ravel(cellConf)
+        for k in range(len(cellTypes)):
+            self._writer.writerow([name, k + 1, cellTypes[k], '%.1f' % conf[k], int(imInfo[k][0]), int(imInfo[k][1])])
+        self._file.flush()
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the csv file.
+        """
+        self._file.close()
+
+
+class WorkbookSink(object):
+    """
+    Writes the summary Excel spreadsheet once every image has been added.
+
+    Only the number of cells of each type and the mean confidence of each image are kept, rather than every cell.
+
+    Attributes
+    ----------
+    typeArray : list
+        The categories, including 'Other' and 'Edge'
+    settings : dict
+        The keyword arguments of writeWorkbook that describe the analysis
+    """
+    def __init__(self,
+                 pics_dir,  # type: str
+                 l_dir,  # type: str
+                 typeArray,  # type: List[str]
+                 **settings
+                 ):
+        # type: (...) -> None
+        self.pics_dir = pics_dir
+        self.l_dir = l_dir
+        self.typeArray = typeArray
+        self.settings = settings
+        self._names = []
+        self._counts = []
+        self._conf = []
+
+    def add(self,
+            j,  # type: int
+            name,  # type: str
+            cellTypes,  # type: List[str]
+            cellConf,  # type: ndarray
+            imInfo,  # type: List[List[int]]
+            areas=None  # type: Optional(List[int])
+            ):
+        # type: (...) -> None
+        """
+        Counts the cells in one image.
+        """
+        self._names.append(name)
+        self._counts.append(CellStats([cellTypes], self.typeArray)[:, 0])
+        self._conf.append(imageConfidence(cellConf))
+
+    def close(self):
+        # type: () -> None
+        """
+        Writes the spreadsheet, if any images were added.
+        """
+        if not self._names:
+            return
+        stat = np.transpose(np.array(self._counts))
+        writeWorkbook(stat, self.typeArray, self._names, self._conf, self.pics_dir, self.l_dir, **self.settings)
+        self._names = []
@@ -0,0 +1,438 @@
+"""
+   File Name: ResultsDatabase.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Keeps the results of every analysis in one SQLite database that can be queried across runs and folders
+"""
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+import numpy as np
+from IdentiCyte.WriteResult import imageConfidence
+import IdentiCyte.Globs as Globs
+import IdentiCyte.Instrument as Instrument
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    library TEXT,
+    started TEXT NOT NULL,
+    finished TEXT,
+    completed INTEGER NOT NULL DEFAULT 0,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    run INTEGER NOT NULL REFERENCES runs(id),
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cells INTEGER NOT NULL,
+    confidence REAL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    image INTEGER NOT NULL REFERENCES images(id),
+    cell INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    row INTEGER,
+    col INTEGER,
+    area INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_folder ON runs(folder, started);
+CREATE INDEX IF NOT EXISTS runs_started ON runs(started);
+CREATE INDEX IF NOT EXISTS images_run ON images(run);
+CREATE INDEX IF NOT EXISTS images_folder ON images(folder, name);
+CREATE INDEX IF NOT EXISTS cells_image ON cells(image);
+CREATE INDEX IF NOT EXISTS cells_label ON cells(label, confidence);
+"""
+
+# What the cells can be counted by, and the column each is read from
+GROUPS = {'label': 'cells.label', 'folder': 'images.folder', 'image': "images.folder || '/' || images.name",
+          'run': 'runs.id'}
+
+
+class ResultsDatabase(object):
+    """
+    An SQLite database of every run, image and cell analysed.
+
+    An image is always added in the same transaction as its cells, so the database only holds whole images. The
+    database is opened in write-ahead mode, so it can be queried while it is being written, and several processes,
+    such as the workers of a batch, can write to it at once.
+
+    The cells are indexed by image and by label and confidence together, and the runs and images by folder, so counts
+    of one type above a confidence across every folder are found without reading the other cells.
+
+    Attributes
+    ----------
+    path : str
+        The database file. It is created if needed.
+    timeout : float
+        How long to wait, in seconds, for another process to finish writing
+    """
+    def __init__(self,
+                 path,  # type: str
+                 timeout=60  # type: Optional(float)
+                 ):
+        # type: (str, Optional(float)) -> None
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # The driver may run on another thread than the one that opened the database
+        self._connection = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        # Write-ahead logging only needs to sync at checkpoints, and a larger page cache keeps more of the label
+        # index in memory as the cells are inserted
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('PRAGMA cache_size=-65536')
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def __reduce__(self):
+        return ResultsDatabase, (self.path, self.timeout)
+
+    def close(self):
+        # type: () -> None
+        """
+        Closes the database.
+        """
+        self._connection.close()
+
+    def startRun(self,
+                 folder,  # type: str
+                 library=None,  # type: Optional(str)
+                 **settings
+                 ):
+        # type: (...) -> int
+        """
+        Records the start of the analysis of a folder.
+
+        Returns
+        -------
+        run : int
+            The id of the run, which its images are added to
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (folder, library, started, settings) VALUES (?, ?, ?, ?)',
+                (os.path.abspath(folder), os.path.abspath(library) if library else None, datetime.now().isoformat(),
+                 json.dumps(settings, sort_keys=True)))
+        return cursor.lastrowid
+
+    def addImage(self,
+                 run,  # type: int
+                 name,  # type: str
+                 cellTypes,  # type: List[str]
+                 cellConf,  # type: ndarray
+                 imInfo,  # type: List[List[int]]
+                 areas=None  # type: Optional(List[int])
+                 ):
+        # type: (...) -> int
+        """
+        Adds an image and its cells to a run.
+
+        Returns
+        -------
+        image : int
+            The id of the image
+        """
+        return self.addImages(run, [(name, cellTypes, cellConf, imInfo, areas)])[0]
+
+    def addImages(self,
+                  run,  # type: int
+                  images  # type: List[tuple]
+                  ):
+        # type: (...) -> List[int]
+        """
+        Adds several images and their cells to a run in one transaction.
+
+        Parameters
+        ----------
+        run : int
+            The id of the run, from startRun
+        images : list
+            A (name, cellTypes, cellConf, imInfo, areas) tuple for each image, where areas may be None
+
+        Returns
+        -------
+        ids : list
+            The id of each image
+        """
+        ids = []
+        with self._lock, self._connection:
+            folder = self._connection.execute('SELECT folder FROM runs WHERE id = ?', (run,)).fetchone()[0]
+            for name, cellTypes, cellConf, imInfo, areas in images:
+                if type(cellTypes) is np.ndarray:
+                    cellTypes = cellTypes.tolist()
+                conf = np.ravel(cellConf).tolist()
+                if areas is None:
+                    areas = [None]*len(cellTypes)
+                cursor = self._connection.execute(
+                    'INSERT INTO images (run, folder, name, cells, confidence) VALUES (?, ?, ?, ?, ?)',
+                    (run, folder, name, len(cellTypes), float(imageConfidence(conf))))
+                image = cursor.lastrowid
+                self._connection.executemany(
+                    'INSERT INTO cells (image, cell, label, confidence, row, col, area) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(image, k, cellTypes[k], conf[k], int(imInfo[k][0]), int(imInfo[k][1]),
+                      None if areas[k] is None else int(areas[k])) for k in range(len(cellTypes))])
+                ids.append(image)
+        return ids
+
+    def finishRun(self,
+                  run,  # type: int
+                  completed=True  # type: Optional(bool)
+                  ):
+        # type: (...) -> None
+        """
+        Records the end of a run, and whether every image in the folder was analysed.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE runs SET finished = ?, completed = ? WHERE id = ?',
+                                     (datetime.now().isoformat(), int(completed), run))
+
+    def runs(self,
+             folder=None,  # type: Optional(str)
+             since=None,  # type: Optional(Union[datetime, str])
+             until=None,  # type: Optional(Union[datetime, str])
+             latest=False  # type: Optional(bool)
+             ):
+        # type: (...) -> List[dict]
+        """
+        Lists the runs, oldest first. The filters are as described in cells.
+        """
+        where, params = _filters(folder=folder, since=since, until=until, latest=latest)
+        rows = self._query('SELECT runs.id, runs.folder, runs.library, runs.started, runs.finished, runs.completed, '
+                           'runs.settings, (SELECT COUNT(*) FROM images WHERE images.run = runs.id) FROM runs'
+                           + where + ' ORDER BY runs.started, runs.id', params)
+        return [{'run': row[0], 'folder': row[1], 'library': row[2], 'started': row[3], 'finished': row[4],
+                 'completed': bool(row[5]), 'settings': json.loads(row[6]), 'images': row[7]} for row in rows]
+
+    def cells(self,
+              label=None,  # type: Optional(Union[str, List[str]])
+              minConf=None,  # type: Optional(float)
+              maxConf=None,  # type: Optional(float)
+              folder=None,  # type: Optional(str)
+              since=None,  # type: Optional(Union[datetime, str])
+              until=None,  # type: Optional(Union[datetime, str])
+              latest=False,  # type: Optional(bool)
+              limit=None  # type: Optional(int)
+              ):
+        # type: (...) -> List[dict]
+        """
+        Finds the cells that match every filter given.
+
+        Parameters
+        ----------
+        label : str or list
+            The cell type, or a list of cell types
+        minConf : float
+            The lowest confidence, in percent, inclusive
+        maxConf : float
+            The highest confidence, in percent, inclusive
+        folder : str
+            The folder analysed. Its sub folders are included.
+        since : datetime or str
+            The earliest start of the run, as a datetime or an ISO 8601 string such as '2026-09-01'
+        until : datetime or str
+            The latest start of the run, exclusive
+        latest : bool
+            Only include the most recent run of each folder, so folders analysed more than once are not counted twice
+        limit : int
+            The most cells returned
+
+        Returns
+        -------
+        cells : list
+            A dict for each cell with its 'run', the 'started' time of the run, the 'folder' and 'image' it is in, its
+            index in the image as 'cell', its 'label', 'confidence', 'row', 'column' and 'area' (None if not recorded).
+        """
+        where, params = _filters(label, minConf, maxConf, folder, since, until, latest)
+        sql = ('SELECT runs.id, runs.started, images.folder, images.name, cells.cell, cells.label, cells.confidence, '
+               'cells.row, cells.col, cells.area FROM cells JOIN images ON cells.image = images.id '
+               'JOIN runs ON images.run = runs.id' + where + ' ORDER BY images.id, cells.cell')
+        if limit is not None:
+            sql += ' LIMIT %d' % int(limit)
+        keys = ['run', 'started', 'folder', 'image', 'cell', 'label', 'confidence', 'row', 'column', 'area']
+        return [dict(zip(keys, row)) for row in self._query(sql, params)]
+
+    def counts(self,
+               by='label',  # type: Optional(str)
+               **filters
+               ):
+        # type: (...) -> dict
+        """
+        Counts the cells that match the filters of cells.
+
+        Parameters
+        ----------
+        by : str
+            What to count the cells by: 'label', 'folder', 'image' (as the folder and name joined by '/') or 'run'
+
+        Returns
+        -------
+        counts : dict
+            The number of 'cells' and their 'confidence', as a mean in percent, of each label, folder, image or run
+        """
+        if by not in GROUPS:
+            raise ValueError('Cells can only be counted by one of: ' + ', '.join(sorted(GROUPS)))
+        where, params = _filters(**filters)
+        sql = ('SELECT %s, COUNT(*), AVG(cells.confidence) FROM cells JOIN images ON cells.image = images.id '
+               'JOIN runs ON images.run = runs.id%s GROUP BY 1' % (GROUPS[by], where))
+        return dict((row[0], {'cells': row[1], 'confidence': row[2]}) for row in self._query(sql, params))
+
+    def _query(self,
+               sql,  # type: str
+               params  # type: list
+               ):
+        # type: (...) -> List[tuple]
+        """
+        Runs a query and returns every row.
+        """
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+
+class DatabaseSink(object):
+    """
+    Adds the results of one folder to a ResultsDatabase, as the sinks in ResultSinks do.
+
+    Committing a transaction rewrites every index page it touched, so images are added in batches of about batchCells
+    cells rather than one at a time. The images still waiting to be added are added when the sink is closed.
+
+    Attributes
+    ----------
+    database : ResultsDatabase
+        The database written to
+    run : int
+        The id of this analysis in the database
+    batchCells : int
+        The number of cells waiting to be added that starts a transaction
+    """
+    def __init__(self,
+                 database,  # type: ResultsDatabase
+                 pics_dir,  # type: str
+                 l_dir,  # type: str
+                 batchCells=50000,  # type: Optional(int)
+                 **settings
+                 ):
+        # type: (...) -> None
+        self.database = database
+        self.run = database.startRun(pics_dir, l_dir, **settings)
+        self.batchCells = batchCells
+        self._pending = []
+        self._cells = 0
+        self._closed = False
+
+    def add(self,
+            j,  # type: int
+            name,  # type: str
+            cellTypes,  # type: List[str]
+            cellConf,  # type: ndarray
+            imInfo,  # type: List[List[int]]
+            areas=None  # type: Optional(List[int])
+            ):
+        # type: (...) -> None
+        """
+        Adds the cells of one image, once enough cells are waiting.
+        """
+        self._pending.append((name, cellTypes, cellConf, imInfo, areas))
+        self._cells += len(cellTypes)
+        if self._cells >= self.batchCells:
+            self._flush()
+
+    def close(self):
+        # type: () -> None
+        """
+        Adds the images still waiting, then marks the run as finished, and as completed unless the analysis was
+        stopped.
+        """
+        if self._closed:
+            return
+        self._flush()
+        self.database.finishRun(self.run, not Globs.end)
+        self._closed = True
+
+    def _flush(self):
+        # type: () -> None
+        """
+        Adds the images waiting in one transaction.
+        """
+        if self._pending:
+            with Instrument.stage('database'):
+                self.database.addImages(self.run, self._pending)
+        self._pending = []
+        self._cells = 0
+
+
+def recordResults(database,  # type: ResultsDatabase
+                  pics_dir,  # type: str
+                  l_dir,  # type: str
+                  names,  # type: List[str]
+                  results,  # type: List[List[str]]
+                  conf,  # type: List[ndarray]
+                  locations,  # type: List[List[List[int]]]
+                  areas=None,  # type: Optional(List[List[int]])
+                  **settings
+                  ):
+    # type: (...) -> int
+    """
+    Adds the results of a whole folder at once, for the results of ProcessFiles. The areas of the cells in each image
+    are recorded if given.
+
+    Returns
+    -------
+    run : int
+        The id of the run in the database
+    """
+    sink = DatabaseSink(database, pics_dir, l_dir, **settings)
+    try:
+        for j in range(len(results)):
+            sink.add(j, names[j], results[j], conf[j], locations[j], areas[j] if areas is not None else None)
+    finally:
+        sink.close()
+    return sink.run
+
+
+def _filters(label=None,  # type: Optional(Union[str, List[str]])
+             minConf=None,  # type: Optional(float)
+             maxConf=None,  # type: Optional(float)
+             folder=None,  # type: Optional(str)
+             since=None,  # type: Optional(Union[datetime, str])
+             until=None,  # type: Optional(Union[datetime, str])
+             latest=False  # type: Optional(bool)
+             ):
+    # type: (...) -> (str, list)
+    """
+    Builds the WHERE clause of a query from the filters described in ResultsDatabase.cells.
+    """
+    clauses = []
+    params = []
+    if label is not None:
+        labels = [label] if isinstance(label, str) else list(label)
+        clauses.append('cells.label IN (%s)' % ', '.join('?'*len(labels)))
+        params.extend(labels)
+    if minConf is not None:
+        clauses.append('cells.confidence >= ?')
+        params.append(float(minConf))
+    if maxConf is not None:
+        clauses.append('cells.confidence <= ?')
+        params.append(float(maxConf))
+    if folder is not None:
+        # The sub folders sort between the folder followed by a separator and the character after the separator
+        folder = os.path.abspath(folder)
+        clauses.append('(runs.folder = ? OR (runs.folder >= ? AND runs.folder < ?))')
+        params.extend([folder, folder + os.sep, folder + chr(ord(os.sep) + 1)])
+    if since is not None:
+        clauses.append('runs.started >= ?')
+        params.append(since.isoformat() if isinstance(since, datetime) else since)
+    if until is not None:
+        clauses.append('runs.started < ?')
+        params.append(until.isoformat() if isinstance(until, datetime) else until)
+    if latest:
+        clauses.append('runs.id IN (SELECT MAX(id) FROM runs GROUP BY folder)')
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params
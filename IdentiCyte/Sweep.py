@@ -0,0 +1,240 @@
+"""
+   File Name: Sweep.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Identifies the cells in a folder with a grid of recognition settings in a single pass
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+import cv2
+import numpy as np
+from IdentiCyte.PCARecognition import componentCount, nearestNeighbours, scoreNeighbours
+from IdentiCyte.ProcessFiles import RowBuffer, detectionSettings, findCells, openAnalysis
+from IdentiCyte.ResultCache import CachedReader, detectionSettingsKey
+from IdentiCyte.Prefetch import ImagePrefetcher
+import IdentiCyte.Globs as Globs
+import IdentiCyte.Instrument as Instrument
+
+# The edges of the bins of the confidence histograms, in percent
+CONFIDENCE_BINS = np.linspace(0, 100, 11)
+
+
+def sweep(l_dir,  # type: str
+          pics_dir,  # type: str
+          pcThresh=(90,),  # type: Optional(List[float])
+          near=(10,),  # type: Optional(List[int])
+          confThresh=(50,),  # type: Optional(List[float])
+          window=None,  # type: Optional(MainWindow)
+          bits=3,  # type: Optional(int)
+          color='B',  # type: Optional(str)
+          method='Triangle',  # type: Optional(str)
+          minSize=9000,  # type: Optional(int)
+          bf=True,  # type: Optional(bool)
+          prefetch=2,  # type: Optional(int)
+          detections=None  # type: Optional(DiskCache)
+          ):
+    # type: (...) -> Optional(dict)
+    """
+    Identifies the cells in a folder of images with every combination of recognition settings.
+
+    Each image is segmented once and its cells are projected once onto the most principal components any setting
+    uses. Fewer components are a slice of that projection. The nearest library cells are found once for each number
+    of components, for the largest near, and the closest of them are used for smaller values of near. The confidence
+    threshold only decides which cells are called 'Other', so every threshold is applied to the same votes.
+
+    Parameters
+    ----------
+    l_dir : str
+        A string of the directory path to the library
+    pics_dir : str
+        A string of the directory path to the images to be analysed
+    pcThresh : list
+        The proportions of the variance of the library, in percent, used to compare cells to the library
+    near : list
+        The numbers of nearest library cells considered when classifying a cell
+    confThresh : list
+        The confidences, in percent, a cell must have to be classified rather than called 'Other'
+    window : MainWindow
+        Shows progress if given
+    bits, color, method, minSize, bf
+        The detection settings, as described in ProcessFiles. They are the same for every combination.
+    prefetch : int
+        The number of images read ahead on background threads
+    detections : DiskCache
+        A cache of the cells found in each image, so images are not segmented again
+
+    Returns
+    -------
+    report : dict
+        The 'settings' shared by every combination, the 'imageCount', the number of 'cells', the 'seconds' taken and the
+        'results' of each combination. Each result has its 'pcThresh', 'pcNum', 'near' and 'confThresh', the 'counts'
+        of each cell type and a 'confidence' histogram of the cells clear of the edge, with its 'mean'. None is
+        returned if the library could not be loaded.
+    """
+    start = timeit.default_timer()
+    opened = openAnalysis(l_dir, pics_dir, window)
+    if opened is None:
+        return None
+    img_names, resDict, index = opened
+
+    eigenV = resDict['eigenV']
+    score = resDict['SCORE']
+    meanV = resDict['meanV']
+    typeNames, codes = np.unique(np.asarray(resDict['colTypes'], dtype=str), return_inverse=True)
+    codes = codes.ravel()
+    names = np.append(typeNames, 'Other')
+
+    # The number of components of each threshold, and the nearest neighbours needed for each number of components
+    pcNums = dict((thresh, componentCount(resDict['latent'], thresh, resDict.get('totalVar'))) for thresh in pcThresh)
+    maxPc = max(pcNums.values())
+    maxNear = max(near)
+    grid = list(itertools.product(sorted(set(pcNums.values())), sorted(set(near))))
+
+    # For each number of components and near: the cell type counts of each confidence threshold and the histogram
+    counts = dict(((pcNum, n, thresh), np.zeros(len(names) + 1, dtype=int))
+                  for (pcNum, n), thresh in itertools.product(grid, confThresh))
+    histograms = dict((key, np.zeros(len(CONFIDENCE_BINS) - 1, dtype=int)) for key in grid)
+    totals = dict((key, 0.) for key in grid)
+    cells = 0
+
+    buffer = RowBuffer(np.shape(eigenV)[0], eigenV.dtype)
+    paths = [os.path.join(pics_dir, name) for name in img_names]
+    reader = None
+    if detections is not None:
+        radius = int((np.sqrt(np.shape(eigenV)[0]) - 1)/2)
+        detectionBase = detectionSettingsKey(detectionSettings(bits, color, method, minSize, bf, radius))
+        reader = CachedReader(detections=detections, detectionBase=detectionBase)
+    with ImagePrefetcher(paths, depth=prefetch, loader=reader or cv2.imread) as images:
+        for j, (path, image) in enumerate(images):
+            if Globs.end:
+                break
+            if window:
+                window.printout(str(j + 1) + '. ' + img_names[j])
+            imInfo, cellData, valid, _ = findCells(image, resDict, bits, color, method, minSize, bf, buffer, detections,
+                                                reader.digests.pop(path) if reader else None,
+                                                reader.found.pop(path, None) if reader else None)
+            cells += len(imInfo)
+            edges = int(np.sum(~valid))
+            for key in counts:
+                counts[key][-1] += edges
+            if not np.any(valid):
+                continue
+
+            # Project once onto the most components needed
+            with Instrument.stage('projection'):
+                features = np.matmul(cellData[valid].astype(eigenV.dtype, copy=False) - meanV, eigenV[:, 0:maxPc])
+
+            for pcNum in sorted(set(pcNums.values())):
+                f = features[:, 0:pcNum]
+                gallery = score[:, 0:pcNum]
+                with Instrument.stage('knn'):
+                    if index is not None and index.usable(pcNum, maxNear):
+                        dist, idx = index.neighbours(f, gallery, maxNear)
+                    else:
+                        dist, idx = nearestNeighbours(f, gallery, maxNear)
+                for n in sorted(set(near)):
+                    with Instrument.stage('scoring'):
+                        labels, confs = scoreNeighbours(dist[:, 0:n], codes[idx[:, 0:n]], len(typeNames))
+                    histograms[pcNum, n] += np.histogram(confs, CONFIDENCE_BINS)[0]
+                    totals[pcNum, n] += float(np.sum(confs))
+                    for thresh in confThresh:
+                        chosen = np.where(confs < thresh, len(typeNames), labels)
+                        counts[pcNum, n, thresh][0:len(names)] += np.bincount(chosen, minlength=len(names))
+
+    scored = int(np.sum(histograms[grid[0]])) if grid else 0
+    results = []
+    for thresh, n, conf in itertools.product(pcThresh, near, confThresh):
+        pcNum = pcNums[thresh]
+        # A library category may itself be called 'Other'
+        tally = {}
+        for name, count in zip(names.tolist() + ['Edge'], counts[pcNum, n, conf].tolist()):
+            tally[name] = tally.get(name, 0) + count
+        results.append({'pcThresh': thresh,
+                        'pcNum': pcNum,
+                        'near': n,
+                        'confThresh': conf,
+                        'counts': tally,
+                        'confidence': {'bins': CONFIDENCE_BINS.tolist(),
+                                       'histogram': histograms[pcNum, n].tolist(),
+                                       'mean': totals[pcNum, n]/scored if scored else 0.}})
+    return {'created': datetime.now().isoformat(),
+            'library': os.path.abspath(l_dir),
+            'images': os.path.abspath(pics_dir),
+            'settings': {'bits': bits, 'color': color, 'method': method, 'minSize': minSize, 'bf': bf},
+            'imageCount': len(img_names),
+            'cells': cells,
+            'completed': not Globs.end,
+            'seconds': timeit.default_timer() - start,
+            'results': results}
+
+
+def formatReport(report  # type: dict
+                 ):
+    # type: (dict) -> str
+    """
+    Lays out a sweep report as text, with one line per combination of settings.
+    """
+    types = sorted(report['results'][0]['counts']) if report['results'] else []
+    header = '%8s %5s %5s %8s %8s ' % ('pcThresh', 'PCs', 'near', 'conf', 'meanConf')
+    lines = [header + ' '.join('%10s' % name[0:10] for name in types)]
+    for result in report['results']:
+        line = '%8g %5d %5d %8g %8.2f ' % (result['pcThresh'], result['pcNum'], result['near'], result['confThresh'],
+                                           result['confidence']['mean'])
+        lines.append(line + ' '.join('%10d' % result['counts'][name] for name in types))
+    lines.append('')
+    lines.append('%d combinations of settings over %d cells in %d images in %.1f seconds.'
+                 % (len(report['results']), report['cells'], report['imageCount'], report['seconds']))
+    return '\n'.join(lines)
+
+
+def main(argv=None  # type: Optional(List[str])
+         ):
+    # type: (...) -> int
+    """
+    Runs a sweep from the command line.
+    """
+    parser = argparse.ArgumentParser(prog='python -m IdentiCyte.Sweep',
+                                     description='Identifies the cells in a folder with every combination of '
+                                                 'recognition settings.')
+    parser.add_argument('--library', required=True, help='the library folder')
+    parser.add_argument('--images', required=True, help='the folder of images')
+    parser.add_argument('--pc-thresh', dest='pcThresh', type=float, nargs='+', default=[90])
+    parser.add_argument('--near', type=int, nargs='+', default=[10])
+    parser.add_argument('--conf-thresh', dest='confThresh', type=float, nargs='+', default=[50])
+    parser.add_argument('--bits', type=int, default=3)
+    parser.add_argument('--color', default='B')
+    parser.add_argument('--method', default='Triangle')
+    parser.add_argument('--cell-size', dest='minSize', type=int, default=9000)
+    parser.add_argument('--fluorescent', dest='bf', action='store_false')
+    parser.add_argument('--detection-cache', dest='detections',
+                        help='a folder to keep the cells found in each image in')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    detections = None
+    if args.detections:
+        from IdentiCyte.ResultCache import DiskCache
+        detections = DiskCache(args.detections)
+    Globs.end = False
+    report = sweep(args.library, args.images, args.pcThresh, args.near, args.confThresh, bits=args.bits,
+                   color=args.color, method=args.method, minSize=args.minSize, bf=args.bf, detections=detections)
+    if report is None:
+        print('The library could not be loaded or there are no images.', file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    print(formatReport(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+"""
+   File Name: TiledDetection.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Locates the cells in very large images one tile at a time
+"""
+import cv2
+import numpy as np
+from scipy.ndimage import minimum
+from IdentiCyte.CellDetection import channelImage, binarize, distance, seeds, regionStats, REGION_DTYPE
+
+# An estimate of the working memory used per pixel of a tile while it is segmented. This covers the binary masks,
+# the distance transform, the int32 watershed markers and the temporaries used by regionStats.
+BYTES_PER_PIXEL = 64
+
+# The width in pixels of the overlap around each tile, unless another is given
+HALO = 256
+
+
+def tiledHalo(shape,  # type: Tuple[int, ...]
+              maxMemory=None  # type: Optional(int)
+              ):
+    # type: (...) -> Optional(int)
+    """
+    Gives the halo an image is segmented in tiles with when finding its cells may use at most maxMemory bytes, or None
+    if it is small enough to segment in one piece or maxMemory is None.
+    """
+    if maxMemory is None or len(shape) < 2 or np.prod(shape[0:2])*BYTES_PER_PIXEL <= maxMemory:
+        return None
+    return HALO
+
+
+def thresholdLevel(hist,  # type: ndarray
+                   method='Otsu'  # type: Optional(str)
+                   ):
+    # type: (ndarray, Optional(str)) -> float
+    """
+    Finds the threshold that cv2.threshold would choose for an image with the given histogram.
+
+    This lets the threshold of a large image be found from a histogram gathered tile by tile. The Otsu and Triangle
+    methods follow the OpenCV implementations for 8 bit images.
+
+    Parameters
+    ----------
+    hist : ndarray
+        The 256 bin histogram of a uint8 image.
+    method : str
+        The algorithm used to threshold the image into binary when detecting cells. Either 'Otsu' or 'Triangle'.
+
+    Returns
+    -------
+    level : float
+        The threshold. Pixels above it are set to 255 by cv2.THRESH_BINARY.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    N = len(hist)
+    if method == 'Otsu':
+        scale = 1./np.sum(hist)
+        mu = np.sum(np.arange(N)*hist)*scale
+        mu1 = 0.
+        q1 = 0.
+        maxSigma = 0.
+        level = 0.
+        eps = np.finfo(np.float32).eps
+        for i in range(N):
+            p = hist[i]*scale
+            mu1 *= q1
+            q1 += p
+            q2 = 1. - q1
+            if min(q1, q2) < eps or max(q1, q2) > 1. - eps:
+                continue
+            mu1 = (mu1 + i*p)/q1
+            mu2 = (mu - q1*mu1)/q2
+            sigma = q1*q2*(mu1 - mu2)*(mu1 - mu2)
+            if sigma > maxSigma:
+                maxSigma = sigma
+                level = i
+        return float(level)
+    elif method == 'Triangle':
+        nonZero = np.flatnonzero(hist)
+        left = int(nonZero[0])
+        right = int(nonZero[-1])
+        if left > 0:
+            left -= 1
+        if right < N - 1:
+            right += 1
+        peak = int(np.argmax(hist))
+        peakVal = hist[peak]
+
+        # Work on the longer side of the peak
+        flipped = peak - left < right - peak
+        if flipped:
+            hist = hist[::-1]
+            left = N - 1 - right
+            peak = N - 1 - peak
+
+        level = left
+        dist = 0.
+        b = left - peak
+        for i in range(left + 1, peak + 1):
+            tempDist = peakVal*i + b*hist[i]
+            if tempDist > dist:
+                dist = tempDist
+                level = i
+        level -= 1
+        if flipped:
+            level = N - 1 - level
+        return float(level)
+    return 0.
+
+
+def tiles(shape,  # type: Tuple[int, int]
+          tileSize,  # type: int
+          halo  # type: int
+          ):
+    # type: (...) -> Iterator[(Tuple[slice, slice], Tuple[slice, slice])]
+    """
+    Splits an image into square tiles with an overlapping border.
+
+    Parameters
+    ----------
+    shape : tuple
+        The number of rows and columns in the image.
+    tileSize : int
+        The side length of the core of each tile. Every pixel of the image lies in the core of exactly one tile.
+    halo : int
+        The width of the border added around each core. The border is clipped at the image edges.
+
+    Yields
+    ------
+    core : tuple
+        The rows and columns of the core of the tile in image co-ordinates.
+    window : tuple
+        The rows and columns of the core and its border in image co-ordinates.
+    """
+    rows, cols = shape[0], shape[1]
+    for y in range(0, rows, tileSize):
+        for x in range(0, cols, tileSize):
+            core = (slice(y, min(y + tileSize, rows)), slice(x, min(x + tileSize, cols)))
+            window = (slice(max(y - halo, 0), min(y + tileSize + halo, rows)),
+                      slice(max(x - halo, 0), min(x + tileSize + halo, cols)))
+            yield core, window
+
+
+def detectTiled(image,  # type: ndarray
+                channel='B',  # type: Optional(str)
+                method='Otsu',  # type: Optional(str)
+                minSize=9000,  # type: Optional(int)
+                bf=True,  # type: Optional(bool)
+                halo=HALO,  # type: Optional(int)
+                maxMemory=2**30,  # type: Optional(int)
+                tileSize=None,  # type: Optional(int)
+                table=False  # type: Optional(bool)
+                ):
+    # type: (...) -> Union[List[List[int]], ndarray]
+    """
+    Detects cells in an image too large to segment in one piece.
+
+    The image is processed in overlapping tiles so only one tile is segmented at a time. The image itself may be a
+    numpy memmap. Three passes are made over the tiles:
+
+    1. The histogram of the whole image is gathered so every tile is thresholded at the level detect() would use.
+    2. The largest distance from the background is found, which sets the level of the watershed seeds.
+    3. Each tile is segmented and the cells whose centroid lies in its core are kept. Cells are ordered and labelled
+       as they would be when the whole image is segmented.
+
+    As long as every clump of touching cells is smaller than the halo, the result is the same as detect() on the
+    whole image.
+
+    Parameters
+    ----------
+    image : ndarray
+        A uint8 array containing the pixel values of the image. Can be 3 channel colour or grey scale
+    channel : str
+        The colour channel that will be inspected, ignored if analyzing grey scale images
+    method : str
+        The algorithm used to threshold the image into binary when detecting cells. Either 'Otsu' or 'Triangle'.
+    minSize : int
+        The minimum number of pixels in a blob for it to be considered a cell and not small debris.
+    bf : bool
+        Indicates whether the image is bright field(True) or fluorescent(False)
+    halo : int
+        The width in pixels of the overlap around each tile. This should be larger than the biggest clump of cells.
+    maxMemory : int
+        The most memory in bytes that segmenting a single tile may use. Sets the tile size if tileSize is not given.
+    tileSize : int
+        The side length of the core of each tile.
+    table : bool
+        Return the per-cell statistics table instead of the list of centroids.
+
+    Returns
+    -------
+    imInfo : list or ndarray
+        A list of the approximate centroid for each cell detected in an image, or a structured array with one row
+        per cell if table is True.
+    """
+    if np.asarray(image[:1, :1]).dtype != np.uint8:
+        raise ValueError('Tiled detection needs a uint8 image.')
+    if tileSize is None:
+        tileSize = int(np.sqrt(maxMemory/BYTES_PER_PIXEL)) - 2*halo
+    if tileSize < 1:
+        raise ValueError('maxMemory is too small for a halo of %d pixels.' % halo)
+    shape = np.shape(image)[0:2]
+    img = channelImage(image, channel)
+
+    # Threshold the tiles at the level found for the whole image
+    hist = np.zeros(256, dtype=np.int64)
+    for core, _ in tiles(shape, tileSize, 0):
+        hist += np.bincount(np.ravel(img[core]), minlength=256)
+    level = thresholdLevel(hist, method)
+
+    # Find the largest distance from the background in the whole image
+    maxDist = 0
+    for core, window in tiles(shape, tileSize, halo):
+        _, dstTransf = distance(binarize(img[window], bf=bf, level=level))
+        inner = _inner(core, window)
+        maxDist = max(maxDist, int(np.max(dstTransf[inner])))
+    fgLevel = 0.6*maxDist
+
+    cells = []
+    order = []
+    seedBlocks = []
+    for core, window in tiles(shape, tileSize, halo):
+        tile = image[window]
+        inner = _inner(core, window)
+        markers = seeds(binarize(img[window], bf=bf, level=level), fgLevel)
+
+        # Note where each seed starts. cv2.connectedComponents scans the image in 2x2 blocks, so seeds are numbered
+        # in raster order of the first block they touch.
+        labels, first = np.unique(markers, return_index=True)
+        firstY, firstX = np.unravel_index(first, markers.shape)
+        isSeed = labels > 1
+        inCore = ((firstY >= inner[0].start) & (firstY < inner[0].stop) &
+                  (firstX >= inner[1].start) & (firstX < inner[1].stop))
+        blocks = (np.arange(window[0].start, window[0].stop)[:, None]//2*((shape[1] + 1)//2) +
+                  np.arange(window[1].start, window[1].stop)[None, :]//2)
+        firstBlock = np.zeros(len(labels), dtype=np.int64)
+        if np.any(isSeed):
+            firstBlock[isSeed] = minimum(blocks, markers, labels[isSeed])
+        seedBlocks.append(firstBlock[isSeed & inCore])
+        starts = dict(zip(labels.tolist(), firstBlock.tolist()))
+
+        if (len(np.shape(tile)) != 3) or (np.shape(tile)[2] == 1):
+            tile = np.stack((tile,) * 3, axis=-1)
+        markers = cv2.watershed(np.ascontiguousarray(tile), markers)
+
+        stats = regionStats(markers, img[window])
+        stats = stats[2:][stats['area'][2:] >= minSize]
+        stats['y'] += window[0].start
+        stats['x'] += window[1].start
+        stats['ymin'] += window[0].start
+        stats['ymax'] += window[0].start
+        stats['xmin'] += window[1].start
+        stats['xmax'] += window[1].start
+
+        # Keep the cells whose centroid is in the core. Each cell is then found in exactly one tile.
+        owned = ((stats['y'] >= core[0].start) & (stats['y'] < core[0].stop) &
+                 (stats['x'] >= core[1].start) & (stats['x'] < core[1].stop))
+        stats = stats[owned]
+        cells.append(stats)
+        order.extend(starts[label] for label in stats['label'].tolist())
+
+    cells = np.concatenate(cells) if cells else np.zeros(0, dtype=REGION_DTYPE)
+    seedBlocks = np.sort(np.concatenate(seedBlocks)) if seedBlocks else np.zeros(0, dtype=np.int64)
+
+    # Number the cells as the watershed of the whole image would
+    cells['label'] = np.searchsorted(seedBlocks, order) + 2
+    cells = cells[np.argsort(cells['label'], kind='stable')]
+
+    if table:
+        return cells
+    return [[int(y), int(x)] for y, x in zip(cells['y'], cells['x'])]
+
+
+def _inner(core,  # type: Tuple[slice, slice]
+           window  # type: Tuple[slice, slice]
+           ):
+    # type: (...) -> Tuple[slice, slice]
+    """
+    Gives the core of a tile in the co-ordinates of its window.
+    """
+    return (slice(core[0].start - window[0].start, core[0].stop - window[0].start),
+            slice(core[1].start - window[1].start, core[1].stop - window[1].start))
@@ -1,13 +1,16 @@
 """
    File Name: ToGreyScale.py
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Converts an RGB image to depth-bit greyscale.
 """
 import numpy as np
 
+# Every value a pixel of an 8 bit image can take
+_LEVELS = np.arange(256, dtype=np.float64)
+
 
 def greyalize(imArray,  # type: ndarray
               depth=3,  # type: Opional(int)
@@ -33,13 +36,174 @@ def greyalize(imArray,  # type: ndarray
         ndarray
             An array representing the grey scale image with 2^depth distinct values of grey
         """
-    if depth < 1:
-        depth = 1
-    elif depth > 8:
-        depth = 8
-    greyShades = pow(2, depth)
-    greyDist = 256/greyShades
+    greyim = greyChannel(imArray, colour)
+    if greyim.dtype == np.uint8:
+        return greyTable(greyim, depth)[greyim]
+
+    greyShades, greyDist = _shades(depth)
+    mini = np.min(greyim)
+    norm = greyim - mini
+    out = np.ceil((norm/np.max(norm)) * greyShades)*greyDist
+    out[out > 255] = 255
+    return out.astype(int)
+
+
+def greyRow(imArray,  # type: ndarray
+            depth=3,  # type: Opional(int)
+            colour='B',  # type: Opional(str)
+            out=None  # type: Optional(ndarray)
+            ):
+    # type: (...) -> ndarray
+    """
+    Converts an image to greyscale as greyalize does, divides it by its maximum and flattens it into a row.
+
+    8 bit images are converted with a lookup table, so the only full size array made is the row itself. The result
+    is identical to greyalize(imArray, depth, colour)/max, flattened.
+
+    Parameters
+    ----------
+    imArray : ndarray
+        An array containing the pixel values of the image. Can be 3 channel colour or grey scale
+    depth : int
+        The bit depth of the grey scale image
+    colour : str
+        The colour channel that will be inspected, ignored if analyzing grey scale images
+    out : ndarray
+        A contiguous array with one element per pixel to write the row into, such as a row of the matrix of cells.
+        A new float64 row is made if None.
+
+    Returns
+    -------
+    row : ndarray
+        The normalized grey scale image as a row, which is out if it was given.
+    """
+    greyim = greyChannel(imArray, colour)
+    if out is None:
+        out = np.empty(greyim.size)
+    if greyim.dtype == np.uint8:
+        table = greyTable(greyim, depth)
+        table = (table/table[np.max(greyim)]).astype(out.dtype, copy=False)
+        np.take(table, greyim, out=out.reshape(greyim.shape))
+    else:
+        grey = greyalize(greyim, depth)
+        out[:] = np.ravel(grey/np.max(grey))
+    return out
+
+
+def greyRows(crops,  # type: ndarray
+             depth=3,  # type: Opional(int)
+             out=None,  # type: Optional(ndarray)
+             rows=None  # type: Optional(ndarray)
+             ):
+    # type: (...) -> ndarray
+    """
+    Converts a stack of single channel crops as greyRow does for each, building the lookup tables of 8 bit crops
+    together.
+
+    Parameters
+    ----------
+    crops : ndarray
+        The crops, with shape (number of crops, height, width)
+    depth : int
+        The bit depth of the grey scale images
+    out : ndarray
+        The matrix the rows are written to. A new float64 matrix with one row per crop is made if None.
+    rows : ndarray
+        The row of out each crop is written to. The crops fill the first rows of out if None.
+
+    Returns
+    -------
+    out : ndarray
+        The matrix of rows
+    """
+    count = len(crops)
+    if out is None:
+        out = np.empty([count, np.size(crops[0]) if count else 0])
+    if rows is None:
+        rows = np.arange(count)
+    if count == 0:
+        return out
+    if crops.dtype != np.uint8:
+        for crop, row in zip(crops, rows):
+            greyRow(crop, depth, out=out[row])
+        return out
+
+    flat = np.reshape(crops, [count, -1])
+    tables, maxi = _greyTables(flat, depth)
+    tables = (tables/tables[np.arange(count), maxi][:, None]).astype(out.dtype, copy=False)
+    for k in range(count):
+        np.take(tables[k], flat[k], out=out[rows[k]])
+    return out
 
+
+def greyLevels(crops,  # type: ndarray
+               depth=3  # type: Opional(int)
+               ):
+    # type: (...) -> ndarray
+    """
+    Converts a stack of single channel 8 bit crops to grey scale as greyalize does for each, without normalizing them.
+
+    Parameters
+    ----------
+    crops : ndarray
+        The crops, with shape (number of crops, height, width)
+    depth : int
+        The bit depth of the grey scale images
+
+    Returns
+    -------
+    levels : ndarray
+        The grey scale crops, flattened into one row per crop. These are uint8 unless a crop was a single shade.
+    """
+    flat = np.reshape(crops, [len(crops), int(np.prod(np.shape(crops)[1:]))])
+    tables, _ = _greyTables(flat, depth)
+    levels = np.empty(np.shape(flat), dtype=tables.dtype)
+    for k in range(len(flat)):
+        np.take(tables[k], flat[k], out=levels[k])
+    if np.all((levels >= 0) & (levels <= 255)):
+        levels = levels.astype(np.uint8)
+    return levels
+
+
+def levelRows(levels,  # type: ndarray
+              out=None,  # type: Optional(ndarray)
+              rows=None  # type: Optional(ndarray)
+              ):
+    # type: (...) -> ndarray
+    """
+    Divides each row of greyLevels by its maximum, giving the same rows as greyRows.
+
+    Parameters
+    ----------
+    levels : ndarray
+        The grey scale crops from greyLevels
+    out : ndarray
+        The matrix the rows are written to. A new float64 matrix is made if None.
+    rows : ndarray
+        The row of out each crop is written to. The crops fill the first rows of out if None.
+
+    Returns
+    -------
+    out : ndarray
+        The matrix of rows
+    """
+    if out is None:
+        out = np.empty(np.shape(levels))
+    if rows is None:
+        rows = np.arange(len(levels))
+    for k in range(len(levels)):
+        row = levels[k].astype(int)
+        np.divide(row, np.max(row), out=out[rows[k]], casting='unsafe')
+    return out
+
+
+def greyChannel(imArray,  # type: ndarray
+                colour='B'  # type: Opional(str)
+                ):
+    # type: (...) -> ndarray
+    """
+    Selects the colour channel that will be inspected. Grey scale images are returned as they are.
+    """
     # Channel selection
     if colour == 'R':
         channel = 0
@@ -51,14 +215,73 @@ def greyalize(imArray,  # type: ndarray
     # Check if a channel needs to be selected
     if len(imArray.shape) == 3:
         try:
-            greyim = imArray[:, :, channel]
+            return imArray[:, :, channel]
         except IndexError:
-            greyim = imArray[:, :, 0]
-    else:
-        greyim = imArray[:, :]
+            return imArray[:, :, 0]
+    return imArray[:, :]
 
-    mini = np.min(greyim)
-    norm = greyim - mini
-    out = np.ceil((norm/np.max(norm)) * greyShades)*greyDist
-    out[out > 255] = 255
-    return out.astype(int)
+
+def greyTable(greyim,  # type: ndarray
+              depth=3  # type: Opional(int)
+              ):
+    # type: (...) -> ndarray
+    """
+    Makes the lookup table that converts each value of an 8 bit grey scale image to its reduced bit depth shade.
+
+    The table is computed with the same operations greyalize applies to every pixel, so looking the pixels up gives
+    the same result.
+
+    Parameters
+    ----------
+    greyim : ndarray
+        A single channel 8 bit image
+    depth : int
+        The bit depth of the output
+
+    Returns
+    -------
+    table : ndarray
+        The shade of each of the 256 pixel values. Only the entries between the minimum and maximum of the image are
+        meaningful.
+    """
+    greyShades, greyDist = _shades(depth)
+    mini = int(np.min(greyim))
+    spread = float(np.max(greyim)) - mini
+    # An image of a single shade has no spread. Its table is left as the division gives it, without warnings.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.ceil(((_LEVELS - mini)/spread) * greyShades)*greyDist
+        out[out > 255] = 255
+        return out.astype(int)
+
+
+def _greyTables(flat,  # type: ndarray
+                depth  # type: int
+                ):
+    # type: (ndarray, int) -> (ndarray, ndarray)
+    """
+    Makes the lookup table of each row of 8 bit pixels with the same arithmetic as greyTable, for all the rows at once.
+    The tables are returned with the maximum of each row.
+    """
+    mini = np.min(flat, axis=1)
+    maxi = np.max(flat, axis=1)
+    greyShades, greyDist = _shades(depth)
+    spread = maxi.astype(np.float64) - mini
+    # As in greyTable, the tables of rows of a single shade are left as the division gives them
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tables = np.ceil(((_LEVELS - mini[:, None].astype(int))/spread[:, None]) * greyShades)*greyDist
+        tables[tables > 255] = 255
+        return tables.astype(int), maxi
+
+
+def _shades(depth  # type: int
+            ):
+    # type: (int) -> (int, float)
+    """
+    Finds the number of shades of grey and the distance between them for a bit depth, limited to between 1 and 8.
+    """
+    if depth < 1:
+        depth = 1
+    elif depth > 8:
+        depth = 8
+    greyShades = pow(2, depth)
+    return greyShades, 256/greyShades
@@ -0,0 +1,249 @@
+"""
+   File Name: Validation.py
+   Version: 1.0
+   Author: Guillaume Garnier
+   Date Modified: 2026-10-18
+   License: GNU-GPL-3.0-or-later
+   Python Version 3.5
+   Description: Checks how much the results change when the library is compiled in single precision
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+import cv2
+import numpy as np
+from IdentiCyte.ConstructLibrary import compileLibrary, libraryImages
+from IdentiCyte.LibraryStore import loadLibrary
+from IdentiCyte.ProcessFiles import iterProcessFiles
+import IdentiCyte.Instrument as Instrument
+
+
+def runPrecision(l_dir,  # type: str
+                 pics_dir,  # type: str
+                 precision,  # type: str
+                 work,  # type: str
+                 **settings
+                 ):
+    # type: (...) -> (dict, List[(str, List[str], ndarray)])
+    """
+    Compiles a copy of the library in one precision and identifies the cells in a folder of images with it.
+
+    Parameters
+    ----------
+    l_dir : str
+        The library folder. It is copied, so its own compiled library is left as it is.
+    pics_dir : str
+        The folder of images
+    precision : str
+        'float64' or 'float32'
+    work : str
+        A folder to copy the library into
+    settings
+        The keyword arguments of iterProcessFiles, such as method and minSize
+
+    Returns
+    -------
+    run : dict
+        The 'precision', the 'compileSeconds', the 'seconds' taken to identify the cells, the part of it spent
+        projecting cells onto the library ('projectionSeconds') and the size of the compiled arrays ('libraryBytes').
+    results : list
+        The file name, cell types and confidences of each image
+    """
+    categories, _ = libraryImages(l_dir)
+    copy = os.path.join(work, precision)
+    for category in categories:
+        shutil.copytree(os.path.join(l_dir, category), os.path.join(copy, category))
+    report = compileLibrary(copy, precision=precision)
+    arrays = loadLibrary(copy).manifest['arrays']
+    libraryBytes = sum(os.path.getsize(os.path.join(copy, arrays[key])) for key in ('SCORE', 'eigenV', 'meanV'))
+
+    # Time the projection on its own, keeping anything already recorded
+    recorded = Instrument.snapshot()
+    wasEnabled = Instrument.enabled
+    Instrument.reset()
+    Instrument.enable()
+    start = timeit.default_timer()
+    try:
+        results = [(name, types, conf) for _, name, types, conf, _, _ in iterProcessFiles(copy, pics_dir, categories,
+                                                                                          **settings)]
+    finally:
+        seconds = timeit.default_timer() - start
+        stages = Instrument.snapshot()
+        Instrument.reset()
+        Instrument.merge(recorded)
+        if not wasEnabled:
+            Instrument.disable()
+    run = {'precision': precision,
+           'compileSeconds': report['seconds'] if report else 0.,
+           'seconds': seconds,
+           'projectionSeconds': stages.get('projection', {}).get('seconds', 0.),
+           'libraryBytes': libraryBytes}
+    return run, results
+
+
+def compareRuns(reference,  # type: List[(str, List[str], ndarray)]
+                candidate  # type: List[(str, List[str], ndarray)]
+                ):
+    # type: (...) -> dict
+    """
+    Compares the cell types and confidences found in the same images by two runs.
+
+    Parameters
+    ----------
+    reference : list
+        The file name, cell types and confidences of each image in the reference run
+    candidate : list
+        The same for the run being checked
+
+    Returns
+    -------
+    comparison : dict
+        The number of 'cells', the fraction whose type is the same ('agreement'), the 'meanDrift', 'p95Drift' and
+        'maxDrift' of the absolute change in confidence in percentage points, and each cell whose type changed
+        ('disagreements').
+    """
+    drift = []
+    disagreements = []
+    for (name, refTypes, refConf), (_, types, conf) in zip(reference, candidate):
+        refConf = np.ravel(refConf)
+        conf = np.ravel(conf)
+        for k in range(len(refTypes)):
+            drift.append(abs(float(conf[k]) - float(refConf[k])))
+            if types[k] != refTypes[k]:
+                disagreements.append({'image': name, 'cell': k, 'reference': refTypes[k], 'candidate': types[k],
+                                      'referenceConfidence': float(refConf[k]), 'candidateConfidence': float(conf[k])})
+    cells = len(drift)
+    drift = np.asarray(drift)
+    return {'cells': cells,
+            'agreement': 1 - len(disagreements)/cells if cells else 1.,
+            'meanDrift': float(np.mean(drift)) if cells else 0.,
+            'p95Drift': float(np.percentile(drift, 95)) if cells else 0.,
+            'maxDrift': float(np.max(drift)) if cells else 0.,
+            'disagreements': disagreements}
+
+
+def validatePrecision(l_dir,  # type: str
+                      pics_dir,  # type: str
+                      window=None,  # type: Optional(MainWindow)
+                      **settings
+                      ):
+    # type: (...) -> dict
+    """
+    Identifies the cells in a reference folder of images with the library compiled in double and in single precision,
+    and compares the results.
+
+    Parameters
+    ----------
+    l_dir : str
+        The library folder. Its own compiled library is not changed.
+    pics_dir : str
+        The reference folder of images
+    window : MainWindow
+        Shows progress if given
+    settings
+        The keyword arguments of iterProcessFiles, such as method and minSize
+
+    Returns
+    -------
+    report : dict
+        The 'runs' in each precision, as from runPrecision, and the 'comparison' of float32 against float64 from
+        compareRuns.
+    """
+    runs = {}
+    results = {}
+    with tempfile.TemporaryDirectory() as work:
+        for precision in ('float64', 'float32'):
+            if window:
+                window.printout('Identifying cells in %s precision' % precision)
+            runs[precision], results[precision] = runPrecision(l_dir, pics_dir, precision, work, **settings)
+    return {'created': datetime.now().isoformat(),
+            'library': os.path.abspath(l_dir),
+            'images': os.path.abspath(pics_dir),
+            'settings': settings,
+            'runs': runs,
+            'comparison': compareRuns(results['float64'], results['float32'])}
+
+
+def formatReport(report  # type: dict
+                 ):
+    # type: (dict) -> str
+    """
+    Lays out a validation report as text.
+    """
+    lines = ['%-10s %12s %12s %14s %14s' % ('Precision', 'Compile (s)', 'Identify (s)', 'Projection (s)',
+                                            'Library (MB)')]
+    for precision in ('float64', 'float32'):
+        run = report['runs'][precision]
+        lines.append('%-10s %12.3f %12.3f %14.4f %14.2f' % (precision, run['compileSeconds'], run['seconds'],
+                                                            run['projectionSeconds'], run['libraryBytes']/2**20))
+    comparison = report['comparison']
+    lines.append('')
+    lines.append('%d cells, %.2f%% with the same type. Confidence drift: mean %.4f, 95th percentile %.4f, max %.4f '
+                 'percentage points.' % (comparison['cells'], 100*comparison['agreement'], comparison['meanDrift'],
+                                         comparison['p95Drift'], comparison['maxDrift']))
+    for cell in comparison['disagreements']:
+        lines.append('  %s cell %d: %s (%.1f%%) -> %s (%.1f%%)' % (cell['image'], cell['cell'], cell['reference'],
+                                                                   cell['referenceConfidence'], cell['candidate'],
+                                                                   cell['candidateConfidence']))
+    return '\n'.join(lines)
+
+
+def main(argv=None  # type: Optional(List[str])
+         ):
+    # type: (...) -> int
+    """
+    Runs the validation from the command line. Returns 1 if fewer cells than --min-agreement keep their type.
+    """
+    parser = argparse.ArgumentParser(prog='python -m IdentiCyte.Validation',
+                                     description='Compares identifying cells with a single and a double precision '
+                                                 'library.')
+    parser.add_argument('--library', help='the library folder')
+    parser.add_argument('--images', help='the reference folder of images')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='use a synthetic library and images instead, as in the benchmarks')
+    parser.add_argument('--bits', type=int, default=3)
+    parser.add_argument('--color', default='B')
+    parser.add_argument('--method', default='Triangle')
+    parser.add_argument('--cell-size', dest='minSize', type=int, default=9000)
+    parser.add_argument('--pc-thresh', dest='pcThresh', type=float, default=90)
+    parser.add_argument('--conf-thresh', dest='confThresh', type=float, default=50)
+    parser.add_argument('--near', type=int, default=10)
+    parser.add_argument('--fluorescent', dest='bf', action='store_false')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--min-agreement', dest='minAgreement', type=float, default=0.99,
+                        help='the fraction of cells that must keep their type')
+    args = parser.parse_args(argv)
+    settings = {'bits': args.bits, 'color': args.color, 'method': args.method, 'minSize': args.minSize,
+                'pcThresh': args.pcThresh, 'confThresh': args.confThresh, 'near': args.near, 'bf': args.bf}
+
+    if args.synthetic:
+        from IdentiCyte.Benchmark import syntheticLibrary, syntheticField
+        with tempfile.TemporaryDirectory() as work:
+            l_dir = os.path.join(work, 'Library')
+            pics_dir = os.path.join(work, 'Images')
+            syntheticLibrary(l_dir, bits=args.bits)
+            os.mkdir(pics_dir)
+            for k in range(4):
+                cv2.imwrite(os.path.join(pics_dir, '%d.tif' % k), syntheticField(seed=k, bf=args.bf))
+            settings['minSize'] = int(0.5*np.pi*30**2)
+            report = validatePrecision(l_dir, pics_dir, **settings)
+    elif args.library and args.images:
+        report = validatePrecision(args.library, args.images, **settings)
+    else:
+        parser.error('give --library and --images, or --synthetic')
+        return 2
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    print(formatReport(report))
+    return 0 if report['comparison']['agreement'] >= args.minAgreement else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
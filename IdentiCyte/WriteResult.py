@@ -1,16 +1,19 @@
 """
    File Name: WriteResults.py
    Author: Guillaume Garnier
-   Date Modified: 2019-02-08
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
    Description: Writes the results of the analysis to the summary Excel sheet and pickle file
 """
-import xlsxwriter
 import numpy as np
 import os
 import pickle
-import re
+from IdentiCyte.ProcessFiles import imageNames
+from IdentiCyte.CellTable import writeCellTable
+import IdentiCyte.Instrument as Instrument
+
+RESULTS_NAME = 'IdentifiedCellInfo.pkl'
 
 
 def WriteResults(stat,
@@ -28,7 +31,9 @@ def WriteResults(stat,
                  method,  # type: str
                  cellSize,  # type: int
                  near,  # type: int
-                 bf  # type: bool
+                 bf,  # type: bool
+                 areas=None,  # type: Optional(List[List[int]])
+                 names=None  # type: Optional(List[str])
                  ):
     # type: (...) -> None
     """
@@ -74,170 +79,238 @@ def WriteResults(stat,
         The minimum number of pixels in a blob for it to be considered a cell and not small debris.
     bf : bool
         Indicates whether the image is bright field(True) or fluorescent(False)
+    areas : list
+        A list of lists. Each list corresponds to one of the images analysed and has the number of pixels in each cell
+        in the corresponding image. The cell table has no areas if not given.
+    names : list
+        The file name of each image analysed, in the same order as results. The images in pics_dir if not given.
 
     Returns
     -------
-    Outputs a .xls file with a summary of the analysis
+    Outputs a .xls file with a summary of the analysis, and the cells to IdentifiedCellInfo.pkl and IdentifiedCells.ict
    """
-    for j in range(len(results)):
-        if type(results[j]) is np.ndarray:
-            results[j] = results[j].tolist()
-
-    for j in range(len(results)):
-        for k in range(len(results[j])):
-            results[j][k] = [results[j][k], ' %.1lf%%' % conf[j][k], [int(locations[j][k][0]), int(locations[j][k][1])]]
+    records = [cellRecords(results[j], conf[j], locations[j]) for j in range(len(results))]
 
     # Make the file's name
-    dataName = os.path.split(pics_dir)[-1]
-    results_file = os.path.abspath(os.path.join(pics_dir, 'IdentifiedCellInfo.pkl'))
-
-    results.append(typeArray)
-    with open(results_file, 'wb') as f:
-        pickle.dump(results, f)
-
-    # Calculate the average confidence per image
-    for lst in range(len(conf)):
-        if len(conf[lst]):
-            tmpMean = 0
-            # Get the average of all non edge cells
-            for perc in range(len(conf[lst])):
-                if 'Edg' not in results[lst][perc]:
-                    tmpMean = tmpMean + conf[lst][perc]
-            if len(conf[lst]) > 0:
-                tmpMean = tmpMean/len(conf[lst])
+    results_file = os.path.abspath(os.path.join(pics_dir, RESULTS_NAME))
+
+    records.append(typeArray)
+    with Instrument.stage('pickle'):
+        with open(results_file, 'wb') as f:
+            pickle.dump(records, f)
+
+    if names is None:
+        names = imageNames(pics_dir)
+    writeCellTable(pics_dir, typeArray, names, results, conf, locations, areas, library=os.path.abspath(l_dir),
+                   pcThresh=pcThresh, confThresh=confThresh, userver=userver, bits=bits, color=color, method=method,
+                   cellSize=cellSize, near=near, bf=bf)
+
+    imageConf = [imageConfidence(conf[lst]) for lst in range(len(conf))]
+    writeWorkbook(stat, typeArray, names, imageConf, pics_dir, l_dir, pcThresh, confThresh,
+                  userver, bits, color, method, cellSize, near, bf)
+
+
+def cellRecords(results,  # type: List[str]
+                conf,  # type: ndarray
+                locations  # type: List[List[int]]
+                ):
+    # type: (...) -> List[list]
+    """
+    Combines the results for one image into the entries saved in IdentifiedCellInfo.pkl.
+
+    Parameters
+    ----------
+    results : list
+        The classification of each cell in the image
+    conf : ndarray
+        The confidence of each cell in the image
+    locations : list
+        The location of each cell in the image
+
+    Returns
+    -------
+    records : list
+        A [classification, confidence, location] list for each cell.
+    """
+    if type(results) is np.ndarray:
+        results = results.tolist()
+    conf = np.ravel(conf)
+    return [[results[k], ' %.1lf%%' % conf[k], [int(locations[k][0]), int(locations[k][1])]]
+            for k in range(len(results))]
+
+
+def imageConfidence(conf  # type: ndarray
+                    ):
+    # type: (ndarray) -> float
+    """
+    Averages the confidence of the cells in one image. The mean is taken over every cell, edge cells included.
+    """
+    if not len(conf):
+        return 0
+    tmpMean = 0
+    for perc in range(len(conf)):
+        tmpMean = tmpMean + conf[perc]
+    tmpMean = tmpMean/len(conf)
+    try:
+        return tmpMean[0]
+    except:
+        return tmpMean
+
+
+def writeWorkbook(stat,  # type: ndarray
+                  typeArray,  # type: List[str]
+                  img_names,  # type: List[str]
+                  conf,  # type: List[float]
+                  pics_dir,  # type: str
+                  l_dir,  # type: str
+                  pcThresh,  # type: float
+                  confThresh,  # type: float
+                  userver,  # type: bool
+                  bits,  # type: int
+                  color,  # type: str
+                  method,  # type: str
+                  cellSize,  # type: int
+                  near,  # type: int
+                  bf  # type: bool
+                  ):
+    # type: (...) -> None
+    """
+    Writes the summary Excel spreadsheet.
+
+    Parameters
+    ----------
+    stat : ndarray
+        The number of cells of each type in each image, as in WriteResults.
+    typeArray : list
+        A list of strings, each of which represents a category
+    img_names : list
+        The file name of each image
+    conf : list
+        The mean confidence of the cells in each image, from imageConfidence
+
+    The remaining parameters are as described in WriteResults.
+    """
+    with Instrument.stage('workbook'):
+        dataName = os.path.split(pics_dir)[-1]
+        img_names = list(img_names)
+
+        # Find the average confidence for the folder
+        conf = np.insert(conf, 0, np.mean(conf))
+
+        # Complete the confidence column
+        confStr = ['%.1lf%%' % np.mean(conf[lst]) for lst in range(len(conf))]
+        confStr.insert(0, 'Confidence Per Image')
+
+        # Calculate the total number of cells in each image
+        totalNums = []
+        for j in range(len(stat[0])):
+            runCount = 0
+            for k in range(len(stat)):
+                runCount += stat[k][j]
+            totalNums.append(int(runCount))
+
+        # Find the total number of cells in the folder
+        totalNums.insert(0, sum(totalNums))
+
+        # Get the total number of each type of cell in the folder
+        outStat = []
+        for j in range(len(stat)):
+            outStat.append(np.insert(stat[j], 0, sum(stat[j])))
+
+        # Convert number of cells per image to a percentage
+        for j in range(1, len(outStat[0])):
+            if not (totalNums[j] == 0):
+                for k in range(len(outStat)):
+                    outStat[k][j] /= totalNums[j]
+                    outStat[k][j] *= 100
+
+        # Find the total number of desirable cells (All cells not in the 'Other', 'Edge' or 'Ignore' categories)
+        totalNums.insert(1, int(totalNums[0] - outStat[-1][0] - outStat[-2][0]))
+        totalNums.insert(0, '')
+        for j in range(len(outStat)):
+            outStat[j] = outStat[j].tolist()
+
+        # Convert the output stats to strings
+        for j in range(len(outStat)):
+            for k in range(1, len(outStat[0])):
+                outStat[j][k] = '%.1lf%%' % outStat[j][k]
+
+        # Add the percentage of each type of cell counted
+        for j in range(len(outStat)):
+            if totalNums[2] > 0:
+                outStat[j].insert(1, np.round(outStat[j][0]*100/totalNums[2], 2))
             else:
-                tmpMean = 0
-            try:
-                conf[lst] = tmpMean[0]
-            except:
-                conf[lst] = tmpMean
-        else:
-            conf[lst] = 0
-
-    # Find the average confidence for the folder
-    conf = np.insert(conf, 0, np.mean(conf))
-
-    # Complete the confidence column
-    confStr = ['%.1lf%%' % np.mean(conf[lst]) for lst in range(len(conf))]
-    confStr.insert(0, 'Confidence Per Image')
-
-    # Calculate the total number of cells in each image
-    totalNums = []
-    for j in range(len(stat[0])):
-        runCount = 0
-        for k in range(len(stat)):
-            runCount += stat[k][j]
-        totalNums.append(int(runCount))
-
-    # Find the total number of cells in the folder
-    totalNums.insert(0, sum(totalNums))
-
-    # Get the total number of each type of cell in the folder
-    outStat = []
-    for j in range(len(stat)):
-        outStat.append(np.insert(stat[j], 0, sum(stat[j])))
-
-    # Convert number of cells per image to a percentage
-    for j in range(1, len(outStat[0])):
-        if not (totalNums[j] == 0):
-            for k in range(len(outStat)):
-                outStat[k][j] /= totalNums[j]
-                outStat[k][j] *= 100
-
-    # Find the total number of desirable cells (All cells not in the 'Other', 'Edge' or 'Ignore' categories)
-    totalNums.insert(1, int(totalNums[0] - outStat[-1][0] - outStat[-2][0]))
-    totalNums.insert(0, '')
-    for j in range(len(outStat)):
-        outStat[j] = outStat[j].tolist()
-
-    # Convert the output stats to strings
-    for j in range(len(outStat)):
-        for k in range(1, len(outStat[0])):
-            outStat[j][k] = '%.1lf%%' % outStat[j][k]
-
-    # Add the percentage of each type of cell counted
-    for j in range(len(outStat)):
-        if totalNums[2] > 0:
-            outStat[j].insert(1, np.round(outStat[j][0]*100/totalNums[2], 2))
-        else:
-            outStat[j].insert(1, '0')
-        outStat[j].insert(0, typeArray[j])
-    outStat[-1][2] = '-'
-    outStat[-2][2] = '-'
-
-    # Get the names of files
-    img_names = os.listdir(pics_dir)
-    for entry in range(len(img_names) - 1, -1, -1):
-        exp = re.compile("\.png$|\.tif$|\.jpg$|\.jpeg$|\.tiff$", re.I)
-        an_image = bool(exp.search(img_names[entry]))
-        if os.path.isdir(os.path.abspath(os.path.join(pics_dir, img_names[entry]))) or not an_image:
-            img_names.pop(entry)
-
-    # Complete the first column
-    img_names.insert(0, 'Percent of Identified Cells')
-    img_names.insert(0, 'Cells Per Category')
-    img_names.insert(0, 'Library Categories')
-
-    # Combine all the matrices for outputting
-    outStat.insert(0, img_names)
-    outStat.append(totalNums)
+                outStat[j].insert(1, '0')
+            outStat[j].insert(0, typeArray[j])
+        outStat[-1][2] = '-'
+        outStat[-2][2] = '-'
 
-    # Make the file's name
-    file_name = os.path.abspath(os.path.join(pics_dir, dataName + '.xlsx'))
-
-    # Write out to the excel doc
-    workbook = xlsxwriter.Workbook(file_name)
-    summarySheet = workbook.add_worksheet("Summary")
-    detailedSheet = workbook.add_worksheet("Per Image Breakdown")
-
-    # Define the settings summary############
-    namesCol = ['Image Location',
-                'Library Location',
-                'User Verification',
-                'Bit Depth',
-                'Color Channel',
-                'Thresholding Method',
-                'Minimum Cell Size',
-                'Confidence Percent',
-                'Principal Component Percent',
-                'Illumination',
-                'Number of Similar Images Considered']
-
-    yn = ['Disabled', 'Enabled']
-    illum = ['Fluorescent', 'Bright Field']
-    settingsCol = [pics_dir,
-                   l_dir,
-                   yn[userver],
-                   bits,
-                   color,
-                   method,
-                   cellSize,
-                   confThresh,
-                   pcThresh,
-                   illum[bf],
-                   near]
-    row = 1
-    for k in outStat:
-        k.insert(3,' ')
-
-    # Write the summary sheet and the detailed overview
-    for col, data in enumerate(outStat[0:-1]):
-        summarySheet.write_column(row, col, data[0:3])
-        detailedSheet.write_column(row-1, col, [data[0]]+data[4:])
-
-    #confStr.insert(2, ' ')
-    summarySheet.write_column(row, len(outStat), outStat[-1][0:3])
-    detailedSheet.write_column(0, len(outStat), ['Cells per Image'] + outStat[-1][4:])
-    detailedSheet.write_column(0, len(outStat)+2, [confStr[0]]+confStr[2:])
-    detailedSheet.write_column(0,0, ["Image Name"])
-
-    summarySheet.write_row(0, 0, ["Dataset Name", dataName])
-    summarySheet.write_row(5, 0, ['Mean Confidence of all Images'])
-    summarySheet.write_row(5, 1, [confStr[1]])
-    summarySheet.write_column(2, len(outStat)+1, ['Total Cells in Batch', 'Cells Identified'])
-    summarySheet.write_column(9,0, namesCol)
-    summarySheet.write_column(9, 1, settingsCol)
-    img_names.pop(1)
-    img_names[1] = 'Overall Confidence'
-
-    workbook.close()
+        # Complete the first column
+        img_names.insert(0, 'Percent of Identified Cells')
+        img_names.insert(0, 'Cells Per Category')
+        img_names.insert(0, 'Library Categories')
+
+        # Combine all the matrices for outputting
+        outStat.insert(0, img_names)
+        outStat.append(totalNums)
+
+        # Make the file's name
+        file_name = os.path.abspath(os.path.join(pics_dir, dataName + '.xlsx'))
+
+        # Write out to the excel doc
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(file_name)
+        summarySheet = workbook.add_worksheet("Summary")
+        detailedSheet = workbook.add_worksheet("Per Image Breakdown")
+
+        # Define the settings summary############
+        namesCol = ['Image Location',
+                    'Library Location',
+                    'User Verification',
+                    'Bit Depth',
+                    'Color Channel',
+                    'Thresholding Method',
+                    'Minimum Cell Size',
+                    'Confidence Percent',
+                    'Principal Component Percent',
+                    'Illumination',
+                    'Number of Similar Images Considered']
+
+        yn = ['Disabled', 'Enabled']
+        illum = ['Fluorescent', 'Bright Field']
+        settingsCol = [pics_dir,
+                       l_dir,
+                       yn[userver],
+                       bits,
+                       color,
+                       method,
+                       cellSize,
+                       confThresh,
+                       pcThresh,
+                       illum[bf],
+                       near]
+        row = 1
+        for k in outStat:
+            k.insert(3,' ')
+
+        # Write the summary sheet and the detailed overview
+        for col, data in enumerate(outStat[0:-1]):
+            summarySheet.write_column(row, col, data[0:3])
+            detailedSheet.write_column(row-1, col, [data[0]]+data[4:])
+
+        #confStr.insert(2, ' ')
+        summarySheet.write_column(row, len(outStat), outStat[-1][0:3])
+        detailedSheet.write_column(0, len(outStat), ['Cells per Image'] + outStat[-1][4:])
+        detailedSheet.write_column(0, len(outStat)+2, [confStr[0]]+confStr[2:])
+        detailedSheet.write_column(0,0, ["Image Name"])
+
+        summarySheet.write_row(0, 0, ["Dataset Name", dataName])
+        summarySheet.write_row(5, 0, ['Mean Confidence of all Images'])
+        summarySheet.write_row(5, 1, [confStr[1]])
+        summarySheet.write_column(2, len(outStat)+1, ['Total Cells in Batch', 'Cells Identified'])
+        summarySheet.write_column(9,0, namesCol)
+        summarySheet.write_column(9, 1, settingsCol)
+        img_names.pop(1)
+        img_names[1] = 'Overall Confidence'
+
+        workbook.close()
@@ -1,21 +1,28 @@
 """
    File Name: main.py
    Author: Guillaume Garnier
-   Date Modified: 2018-12-13
+   Date Modified: 2026-10-18
    License: GNU-GPL-3.0-or-later
    Python Version 3.5
-   Description: The main document of the project. Runs everything else.
+   Description: The main document of the project. Runs everything else. With arguments, runs the analysis from the
+   command line without the GUI (see CommandLine).
 """
-from tkinter import Tk
-from mttkinter import *
-from IdentiCyte.MainUI import MainWindow
+import sys
 
 
 def main():
+    # The GUI is only imported when it is used, so the command line runs without a display
+    from tkinter import Tk
+    import mttkinter  # Patches tkinter so the analysis threads can update the GUI
+    from IdentiCyte.MainUI import MainWindow
+
     root = Tk()
     my_gui = MainWindow(root)
     root.mainloop()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        from IdentiCyte.CommandLine import main as commandLine
+        sys.exit(commandLine())
+    main()
@@ -6,9 +6,32 @@ from IdentiCyte.CellDetection import *
 from IdentiCyte.CellStatistics import *
 from IdentiCyte.ToGreyScale import *
 from IdentiCyte.ProcessFiles import *
+from IdentiCyte.TiledDetection import *
+from IdentiCyte.LibraryIndex import *
+from IdentiCyte.LibraryStore import *
+from IdentiCyte.ConstructLibrary import *
+from IdentiCyte.ResultSinks import *
+from IdentiCyte.Prefetch import *
+from IdentiCyte.Benchmark import syntheticField, compareResults, importTime, IMPORT_MODULES
+import IdentiCyte.Instrument as Instrument
+from IdentiCyte.CommandLine import main as commandLine
+from IdentiCyte.Validation import compareRuns
+from IdentiCyte.FolderBatch import batch, batchFolders
+from IdentiCyte.ResultCache import DiskCache, CachedReader, detectionSettingsKey
+from IdentiCyte.Sweep import sweep
+from IdentiCyte.CondenseLibrary import condenseLibrary, condensePrototypes
+from IdentiCyte.Benchmark import syntheticLibrary
+from IdentiCyte.CellTable import CellTableSink, readCellTable
+from IdentiCyte.ResultsDatabase import ResultsDatabase, DatabaseSink
+import json
 import cv2
 import os
 import pickle
+import tempfile
+import shutil
+import contextlib
+import io
+import IdentiCyte.Globs as Globs
 
 
 class gcdTest(unittest.TestCase):
@@ -34,6 +57,22 @@ class detectTest(unittest.TestCase):
         self.assertEqual(analyze(tstarr, 20), [[22, 33]])
         self.assertEqual(analyze(tstarr, 8), [[22, 33], [82, 72]])
 
+    def testregionstats(self):
+        tstarr = np.ones([100, 100], dtype=int)
+        tstarr[0, :] = -1
+        tstarr[20:25, 31:36] = 2
+        tstarr[80:84, 72:74] = 3
+        intensity = np.zeros([100, 100])
+        intensity[20:25, 31:36] = 7
+        stats = regionStats(tstarr, intensity)
+        np.testing.assert_array_equal(stats['label'], [-1, 1, 2, 3])
+        np.testing.assert_array_equal(stats['area'], [100, 9867, 25, 8])
+        self.assertEqual([stats['ymin'][2], stats['xmin'][2], stats['ymax'][2], stats['xmax'][2]], [20, 31, 24, 35])
+        self.assertEqual(stats['intensity'][2], 7)
+        cells = analyze(tstarr, 8, table=True)
+        np.testing.assert_array_equal(cells['label'], [2, 3])
+        np.testing.assert_array_equal(cells['y'], [22, 82])
+
     def testsegment(self):
         #self.img = cv2.imread(os.path.join(os.getcwd(), 'Cell Examples', 'Cell5.png'))
         #self.greyim = self.img[:, :, 0]
@@ -66,6 +105,62 @@ class detectTest(unittest.TestCase):
         self.assertEqual(detect(img), [[109, 116]])
 
 
+class tiledDetectionTest(unittest.TestCase):
+    def testthresholdlevel(self):
+        img = cv2.imread(os.path.join(os.path.dirname(__file__), 'Cell5.png'))[:, :, 0]
+        hist = np.bincount(img.ravel(), minlength=256)
+        otsu, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+        triangle, _ = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_TRIANGLE)
+        self.assertEqual(thresholdLevel(hist, 'Otsu'), otsu)
+        self.assertEqual(thresholdLevel(hist, 'Triangle'), triangle)
+
+    def testdetecttiled(self):
+        img = np.full([400, 500], 200, np.uint8)
+        for y, x in [[60, 70], [80, 380], [200, 250], [330, 90], [340, 420], [190, 460]]:
+            cv2.circle(img, (x, y), 35, 60, -1)
+        img = np.stack((cv2.GaussianBlur(img, (5, 5), 0),) * 3, axis=-1)
+        whole = detect(img, minSize=1000, table=True)
+        self.assertEqual(len(whole), 6)
+        np.testing.assert_array_equal(detectTiled(img, minSize=1000, halo=90, tileSize=128, table=True), whole)
+        self.assertEqual(detectTiled(img, minSize=1000, halo=90, tileSize=128), detect(img, minSize=1000))
+
+    def testtilememory(self):
+        library = loadLibrary(os.path.join(os.path.dirname(__file__), 'Library'))
+        image = syntheticField(800, 800, density=20, seed=2)
+        whole = findCells(image, library, method='Otsu', minSize=1000)
+        tiled = findCells(image, library, method='Otsu', minSize=1000, tileMemory=2**25)
+        self.assertGreater(len(whole[0]), 0)
+        self.assertEqual(tiled[0], whole[0])
+        self.assertEqual(tiled[3], whole[3])
+        # The rows of cells on the edge are not written to
+        np.testing.assert_array_equal(tiled[2], whole[2])
+        np.testing.assert_array_equal(tiled[1][whole[2]], whole[1][whole[2]])
+        # Only images too large for the memory given are tiled, and the halo alone needs more than this
+        with self.assertRaises(ValueError):
+            findCells(image, library, method='Otsu', minSize=1000, tileMemory=2**20)
+        findCells(image[0:100, 0:100], library, method='Otsu', minSize=1000, tileMemory=2**20)
+        # Only the images that are tiled are cached apart from those segmented in one piece
+        self.assertIsNone(tiledHalo(image[0:100, 0:100].shape, 2**20))
+        self.assertIsNone(tiledHalo(image.shape))
+        halo = tiledHalo(image.shape, 2**25)
+        self.assertIsNotNone(halo)
+        settings = detectionSettings(3, 'B', 'Otsu', 1000, True, 10)
+        self.assertNotEqual(detectionKey('digest', settings), detectionKey('digest', settings, halo))
+        # Giving a tile memory does not change the keys of images too small to tile
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, 'small.png')
+            cv2.imwrite(path, image[0:100, 0:100])
+            detections = DiskCache(os.path.join(cache_dir, 'detections'))
+            base = detectionSettingsKey(detectionSettings(3, 'B', 'Otsu', 1000, True,
+                                                          int((np.sqrt(len(library['eigenV'])) - 1)/2)))
+            reader = CachedReader(detections=detections, detectionBase=base)
+            findCells(reader(path), library, method='Otsu', minSize=1000, detections=detections,
+                      digest=reader.digests[path])
+            reader = CachedReader(detections=detections, detectionBase=base, tileMemory=2**20)
+            self.assertIsNone(reader(path))
+            self.assertIn(path, reader.found)
+
+
 class cellStatisticsTest(unittest.TestCase):
     def teststats(self):
         types = ['Apples', 'Oranges', 'Pears']
@@ -84,8 +179,52 @@ class toGreyScaleTest(unittest.TestCase):
         greyIm = cv2.imread(os.path.join(os.path.dirname(__file__), '1_2Grey.tif'))
         np.testing.assert_array_equal(greyalize(img), greyIm[:, :, 0])
 
+    def testgreyrow(self):
+        img = cv2.imread(os.path.join(os.path.dirname(__file__), '1_2.tif'))
+        for depth, colour in [(3, 'B'), (1, 'R'), (8, 'G')]:
+            grey = greyalize(img.astype(np.int64), depth, colour)
+            expected = np.ravel(grey/np.max(grey))
+            np.testing.assert_array_equal(greyRow(img, depth, colour), expected)
+            out = np.zeros([2, img.shape[0]*img.shape[1]], dtype=np.float32)
+            greyRow(img, depth, colour, out=out[1])
+            np.testing.assert_array_equal(out[1], expected.astype(np.float32))
+
+    def testgreylevels(self):
+        img = cv2.imread(os.path.join(os.path.dirname(__file__), '1_2.tif'))
+        crops = np.stack([img[:, :, 0], img[:, :, 2], np.full(img.shape[0:2], 7, dtype=np.uint8)])
+        for depth in [1, 3, 8]:
+            levels = greyLevels(crops, depth)
+            self.assertNotEqual(levels.dtype, np.uint8)
+            for dtype in [np.float64, np.float32]:
+                out = np.zeros([4, crops[0].size], dtype=dtype)
+                expected = greyRows(crops, depth, out.copy(), np.array([0, 1, 3]))
+                np.testing.assert_array_equal(levelRows(levels, out, np.array([0, 1, 3])), expected)
+            levels = greyLevels(crops[0:2], depth)
+            self.assertEqual(levels.dtype, np.uint8)
+            np.testing.assert_array_equal(levelRows(levels), greyRows(crops[0:2], depth))
+        self.assertEqual(np.shape(greyLevels(crops[0:0])), (0, crops[0].size))
+
 
 class pcaRecognitionTest(unittest.TestCase):
+    def testnearestneighbours(self):
+        rng = np.random.RandomState(0)
+        gallery = np.round(rng.normal(size=[50, 4]))
+        gallery[25:] = gallery[:25]
+        features = np.round(rng.normal(size=[6, 4]))
+        dist, idx = nearestNeighbours(features, gallery, 7)
+        for k in range(len(features)):
+            exact = np.sum(np.power(features[k] - gallery, 2), axis=1)
+            ranked = sorted(zip(exact, range(len(exact))))[0:7]
+            self.assertEqual(idx[k].tolist(), [j for _, j in ranked])
+            self.assertEqual(dist[k].tolist(), [d for d, _ in ranked])
+
+    def testscoreneighbours(self):
+        dist = np.array([[1., 2., 4., 8.], [1., 1., 1., 1.]])
+        types = np.array([[2, 0, 2, 1], [1, 0, 0, 1]])
+        labels, confs = scoreNeighbours(dist, types, 3)
+        np.testing.assert_array_equal(labels, [2, 1])
+        np.testing.assert_almost_equal(confs, [100*(1 + 1/12)/(1 + 1/4 + 1/12 + 1/32), 100*(1 + 1/4)/(1 + 1/2 + 1/3 + 1/4)])
+
     def testpcarecognition(self):
         lib_file = os.path.join(os.path.dirname(__file__), 'Library', 'LibraryInfo.pkl')
         with open(lib_file, 'rb') as f:
@@ -110,6 +249,259 @@ class pcaRecognitionTest(unittest.TestCase):
         self.assertEqual(np.round(conf, 8), np.round(np.asarray([[62.56521685]]), 8))
 
 
+class libraryIndexTest(unittest.TestCase):
+    def testneighbours(self):
+        rng = np.random.RandomState(1)
+        gallery = np.round(rng.normal(size=[200, 3]))
+        features = np.round(rng.normal(size=[10, 3]))
+        index = LibraryIndex(gallery, 3)
+        dist, idx = index.neighbours(features, gallery, 9)
+        bruteDist, bruteIdx = nearestNeighbours(features, gallery, 9)
+        np.testing.assert_array_equal(idx, bruteIdx)
+        np.testing.assert_array_equal(dist, bruteDist)
+
+    def testloadindex(self):
+        rng = np.random.RandomState(2)
+        resDict = {'SCORE': rng.normal(size=[30, 5]), 'latent': np.array([5., 3., 1., 0.5, 0.5])}
+        with tempfile.TemporaryDirectory() as l_dir:
+            self.assertIsNone(loadIndex(l_dir, resDict))
+            buildIndex(l_dir, resDict, pcThresh=90)
+            index = loadIndex(l_dir, resDict)
+            self.assertEqual(index.pcNum, componentCount(resDict['latent'], 90))
+            self.assertTrue(index.usable(index.pcNum, 10))
+            self.assertFalse(index.usable(index.pcNum + 1, 10))
+            resDict['SCORE'][0, 0] += 1
+            self.assertIsNone(loadIndex(l_dir, resDict))
+
+    def testclusterindex(self):
+        rng = np.random.RandomState(4)
+        gallery = rng.normal(size=[2000, 4]) + 5*rng.randint(0, 3, size=[2000, 1])
+        features = rng.normal(size=[20, 4]) + 5*rng.randint(0, 3, size=[20, 1])
+        bruteDist, bruteIdx = nearestNeighbours(features, gallery, 9)
+        index = ClusterIndex(gallery, 4, clusters=20, probes=20)
+        dist, idx = index.neighbours(features, gallery, 9)
+        np.testing.assert_array_equal(idx, bruteIdx)
+        np.testing.assert_array_equal(dist, bruteDist)
+        index.probes = 3
+        dist, idx = index.neighbours(features, gallery, 9)
+        self.assertGreater(np.mean([len(np.intersect1d(idx[k], bruteIdx[k]))/9 for k in range(20)]), 0.8)
+        # Each cell is compared with exactly the library cells of its closest clusters, however the cells are batched
+        for k, chosen in enumerate(nearestCentres(features, index.centres, 3)):
+            members = np.sort(np.concatenate([index.order[index.starts[c]:index.starts[c + 1]] for c in chosen]))
+            cellDist, found = nearestNeighbours(features[k:k + 1], gallery[members], 9)
+            np.testing.assert_array_equal(idx[k], members[found[0]])
+            np.testing.assert_array_equal(dist[k], cellDist[0])
+        small = index.neighbours(features, gallery, 9, chunk=1)
+        np.testing.assert_array_equal(small[0], dist)
+        np.testing.assert_array_equal(small[1], idx)
+
+        resDict = {'SCORE': gallery, 'latent': np.array([4., 3., 2., 1.]), 'colTypes': ['a', 'b']*1000}
+        report = compareIndex(resDict, 100, near=5, sample=50, clusters=20, probes=20)
+        self.assertEqual(report['sample'], 50)
+        self.assertEqual(report['recall'], 1.)
+        self.assertEqual(report['agreement'], 1.)
+        with tempfile.TemporaryDirectory() as l_dir:
+            buildIndex(l_dir, resDict, pcThresh=100, method='clusters', probes=4)
+            index = loadIndex(l_dir, resDict)
+            self.assertIsInstance(index, ClusterIndex)
+            self.assertEqual(index.probes, 4)
+            self.assertTrue(index.usable(index.pcNum, 10))
+            self.assertEqual(loadIndex(l_dir, resDict, probes=2).probes, 2)
+            self.assertEqual(loadIndex(l_dir, resDict, probes=100).probes, len(index.centres))
+
+
+class libraryStoreTest(unittest.TestCase):
+    def testconvertlibrary(self):
+        rng = np.random.RandomState(3)
+        dicti = {'latent': np.array([3., 2., 1.]), 'SCORE': rng.normal(size=[4, 3]), 'eigenV': rng.normal(size=[9, 3]),
+                 'meanV': rng.random_sample(9), 'colTypes': ['Apples', 'Pears', 'Apples', 'Oranges']}
+        with tempfile.TemporaryDirectory() as l_dir:
+            self.assertFalse(libraryExists(l_dir))
+            with open(os.path.join(l_dir, 'LibraryInfo.pkl'), 'wb') as f:
+                pickle.dump(dicti, f)
+            self.assertIsInstance(loadLibrary(l_dir), dict)
+            convertLibrary(l_dir)
+            library = loadLibrary(l_dir)
+            self.assertIsInstance(library, LibraryInfo)
+            for key in ['latent', 'SCORE', 'eigenV', 'meanV']:
+                np.testing.assert_array_equal(library[key], dicti[key])
+            self.assertEqual(list(library['colTypes']), dicti['colTypes'])
+            self.assertTrue(library['eigenV'].flags['F_CONTIGUOUS'])
+            self.assertEqual(pickle.loads(pickle.dumps(library)).version, library.version)
+
+            # Compiling again leaves a library that is already open as it was
+            smaller = dict(dicti, SCORE=dicti['SCORE'][0:2], colTypes=dicti['colTypes'][0:2])
+            latest = saveLibrary(l_dir, smaller)
+            self.assertNotEqual(latest.version, library.version)
+            self.assertEqual(np.shape(library['SCORE']), (4, 3))
+            self.assertEqual(len(library['colTypes']), 4)
+            self.assertEqual(len(loadLibrary(l_dir)['colTypes']), 2)
+            self.assertEqual(sorted(name for name in os.listdir(l_dir) if name.endswith('.npy')),
+                             sorted(latest.manifest['arrays'].values()))
+
+
+class constructLibraryTest(unittest.TestCase):
+    def testincremental(self):
+        source = os.path.join(os.path.dirname(__file__), 'Library')
+        with tempfile.TemporaryDirectory() as l_dir:
+            for category in ['Biconcave', 'Lysing', 'Spherocytic']:
+                shutil.copytree(os.path.join(source, category), os.path.join(l_dir, category))
+            held = os.path.join(l_dir, 'Biconcave', '10_10.tif')
+            shutil.move(held, held + '.held')
+            report = compileLibrary(l_dir, incremental=True)
+            self.assertTrue(report['refit'])
+            shutil.move(held + '.held', held)
+            report = compileLibrary(l_dir, incremental=True)
+            self.assertEqual(report['added'], [os.path.join('Biconcave', '10_10.tif')])
+            self.assertEqual(report['unchanged'], 17)
+            self.assertFalse(report['refit'])
+            updated = dict((key, np.array(value)) for key, value in loadLibrary(l_dir).items())
+            compileLibrary(l_dir)
+            full = loadLibrary(l_dir)
+            np.testing.assert_allclose(updated['latent'][0:10], full['latent'][0:10])
+            np.testing.assert_allclose(np.abs(updated['SCORE'][:, 0:10]), np.abs(full['SCORE'][:, 0:10]), atol=1e-8)
+
+    def testtruncated(self):
+        source = os.path.join(os.path.dirname(__file__), 'Library')
+        with tempfile.TemporaryDirectory() as l_dir:
+            for category in ['Biconcave', 'Lysing', 'Spherocytic']:
+                shutil.copytree(os.path.join(source, category), os.path.join(l_dir, category))
+            compileLibrary(l_dir)
+            full = dict((key, np.array(value)) for key, value in loadLibrary(l_dir).items())
+            report = compileLibrary(l_dir, maxVariance=90, measureMemory=True)
+            truncated = loadLibrary(l_dir)
+            self.assertLess(report['components'], len(full['latent']))
+            self.assertGreater(report['peakMemory'], 0)
+            self.assertEqual(truncated['SCORE'].dtype, np.float32)
+            for pcThresh in [50, 80, 90]:
+                self.assertEqual(componentCount(truncated['latent'], pcThresh, truncated['totalVar']),
+                                 componentCount(full['latent'], pcThresh))
+        data = np.random.RandomState(0).normal(5, 2, [300, 40]).astype(np.float32)
+        np.testing.assert_allclose(columnVariance(data, rows=64), np.var(data, axis=0, ddof=1, dtype=np.float64))
+
+
+    def testprecision(self):
+        source = os.path.join(os.path.dirname(__file__), 'Library')
+        img = cv2.imread(os.path.join(os.path.dirname(__file__), '1_2.tif'))
+        with tempfile.TemporaryDirectory() as l_dir:
+            for category in ['Biconcave', 'Lysing', 'Spherocytic']:
+                shutil.copytree(os.path.join(source, category), os.path.join(l_dir, category))
+            results = []
+            for precision in ['float64', 'float32']:
+                report = compileLibrary(l_dir, precision=precision)
+                library = loadLibrary(l_dir)
+                self.assertEqual(report['precision'], precision)
+                self.assertEqual(library['eigenV'].dtype, np.dtype(precision))
+                row = greyRow(img, out=np.empty([1, np.size(img[:, :, 0])], dtype=library['eigenV'].dtype))
+                results.append(PCARecognition(row, library, False, l_dir, ['Biconcave', 'Lysing', 'Spherocytic']))
+            self.assertEqual(results[0][0], results[1][0])
+            np.testing.assert_allclose(results[0][1], results[1][1], atol=1e-3)
+
+
+class validationTest(unittest.TestCase):
+    def testcompareruns(self):
+        reference = [('a.tif', ['Biconcave', 'Edge'], np.array([[80.], [100.]])), ('b.tif', ['Lysing'], np.array([[60.]]))]
+        candidate = [('a.tif', ['Biconcave', 'Edge'], np.array([[80.5], [100.]])), ('b.tif', ['Other'], np.array([[49.]]))]
+        comparison = compareRuns(reference, candidate)
+        self.assertEqual(comparison['cells'], 3)
+        self.assertAlmostEqual(comparison['agreement'], 2/3)
+        self.assertEqual(comparison['maxDrift'], 11.)
+        self.assertEqual([cell['image'] for cell in comparison['disagreements']], ['b.tif'])
+
+
+class prefetchTest(unittest.TestCase):
+    def testprefetch(self):
+        paths = [str(k) for k in range(10)]
+        for depth in [0, 1, 3]:
+            with ImagePrefetcher(paths, depth=depth, maxBytes=2000, loader=lambda path: np.full(1000, int(path))) as images:
+                read = [(path, int(image[0])) for path, image in images]
+            self.assertEqual(read, [(path, int(path)) for path in paths])
+            self.assertEqual(images.stats['images'], 10)
+            self.assertEqual(images.stats['bytes'], 10*np.full(1000, 0).nbytes)
+
+
+class benchmarkTest(unittest.TestCase):
+    def testsyntheticfield(self):
+        image = syntheticField(512, 512, density=40, seed=1)
+        self.assertEqual(image.shape, (512, 512, 3))
+        np.testing.assert_array_equal(image, syntheticField(512, 512, density=40, seed=1))
+        self.assertGreater(len(detect(image, minSize=1000)), 0)
+        self.assertGreater(len(detect(syntheticField(512, 512, density=40, bf=False), minSize=1000, bf=False)), 0)
+
+    def testcompareresults(self):
+        baseline = {'stages': {'detect': {'best': 1.0}, 'analyze': {'best': 2.0}}}
+        current = {'stages': {'detect': {'best': 1.5}, 'analyze': {'best': 2.0}, 'segment': {'best': 1.0}}}
+        comparison = compareResults(baseline, current, tolerance=0.1)
+        self.assertEqual([row['stage'] for row in comparison], ['analyze', 'detect'])
+        self.assertEqual([row['regressed'] for row in comparison], [False, True])
+
+    def testimporttime(self):
+        for module in IMPORT_MODULES:
+            timing = importTime(module, repeat=1)
+            self.assertEqual(timing['gui'], [], module)
+            self.assertGreater(timing['best'], 0)
+
+
+class instrumentTest(unittest.TestCase):
+    def testinstrument(self):
+        Instrument.reset()
+        with Instrument.stage('detect'):
+            Instrument.count('image', 'cells', 3)
+        self.assertEqual(Instrument.snapshot(), {})
+        Instrument.enable()
+        try:
+            for _ in range(2):
+                with Instrument.stage('detect'):
+                    Instrument.count('image', 'cells', 3)
+        finally:
+            Instrument.disable()
+        Instrument.merge({'detect': {'calls': 1, 'seconds': 0.5}})
+        stages = Instrument.report()['stages']
+        Instrument.reset()
+        self.assertEqual(stages['detect']['calls'], 3)
+        self.assertGreaterEqual(stages['detect']['seconds'], 0.5)
+        self.assertEqual(stages['image']['cells'], 6)
+
+
+class commandLineTest(unittest.TestCase):
+    def testcommandline(self):
+        source = os.path.join(os.path.dirname(__file__), 'Library')
+        with tempfile.TemporaryDirectory() as l_dir:
+            for category in ['Biconcave', 'Lysing']:
+                shutil.copytree(os.path.join(source, category), os.path.join(l_dir, category))
+            config = os.path.join(l_dir, 'settings.json')
+            with open(config, 'w') as f:
+                json.dump({'library': l_dir, 'pcThresh': 80}, f)
+            self.assertEqual(commandLine(['compile', '--config', config, '--quiet']), 0)
+            self.assertTrue(libraryExists(l_dir))
+            self.assertEqual(commandLine(['recognize', '--library', l_dir, '--images', os.path.join(l_dir, 'none'),
+                                          '--quiet']), 3)
+            with open(config, 'w') as f:
+                json.dump({'threshold': 80}, f)
+            self.assertEqual(commandLine(['compile', '--config', config, '--library', l_dir, '--quiet']), 2)
+
+            # A run times its workbook, and a run that cannot write its workbook fails
+            with tempfile.TemporaryDirectory() as pics_dir:
+                shutil.copy(os.path.join(os.path.dirname(__file__), '1_2.tif'), pics_dir)
+                try:
+                    self.assertEqual(commandLine(['recognize', '--library', l_dir, '--images', pics_dir, '--instrument',
+                                                  '--database', os.path.join(l_dir, 'results.db'), '--quiet']), 0)
+                finally:
+                    Globs.end = False
+                with open(os.path.join(pics_dir, os.path.basename(pics_dir) + '_timing.json')) as f:
+                    stages = json.load(f)['stages']
+                self.assertEqual(stages['workbook']['calls'], 1)
+                self.assertEqual(stages['database']['calls'], 1)
+                os.remove(os.path.join(pics_dir, os.path.basename(pics_dir) + '.xlsx'))
+                os.mkdir(os.path.join(pics_dir, os.path.basename(pics_dir) + '.xlsx'))
+                try:
+                    for command in ['recognize', 'batch']:
+                        self.assertEqual(commandLine([command, '--library', l_dir, '--images', pics_dir, '--quiet']),
+                                         1)
+                finally:
+                    Globs.end = False
+
+
 class processFilesTest(unittest.TestCase):
     def testprocessfiles(self):
         imdir = os.path.join(os.path.dirname(__file__))
@@ -122,6 +514,324 @@ class processFilesTest(unittest.TestCase):
         self.assertEqual(confs[0:3], [np.array([[100.]]), np.array([[100.]]), np.array([[100.]])])
         np.testing.assert_almost_equal(confs[3], np.transpose(np.array([[]])))
 
+    def testprocessfilesparallel(self):
+        imdir = os.path.join(os.path.dirname(__file__))
+        libdir = os.path.join(os.path.dirname(__file__), 'Library')
+        types = ['BicEchinocytic', 'Biconcave', 'Echinocytic', 'Lysing', 'Other', 'SphEchinocytic', 'Spherocytic']
+        serial = ProcessFiles(libdir, imdir, types)
+        parallel = ProcessFiles(libdir, imdir, types, workers=2)
+        self.assertEqual(parallel[0], serial[0])
+        self.assertEqual(parallel[2], serial[2])
+        for j in range(len(serial[1])):
+            np.testing.assert_array_equal(parallel[1][j], serial[1][j])
+
+        # The images still queued are dropped as soon as the analysis is stopped
+        paths = [os.path.join(imdir, '1_2.tif')]*20
+        settings = {'typeArray': types, 'bits': 3, 'color': 'B', 'method': 'Triangle', 'minSize': 9000,
+                    'pcThresh': 90, 'confThresh': 50, 'bf': True, 'near': 10}
+        analysed = 0
+        try:
+            for _ in parallelImages(paths, libdir, settings, 2):
+                analysed += 1
+                Globs.end = True
+        finally:
+            Globs.end = False
+        self.assertEqual(analysed, 1)
+
+    def testiterprocessfiles(self):
+        imdir = os.path.join(os.path.dirname(__file__))
+        libdir = os.path.join(os.path.dirname(__file__), 'Library')
+        types = ['BicEchinocytic', 'Biconcave', 'Echinocytic', 'Lysing', 'Other', 'SphEchinocytic', 'Spherocytic']
+        whole = ProcessFiles(libdir, imdir, types)
+        records = list(iterProcessFiles(libdir, imdir, types))
+        self.assertEqual([record[0] for record in records], list(range(len(whole[0]))))
+        self.assertEqual([record[2] for record in records], whole[0])
+        self.assertEqual([record[4] for record in records], whole[2])
+        withAreas = ProcessFiles(libdir, imdir, types, withAreas=True, withNames=True)
+        self.assertEqual([record[5] for record in records], withAreas[3])
+        self.assertEqual([record[1] for record in records], withAreas[4])
+        image = cv2.imread(os.path.join(imdir, '1_2.tif'))
+        cells = detect(image, method='Triangle', table=True)
+        self.assertEqual(withAreas[3][imageNames(imdir).index('1_2.tif')], cells['area'].tolist())
+        self.assertGreater(len(cells), 0)
+
+
+    def testcropcells(self):
+        img = cv2.imread(os.path.join(os.path.dirname(__file__), '1_2.tif'))
+        side = len(img)
+        radius = int((side - 1)/2)
+        field = np.zeros([2*side, 2*side, 3], dtype=np.uint8)
+        field[side:, side:] = img
+        imInfo = [[side + radius, side + radius], [radius, 2*side - radius]]
+        buffer = RowBuffer(side*side)
+        cellData, valid = cropCells(field, imInfo, radius, out=buffer.rows(len(imInfo)))
+        np.testing.assert_array_equal(valid, [True, False])
+        np.testing.assert_array_equal(cellData[0], greyRow(img))
+        self.assertTrue(np.shares_memory(buffer.rows(1), buffer.data))
+
+
+class folderBatchTest(unittest.TestCase):
+    def testbatchfolders(self):
+        with tempfile.TemporaryDirectory() as pics_dir:
+            for folder in ['a/b/c/d', 'a/Labelled', 'e/.hidden']:
+                os.makedirs(os.path.join(pics_dir, folder))
+            if hasattr(os, 'symlink'):
+                os.symlink(os.path.join(pics_dir, 'a'), os.path.join(pics_dir, 'e', 'loop'))
+            folders = [os.path.relpath(folder, pics_dir) for folder in batchFolders(pics_dir, maxDepth=3)]
+            self.assertEqual(sorted(folders), sorted(['.', 'a', os.path.join('a', 'b'), os.path.join('a', 'b', 'c'),
+                                                      'e']))
+            self.assertLess(folders.index('a'), folders.index(os.path.join('a', 'b')))
+
+    def testbatch(self):
+        img = os.path.join(os.path.dirname(__file__), '1_2.tif')
+        l_dir = os.path.join(os.path.dirname(__file__), 'Library')
+        with tempfile.TemporaryDirectory() as pics_dir:
+            nested = os.path.join(pics_dir, 'a', 'b')
+            os.makedirs(nested)
+            for folder in [pics_dir, nested]:
+                shutil.copy(img, folder)
+            database = ResultsDatabase(os.path.join(pics_dir, 'results.db'))
+            Globs.batchEnd = False
+            with contextlib.redirect_stdout(io.StringIO()):
+                batch(l_dir, pics_dir, workers=2, database=database)
+            for folder in [pics_dir, nested]:
+                self.assertTrue(os.path.isfile(os.path.join(folder, os.path.basename(folder) + '.xlsx')))
+            runs = database.runs()
+            self.assertEqual(sorted(run['folder'] for run in runs), sorted([os.path.abspath(pics_dir), nested]))
+            self.assertTrue(all(run['completed'] and run['images'] == 1 for run in runs))
+            counts = database.counts(by='folder', folder=nested)
+            self.assertEqual(list(counts), [nested])
+            self.assertEqual(counts[nested]['cells'], len(database.cells(folder=nested)))
+            database.close()
+
+
+class resultCacheTest(unittest.TestCase):
+    def testdiskcache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            entry = len(pickle.dumps(np.zeros(100), protocol=pickle.HIGHEST_PROTOCOL))
+            cache = DiskCache(directory, maxBytes=int(3.5*entry))
+            for k in range(3):
+                cache.put('%064x' % k, np.zeros(100))
+                os.utime(cache._path('%064x' % k), (k, k))
+            self.assertIsNotNone(cache.get('%064x' % 0))
+            cache.put('%064x' % 3, np.zeros(100))
+            self.assertLessEqual(cache.size(), cache.maxBytes)
+            self.assertIsNone(cache.get('%064x' % 1))
+            self.assertIsNotNone(cache.get('%064x' % 0))
+            self.assertGreater(cache.stats['evicted'], 0)
+
+            # Processes sharing the folder keep to the limit between them
+            cache.clear()
+            shared = [DiskCache(directory, maxBytes=int(3.5*entry)) for _ in range(2)]
+            for k in range(8):
+                shared[k % 2].put('%064x' % (k + 10), np.zeros(100))
+                self.assertLessEqual(cache.size(), cache.maxBytes)
+
+    def testcachedresults(self):
+        source = os.path.dirname(__file__)
+        l_dir = os.path.join(source, 'Library')
+        types = ['BicEchinocytic', 'Biconcave', 'Echinocytic', 'Lysing', 'Other', 'SphEchinocytic', 'Spherocytic']
+        with tempfile.TemporaryDirectory() as work:
+            pics_dir = os.path.join(work, 'Images')
+            os.mkdir(pics_dir)
+            for name in ['1_2.tif', 'Cell5.png', 'Cell5Inv.png']:
+                shutil.copy(os.path.join(source, name), pics_dir)
+            cache = DiskCache(os.path.join(work, 'Cache'))
+            expected = ProcessFiles(l_dir, pics_dir, types, minSize=1000)
+            for workers in [1, 1, 2]:
+                cellTypes, cellConf, locations = ProcessFiles(l_dir, pics_dir, types, minSize=1000, workers=workers,
+                                                              cache=cache)
+                self.assertEqual(cellTypes, expected[0])
+                self.assertEqual(locations, expected[2])
+                for conf, expectedConf in zip(cellConf, expected[1]):
+                    np.testing.assert_array_equal(conf, expectedConf)
+            self.assertEqual(cache.stats['stored'], 3)
+            self.assertEqual(cache.stats['hits'], 3)
+            self.assertEqual(len(list(cache._entries())), 3)
+            ProcessFiles(l_dir, pics_dir, types, minSize=2000, cache=cache)
+            self.assertEqual(cache.stats['stored'], 6)
+
+    def testcacheddetections(self):
+        source = os.path.dirname(__file__)
+        l_dir = os.path.join(source, 'Library')
+        types = ['BicEchinocytic', 'Biconcave', 'Echinocytic', 'Lysing', 'Other', 'SphEchinocytic', 'Spherocytic']
+        with tempfile.TemporaryDirectory() as work:
+            pics_dir = os.path.join(work, 'Images')
+            os.mkdir(pics_dir)
+            for name in ['1_2.tif', 'Cell5.png', 'Cell5Inv.png']:
+                shutil.copy(os.path.join(source, name), pics_dir)
+            detections = DiskCache(os.path.join(work, 'Detections'))
+            for pcThresh, workers in [(90, 1), (80, 1), (70, 2)]:
+                expected = ProcessFiles(l_dir, pics_dir, types, minSize=1000, pcThresh=pcThresh)
+                cellTypes, cellConf, locations = ProcessFiles(l_dir, pics_dir, types, minSize=1000, pcThresh=pcThresh,
+                                                              workers=workers, detections=detections)
+                self.assertEqual(cellTypes, expected[0])
+                self.assertEqual(locations, expected[2])
+                for conf, expectedConf in zip(cellConf, expected[1]):
+                    np.testing.assert_array_equal(conf, expectedConf)
+            self.assertEqual(detections.stats['stored'], 3)
+            self.assertEqual(detections.stats['hits'], 3)
+
+            # Images whose cells are cached are not decoded
+            radius = int((np.sqrt(np.shape(loadLibrary(l_dir)['eigenV'])[0]) - 1)/2)
+            base = detectionSettingsKey(detectionSettings(3, 'B', 'Triangle', 1000, True, radius))
+            reader = CachedReader(detections=detections, detectionBase=base)
+            path = os.path.join(pics_dir, 'Cell5.png')
+            self.assertIsNone(reader(path))
+            self.assertEqual(len(reader.found[path]), 4)
+
+            ProcessFiles(l_dir, pics_dir, types, minSize=2000, detections=detections)
+            self.assertEqual(detections.stats['stored'], 6)
+
+
+class sweepTest(unittest.TestCase):
+    def testsweep(self):
+        source = os.path.dirname(__file__)
+        l_dir = os.path.join(source, 'Library')
+        types = ['BicEchinocytic', 'Biconcave', 'Echinocytic', 'Lysing', 'Other', 'SphEchinocytic', 'Spherocytic']
+        with tempfile.TemporaryDirectory() as pics_dir:
+            for name in ['1_2.tif', 'Cell5.png', 'Cell5Inv.png']:
+                shutil.copy(os.path.join(source, name), pics_dir)
+            Globs.end = False
+            report = sweep(l_dir, pics_dir, [50, 90], [3, 10], [40, 70], minSize=1000)
+            self.assertEqual(len(report['results']), 8)
+            for result in report['results']:
+                cellTypes, _, _ = ProcessFiles(l_dir, pics_dir, types, minSize=1000, pcThresh=result['pcThresh'],
+                                               near=result['near'], confThresh=result['confThresh'])
+                found = [name for image in cellTypes for name in image]
+                for name, count in result['counts'].items():
+                    self.assertEqual(found.count(name), count)
+                self.assertEqual(sum(result['counts'].values()), report['cells'])
+                self.assertEqual(sum(result['confidence']['histogram']),
+                                 report['cells'] - result['counts']['Edge'])
+
+
+class condenseLibraryTest(unittest.TestCase):
+    def testcondenseprototypes(self):
+        rng = np.random.RandomState(5)
+        codes = rng.randint(0, 3, size=600)
+        features = rng.normal(size=[600, 4]) + 6*codes[:, None]
+        kept = condensePrototypes(features, codes, block=64)
+        self.assertLess(np.sum(kept), 60)
+        self.assertEqual(sorted(set(codes[kept])), [0, 1, 2])
+        _, idx = nearestNeighbours(features, features[kept], 1)
+        np.testing.assert_array_equal(codes[kept][idx[:, 0]], codes)
+
+    def testcondenselibrary(self):
+        with tempfile.TemporaryDirectory() as work:
+            l_dir = os.path.join(work, 'Library')
+            out_dir = os.path.join(work, 'Condensed')
+            syntheticLibrary(l_dir)
+            compileLibrary(l_dir)
+            report = condenseLibrary(l_dir, out_dir, near=5)
+            condensed = loadLibrary(out_dir)
+            self.assertEqual(len(condensed['SCORE']), report['kept'])
+            self.assertEqual(report['kept'] + len(report['removed']), report['exemplars'])
+            self.assertEqual(len(libraryImages(out_dir)[1]), report['kept'])
+            np.testing.assert_array_equal(condensed['eigenV'], loadLibrary(l_dir)['eigenV'])
+            self.assertTrue(0 <= report['condensedAccuracy'] <= 1)
+            self.assertEqual(commandLine(['condense', '--library', l_dir, '--output', out_dir, '--quiet']), 2)
+
+
+class resultsDatabaseTest(unittest.TestCase):
+    def testresultsdatabase(self):
+        Globs.end = False
+        with tempfile.TemporaryDirectory() as folder:
+            database = ResultsDatabase(os.path.join(folder, 'results.db'))
+            for pics_dir in ['a', os.path.join('a', 'b'), 'ab', 'a']:
+                sink = DatabaseSink(database, os.path.join(folder, pics_dir), folder, batchCells=2, pcThresh=90)
+                sink.add(0, '1.tif', ['Echinocytic', 'Biconcave', 'Edge'], np.array([[95.], [60.], [100.]]),
+                         [[1, 2], [3, 4], [5, 6]])
+                sink.add(1, '2.tif', [], np.zeros([0, 1]), [])
+                sink.add(2, '3.tif', ['Echinocytic'], np.array([[40.]]), [[7, 8]])
+                sink.close()
+
+            runs = database.runs()
+            self.assertEqual([run['images'] for run in runs], [3, 3, 3, 3])
+            self.assertEqual(runs[0]['settings'], {'pcThresh': 90})
+            self.assertEqual(len(database.runs(latest=True)), 3)
+
+            cells = database.cells(label='Echinocytic', minConf=90)
+            self.assertEqual(len(cells), 4)
+            self.assertEqual([cells[0][key] for key in ['image', 'cell', 'label', 'confidence', 'row', 'column']],
+                             ['1.tif', 0, 'Echinocytic', 95., 1, 2])
+            self.assertEqual(len(database.cells(label=['Echinocytic', 'Biconcave'], maxConf=60, latest=True)), 6)
+            self.assertEqual(len(database.cells(folder=os.path.join(folder, 'a'))), 12)
+            self.assertEqual(len(database.cells(since='2000-01-01', until='2000-01-02')), 0)
+            self.assertEqual(len(database.cells(limit=2)), 2)
+
+            counts = database.counts(latest=True)
+            self.assertEqual(counts['Echinocytic']['cells'], 6)
+            self.assertAlmostEqual(counts['Echinocytic']['confidence'], 67.5)
+            self.assertEqual(database.counts(by='image', folder=os.path.join(folder, 'ab')),
+                             {os.path.join(folder, 'ab') + '/1.tif': {'cells': 3, 'confidence': 85.},
+                              os.path.join(folder, 'ab') + '/3.tif': {'cells': 1, 'confidence': 40.}})
+            with self.assertRaises(ValueError):
+                database.counts(by='colour')
+
+            # A copy, as sent to another process, writes to the same file
+            copy = pickle.loads(pickle.dumps(database))
+            self.assertEqual(len(copy.runs()), 4)
+            copy.close()
+            database.close()
+
+
+class resultSinksTest(unittest.TestCase):
+    def testpicklesink(self):
+        records = [(0, 'a.tif', ['Biconcave', 'Edge'], np.array([[62.5], [100.]]), [[10, 20], [30, 40]]),
+                   (1, 'b.tif', [], np.zeros([0, 1]), [])]
+        with tempfile.TemporaryDirectory() as pics_dir:
+            sink = PickleSink(pics_dir, ['Biconcave', 'Other', 'Edge'])
+            for record in records:
+                sink.add(*record)
+            sink.close()
+            with open(os.path.join(pics_dir, 'IdentifiedCellInfo.pkl'), 'rb') as f:
+                results = pickle.load(f)
+        self.assertEqual(results, [[['Biconcave', ' 62.5%', [10, 20]], ['Edge', ' 100.0%', [30, 40]]], [],
+                                   ['Biconcave', 'Other', 'Edge']])
+
+
+class cellTableTest(unittest.TestCase):
+    def testcelltable(self):
+        records = [(0, 'a.tif', ['Biconcave', 'Edge'], np.array([[62.5], [100.]]), [[10, 20], [30, 40]]),
+                   (1, 'b.tif', [], np.zeros([0, 1]), []),
+                   (2, 'c.tif', ['Ignore'], np.array([[12.]]), [[5, 6]])]
+        with tempfile.TemporaryDirectory() as pics_dir:
+            sink = CellTableSink(pics_dir, ['Biconcave', 'Other', 'Edge'], pcThresh=90)
+            for record in records:
+                sink.add(*record)
+            sink.close()
+            table = readCellTable(pics_dir)
+            self.assertEqual(table['images'], ['a.tif', 'b.tif', 'c.tif'])
+            self.assertEqual(table['settings'], {'pcThresh': 90})
+            self.assertEqual([table['types'][code] for code in table['label']], ['Biconcave', 'Edge', 'Ignore'])
+            self.assertEqual(table['image'].tolist(), [0, 0, 2])
+            self.assertEqual(table['cell'].tolist(), [0, 1, 0])
+            self.assertEqual(table['confidence'].tolist(), [62.5, 100., 12.])
+            self.assertEqual(table['row'].tolist(), [10, 30, 5])
+            self.assertEqual(table['column'].tolist(), [20, 40, 6])
+            self.assertEqual(table['area'].tolist(), [-1, -1, -1])
+
+            # A block cut short is dropped
+            with open(sink.table_file, 'rb+') as f:
+                f.truncate(os.path.getsize(sink.table_file) - 3)
+            table = readCellTable(sink.table_file)
+            self.assertEqual(table['images'], ['a.tif', 'b.tif'])
+            self.assertEqual(table['row'].tolist(), [10, 30])
+
+            # Appending keeps the rows and cell types already in the table
+            sink = CellTableSink(pics_dir, ['Biconcave', 'Lysing', 'Edge'], append=True, pcThresh=80)
+            sink.add(0, 'd.tif', ['Lysing', 'Biconcave'], np.array([[70.], [80.]]), [[1, 2], [3, 4]], [900, 1000])
+            sink.close()
+            table = readCellTable(pics_dir)
+            self.assertEqual(table['images'], ['a.tif', 'b.tif', 'd.tif'])
+            self.assertEqual([table['types'][code] for code in table['label']],
+                             ['Biconcave', 'Edge', 'Lysing', 'Biconcave'])
+            self.assertEqual(table['image'].tolist(), [0, 0, 2, 2])
+            self.assertEqual(table['area'].tolist(), [-1, -1, 900, 1000])
+            self.assertEqual(table['runs'], [{'settings': {'pcThresh': 90}, 'firstImage': 0},
+                                             {'settings': {'pcThresh': 80}, 'firstImage': 2}])
+
 
 def main():
     unittest.main()